@@ -0,0 +1,328 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import urllib.request
+from datetime import datetime
+from typing import List, Dict, Any, Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULT_PREFIX = "BENCH_RESULT "
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_scenario(scenario: Dict[str, Any]) -> Dict[str, Any]:
+    # Runs in a child process with the scenario's work directory as cwd, so peak RSS and the
+    # processor's log file belong to this scenario only
+    import asyncio
+    sys.path.insert(0, REPO_DIR)
+    import gemini_processor
+    
+    gemini_processor.logger.setLevel(scenario["log_level"])
+    
+    processor = gemini_processor.GeminiProcessor(
+        api_keys=scenario["api_keys"],
+        system_prompt_file="system_prompt.txt",
+        output_file="results.jsonl",
+        checkpoint_dir="checkpoints",
+        concurrency=scenario["concurrency"],
+        max_retries=scenario["max_retries"],
+        rpm_limit=scenario["client_rpm_limit"],
+        daily_limit=scenario["client_daily_limit"],
+        key_wait_timeout=scenario["timeout"],
+        output_format="jsonl",
+        pack_size=scenario["pack_size"],
+        adaptive_concurrency=scenario["adaptive_concurrency"],
+        api_url=scenario["api_url"]
+    )
+    
+    latencies: List[float] = []
+    failures = {"count": 0}
+    send = processor._send_gemini_request
+    
+    async def timed_send(data: Dict[str, Any], api_key: str, items: int = 1) -> Any:
+        start = time.perf_counter()
+        result = await send(data, api_key, items=items)
+        latencies.append(time.perf_counter() - start)
+        if isinstance(result, str):
+            failures["count"] += 1
+        return result
+    
+    processor._send_gemini_request = timed_send
+    
+    start = time.perf_counter()
+    asyncio.run(processor.process_questions_async(gemini_processor.iter_questions("questions.jsonl")))
+    elapsed = time.perf_counter() - start
+    
+    return {
+        "elapsed": elapsed,
+        "processed": processor.processed_count,
+        "successful": processor.success_count,
+        "errors": processor.error_count,
+        "throughput": processor.success_count / elapsed if elapsed > 0 else 0,
+        "attempts": len(latencies),
+        "failed_attempts": failures["count"],
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "latency_mean": statistics.mean(latencies) if latencies else None,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+
+def start_mock(args: argparse.Namespace) -> tuple:
+    command = [
+        sys.executable, os.path.join(REPO_DIR, "mock_gemini_server.py"),
+        "--port", "0",
+        "--latency", args.latency,
+        "--response-chars", args.response_chars,
+        "--error-429-rate", str(args.error_429_rate),
+        "--error-5xx-rate", str(args.error_5xx_rate)
+    ]
+    if args.rpm_limit:
+        command += ["--rpm-limit", str(args.rpm_limit)]
+    if args.daily_limit:
+        command += ["--daily-limit", str(args.daily_limit)]
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    
+    mock = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    line = mock.stdout.readline()
+    if not line.startswith("MOCK_URL "):
+        mock.kill()
+        raise RuntimeError("Mock server did not start")
+    return mock, line[len("MOCK_URL "):].strip()
+
+
+def fetch_mock_stats(api_url: str) -> Dict[str, Any]:
+    base = api_url.split("/v1beta/", 1)[0]
+    with urllib.request.urlopen(f"{base}/stats", timeout=10) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def key_utilization(stats: Dict[str, Any], api_keys: List[str], rpm_limit: Optional[int], elapsed: float) -> Dict[str, Any]:
+    # Share of each key's RPM capacity that turned into successful requests during the run
+    ok_counts = [stats["per_key"].get(key, {}).get("ok", 0) for key in api_keys]
+    utilization: Dict[str, Any] = {
+        "keys_used": sum(1 for count in ok_counts if count),
+        "min_requests": min(ok_counts),
+        "max_requests": max(ok_counts)
+    }
+    if rpm_limit and elapsed > 0:
+        capacity = rpm_limit * elapsed / 60
+        shares = [count / capacity for count in ok_counts]
+        utilization["mean"] = statistics.mean(shares)
+        utilization["min"] = min(shares)
+        utilization["max"] = max(shares)
+    return utilization
+
+
+def run_benchmark(args: argparse.Namespace, key_count: int, concurrency: int, pack_size: int, repeat: int) -> Dict[str, Any]:
+    name = f"keys={key_count},concurrency={concurrency},pack={pack_size}"
+    work_dir = tempfile.mkdtemp(prefix="gemini-bench-")
+    mock = None
+    try:
+        with open(os.path.join(work_dir, "questions.jsonl"), 'w', encoding='utf-8') as f:
+            for i in range(args.questions):
+                f.write(json.dumps({"id": i, "question": f"Benchmark question number {i}: how does request pipelining work?"}) + "\n")
+        with open(os.path.join(work_dir, "system_prompt.txt"), 'w', encoding='utf-8') as f:
+            f.write("You are a helpful assistant.")
+        
+        mock, api_url = start_mock(args)
+        api_keys = [f"bench-key-{i:04d}" for i in range(key_count)]
+        scenario = {
+            "api_keys": api_keys,
+            "api_url": api_url,
+            "concurrency": concurrency,
+            "pack_size": pack_size,
+            "adaptive_concurrency": args.adaptive_concurrency,
+            "max_retries": args.max_retries,
+            # Client-side limits match the mock's unless overridden, as they would against the real API
+            "client_rpm_limit": args.client_rpm_limit or args.rpm_limit or 1000000,
+            "client_daily_limit": args.daily_limit or 1000000,
+            "timeout": args.timeout,
+            "log_level": args.log_level
+        }
+        
+        logger.info(f"Running {name} (repeat {repeat + 1}/{args.repeat})")
+        child = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--scenario", json.dumps(scenario)],
+            cwd=work_dir,
+            capture_output=True,
+            text=True,
+            timeout=args.timeout
+        )
+        result_lines = [line for line in child.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+        if child.returncode != 0 or not result_lines:
+            logger.error(f"Scenario {name} failed (exit {child.returncode}): {child.stderr.strip()[-500:]}")
+            return {"name": name, "repeat": repeat, "error": f"exit {child.returncode}"}
+        
+        result = json.loads(result_lines[-1][len(RESULT_PREFIX):])
+        stats = fetch_mock_stats(api_url)
+        result.update({
+            "name": name,
+            "repeat": repeat,
+            "keys": key_count,
+            "concurrency": concurrency,
+            "pack_size": pack_size,
+            "questions": args.questions,
+            "wasted_retries": result["failed_attempts"],
+            "server": {k: v for k, v in stats.items() if k not in ("per_key", "started", "uptime", "in_flight")},
+            "key_utilization": key_utilization(stats, api_keys, args.rpm_limit, result["elapsed"])
+        })
+        return result
+    except Exception as e:
+        logger.error(f"Error running scenario {name}: {e}")
+        return {"name": name, "repeat": repeat, "error": str(e)}
+    finally:
+        if mock is not None:
+            mock.terminate()
+            mock.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def summarize(runs: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    # Medians across repeats, keyed by scenario name, for regression comparisons
+    summary: Dict[str, Dict[str, Any]] = {}
+    for name in dict.fromkeys(run["name"] for run in runs):
+        ok_runs = [run for run in runs if run["name"] == name and "error" not in run]
+        if not ok_runs:
+            summary[name] = {"error": "all repeats failed"}
+            continue
+        summary[name] = {
+            metric: statistics.median(run[metric] for run in ok_runs)
+            for metric in ("throughput", "latency_p50", "latency_p95", "latency_p99", "wasted_retries", "peak_rss_mb")
+            if all(run[metric] is not None for run in ok_runs)
+        }
+    return summary
+
+
+def compare_to_baseline(summary: Dict[str, Dict[str, Any]], baseline_file: str, tolerance: float) -> List[str]:
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        baseline = json.load(f).get("summary", {})
+    
+    regressions = []
+    for name, current in summary.items():
+        previous = baseline.get(name)
+        if not previous or "throughput" not in previous or "throughput" not in current:
+            continue
+        if current["throughput"] < previous["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {current['throughput']:.2f}/s vs {previous['throughput']:.2f}/s")
+        if previous.get("latency_p95") and current.get("latency_p95", 0) > previous["latency_p95"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 latency {current['latency_p95']:.3f}s vs {previous['latency_p95']:.3f}s")
+    return regressions
+
+
+def parse_int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark GeminiProcessor against the local mock Gemini server")
+    parser.add_argument("--keys", type=parse_int_list, default=[1, 4], help="Comma-separated API key counts to try")
+    parser.add_argument("--concurrency", type=parse_int_list, default=[5, 20], help="Comma-separated concurrency settings to try")
+    parser.add_argument("--pack-size", type=parse_int_list, default=[1], help="Comma-separated --pack-size settings to try")
+    parser.add_argument("--adaptive-concurrency", action="store_true", help="Run the processor with --adaptive-concurrency")
+    parser.add_argument("--questions", type=int, default=300, help="Questions per scenario")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per scenario; the summary uses the median")
+    parser.add_argument("--max-retries", type=int, default=5, help="Processor retries per question")
+    parser.add_argument("--latency", default="lognormal:0.2,0.5", help="Mock latency distribution (see mock_gemini_server.py)")
+    parser.add_argument("--response-chars", default="uniform:200,800", help="Mock answer length distribution")
+    parser.add_argument("--rpm-limit", type=int, default=600, help="Per-key RPM enforced by the mock (0 for none)")
+    parser.add_argument("--client-rpm-limit", type=int, default=None,
+                    help="Per-key RPM the processor assumes (default: --rpm-limit)")
+    parser.add_argument("--daily-limit", type=int, default=0, help="Per-key daily limit enforced by the mock (0 for none)")
+    parser.add_argument("--error-429-rate", type=float, default=0.0, help="Fraction of requests the mock answers with 429")
+    parser.add_argument("--error-5xx-rate", type=float, default=0.0, help="Fraction of requests the mock answers with 500/503")
+    parser.add_argument("--seed", type=int, default=1234, help="Mock random seed")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds before a scenario is abandoned")
+    parser.add_argument("--log-level", default="ERROR", help="Log level for the processor inside scenarios")
+    parser.add_argument("--output", default="benchmark_results.json", help="Machine-readable results file")
+    parser.add_argument("--baseline", help="Earlier results file to compare against; exits 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                    help="Allowed relative throughput drop / p95 latency rise before it counts as a regression")
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)
+    
+    args = parser.parse_args()
+    
+    if args.scenario:
+        result = run_scenario(json.loads(args.scenario))
+        print(RESULT_PREFIX + json.dumps(result), flush=True)
+        return 0
+    
+    runs = []
+    for key_count in args.keys:
+        for concurrency in args.concurrency:
+            for pack_size in args.pack_size:
+                for repeat in range(args.repeat):
+                    run = run_benchmark(args, key_count, concurrency, pack_size, repeat)
+                    runs.append(run)
+                    if "error" not in run:
+                        logger.info(
+                            f"{run['name']}: {run['throughput']:.2f} questions/s, "
+                            f"p50/p95/p99 {run['latency_p50']:.3f}/{run['latency_p95']:.3f}/{run['latency_p99']:.3f}s, "
+                            f"{run['wasted_retries']} wasted retries, peak RSS {run['peak_rss_mb'] or 0:.1f} MB"
+                        )
+    
+    summary = summarize(runs)
+    results = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("scenario", "output", "baseline")},
+        "summary": summary,
+        "runs": runs
+    }
+    
+    tmp_path = f"{args.output}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    os.replace(tmp_path, args.output)
+    logger.info(f"Benchmark results saved to {args.output}")
+    
+    if args.baseline:
+        regressions = compare_to_baseline(summary, args.baseline, args.tolerance)
+        for regression in regressions:
+            logger.error(f"Regression: {regression}")
+        if regressions:
+            return 1
+        logger.info(f"No regressions against {args.baseline}")
+    
+    return 1 if any("error" in run for run in runs) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
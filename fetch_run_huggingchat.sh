@@ -125,12 +125,13 @@ if [ "$USE_LOCAL_MODEL" = true ]; then
     echo "🚀 Starting llama.cpp server..."
     
     # Use the appropriate llama-server command based on availability
+    # 4 parallel slots of 2048 tokens with continuous batching, so gemini_processor.py --local-backend can keep 4 requests in flight
     if command -v llama-server &> /dev/null; then
-      llama-server --model models/Phi-3-mini-4k-instruct-q4.gguf -c 2048 --port 8080 &
+      llama-server --model models/Phi-3-mini-4k-instruct-q4.gguf -c 8192 --parallel 4 --cont-batching --port 8080 &
     elif [ -f "/workspace/llama.cpp/build/bin/llama-server" ]; then
-      /workspace/llama.cpp/build/bin/llama-server --model models/Phi-3-mini-4k-instruct-q4.gguf -c 2048 --port 8080 &
+      /workspace/llama.cpp/build/bin/llama-server --model models/Phi-3-mini-4k-instruct-q4.gguf -c 8192 --parallel 4 --cont-batching --port 8080 &
     elif [ -f "llama.cpp/build/bin/llama-server" ]; then
-      $(pwd)/llama.cpp/build/bin/llama-server --model models/Phi-3-mini-4k-instruct-q4.gguf -c 2048 --port 8080 &
+      $(pwd)/llama.cpp/build/bin/llama-server --model models/Phi-3-mini-4k-instruct-q4.gguf -c 8192 --parallel 4 --cont-batching --port 8080 &
     else
       echo "⚠️ Could not find llama-server. Falling back to remote models."
       USE_LOCAL_MODEL=false
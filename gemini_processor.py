@@ -1,137 +1,2131 @@
 import json
 import time
 import os
+import re
 import sys
 import random
+import asyncio
 import logging
+import logging.handlers
 import argparse
 import signal
+import atexit
+import socket
+import sqlite3
+import queue
+import bisect
+import hashlib
+import heapq
+import itertools
+import mmap
+import shutil
+import zlib
 import threading
-from concurrent.futures import ThreadPoolExecutor
+import unicodedata
+import concurrent.futures
+from array import array
+from collections import OrderedDict, deque
 from datetime import datetime
-from typing import List, Dict, Any, Optional, Set
-import requests
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("gemini_processor.log"),
-        logging.StreamHandler()
-    ]
-)
+from email.utils import parsedate_to_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import List, Dict, Any, Awaitable, Callable, Iterable, Optional, Set
+from urllib.parse import parse_qs, urlsplit
+import httpx
+
+try:
+    import h2  # noqa: F401 - only needed so httpx can negotiate HTTP/2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+# Attributes every LogRecord has; anything else on a record came from extra= and is written as a field
+LOG_RECORD_FIELDS = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "event", "suppressed"}
+
+
+class LogSampler(logging.Filter):
+    # Drops repetitive records on the logging thread before they are queued. Records are grouped
+    # by their "event" (or their call site when they have none); a group passes at most rate_limit
+    # records per second, and events in sample_rates keep only that fraction of their records.
+    # The next record of a group to pass carries how many were dropped since the last one.
+    def __init__(self, rate_limit: float = 20, sample_rates: Optional[Dict[str, float]] = None):
+        super().__init__()
+        self.rate_limit = rate_limit
+        self.sample_rates = sample_rates or {}
+        self.lock = threading.Lock()
+        # group -> [window start, passed in window, seen, dropped since the last one passed]
+        self.groups: Dict[str, List[float]] = {}
+        self.suppressed_total = 0
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        group_name = getattr(record, "event", None) or f"{record.module}:{record.lineno}"
+        rate = self.sample_rates.get(group_name, 1.0)
+        with self.lock:
+            group = self.groups.get(group_name)
+            if group is None:
+                group = self.groups[group_name] = [record.created, 0, 0, 0]
+            group[2] += 1
+            keep = rate >= 1 or (rate > 0 and (group[2] - 1) % round(1 / rate) == 0)
+            if keep and self.rate_limit:
+                if record.created - group[0] >= 1:
+                    group[0] = record.created
+                    group[1] = 0
+                keep = group[1] < self.rate_limit
+            if not keep:
+                group[3] += 1
+                self.suppressed_total += 1
+                return False
+            group[1] += 1
+            record.suppressed = group[3]
+            group[3] = 0
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler formats the message on the calling thread. Here the record is queued
+    # as it is, so %-style arguments are only formatted on the listener thread. Callers pass
+    # immutable arguments, so nothing changes under the record while it waits.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class TextLogFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s - %(levelname)s - %(message)s')
+    
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        if getattr(record, "suppressed", 0):
+            text += f" ({record.suppressed} similar messages suppressed)"
+        return text
+
+
+class JsonLogFormatter(logging.Formatter):
+    # One JSON object per line: time, level, event, message, then any extra= fields
+    def format(self, record: logging.LogRecord) -> str:
+        event: Dict[str, Any] = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": getattr(record, "event", None),
+            "message": record.getMessage(),
+        }
+        event.update((k, v) for k, v in record.__dict__.items() if k not in LOG_RECORD_FIELDS)
+        if getattr(record, "suppressed", 0):
+            event["suppressed"] = record.suppressed
+        if record.exc_info:
+            event["exception"] = self.formatException(record.exc_info)
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+log_listener: Optional[logging.handlers.QueueListener] = None
+log_queue_handler: Optional[LazyQueueHandler] = None
+
+
+def configure_logging(
+    log_file: Optional[str] = "gemini_processor.log",
+    log_format: str = "json",
+    rate_limit: float = 20,
+    sample_rates: Optional[Dict[str, float]] = None,
+    force: bool = False
+) -> None:
+    # Callers only put records on a queue; one listener thread formats them and does the console
+    # and file I/O. Like basicConfig, this leaves logging alone when the embedding program has
+    # already set it up, unless force is given.
+    global log_listener, log_queue_handler
+    root = logging.getLogger()
+    if root.handlers and log_queue_handler is None and not force:
+        return
+    stop_logging()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    
+    console = logging.StreamHandler()
+    console.setFormatter(TextLogFormatter())
+    handlers: List[logging.Handler] = [console]
+    if log_file:
+        file_handler = logging.FileHandler(log_file, encoding="utf-8", delay=True)
+        file_handler.setFormatter(JsonLogFormatter() if log_format == "json" else TextLogFormatter())
+        handlers.append(file_handler)
+    
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    log_queue_handler = LazyQueueHandler(log_queue)
+    log_queue_handler.addFilter(LogSampler(rate_limit, sample_rates))
+    root.addHandler(log_queue_handler)
+    root.setLevel(logging.INFO)
+    log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+
+
+def stop_logging() -> None:
+    # Writes out everything still queued and closes the handlers
+    global log_listener, log_queue_handler
+    if log_queue_handler is not None:
+        sampler = log_queue_handler.filters[0]
+        if sampler.suppressed_total:
+            logging.getLogger(__name__).info(f"Dropped {sampler.suppressed_total} repetitive log records in total")
+        logging.getLogger().removeHandler(log_queue_handler)
+        log_queue_handler = None
+    if log_listener is not None:
+        log_listener.stop()
+        for handler in log_listener.handlers:
+            handler.close()
+        log_listener = None
+
+
+configure_logging()
+atexit.register(stop_logging)
 logger = logging.getLogger(__name__)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+
+class TimedLock:
+    # threading.Lock that can also record how long callers waited for it and held it (--profile).
+    # Untimed it adds one attribute check per acquire.
+    def __init__(self, name: str):
+        self.name = name
+        self.timed = False
+        self._lock = threading.Lock()
+        self._acquired_at = 0.0
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+    
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        if not self.timed:
+            return self._lock.acquire(blocking, timeout)
+        start = time.perf_counter()
+        contended = not self._lock.acquire(False)
+        if contended and not self._lock.acquire(blocking, timeout):
+            return False
+        now = time.perf_counter()
+        # Counters are only touched while the lock is held
+        self.acquisitions += 1
+        if contended:
+            self.contended += 1
+            self.wait_total += now - start
+            self.wait_max = max(self.wait_max, now - start)
+        self._acquired_at = now
+        return True
+    
+    def release(self) -> None:
+        if self.timed:
+            self.hold_total += time.perf_counter() - self._acquired_at
+        self._lock.release()
+    
+    def __enter__(self) -> bool:
+        return self.acquire()
+    
+    def __exit__(self, *exc_info: Any) -> None:
+        self.release()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'acquisitions': self.acquisitions,
+            'contended': self.contended,
+            'contention_rate': round(self.contended / self.acquisitions, 4) if self.acquisitions else 0.0,
+            'wait_total_seconds': round(self.wait_total, 6),
+            'wait_max_seconds': round(self.wait_max, 6),
+            'hold_total_seconds': round(self.hold_total, 6)
+        }
+
+
+shutdown_requested = False
+processing_lock = TimedLock("processing_lock")
+QUESTION_PROMPT = ''' Before giving the output ,
+1- read through all the instructions i have given you , 
+2 - prepare a checklist of what you have to deliverand
+ 3- make sure you are passing thorough all of them
+
+4-You won't need to write all the words in Telugu, You are free to use words which are English but written in Telugu(for example - సక్సెస్, ట్రస్ట్ like this) And make sure to keep the answer casual and very informational , use new telugu instrctions.
+
+5- Go through all the words you are going to use and context where you gonna use them , plan it all
+6- then decide the whole information you wat to write  - A 10 point plan of what information should output have and very information rich'''
+GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+PACKED_PROMPT = '''Handle every item in the JSON array below separately. For each item, follow this instruction, using the item's "question" in place of <QUESTION>:
+{instruction}
+
+Return a JSON array with exactly one object per item, in the form {{"id": <the item's id>, "response": <your full answer for that item>}}.
+
+Items:
+{items}'''
+PACKED_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "id": {"type": "INTEGER"},
+            "response": {"type": "STRING"},
+        },
+        "required": ["id", "response"],
+    },
+}
+RETRY_AFTER_PATTERN = re.compile(r"\(retry after ([0-9.]+)s\)")
+# Near-duplicate detection: MinHash over character shingles, 64 hash functions in 8 LSH bands of 8
+NORMALIZE_PATTERN = re.compile(r"[^\w\s]|_")
+NUMBER_PATTERN = re.compile(r"\d+")
+MINHASH_SHINGLE = 5
+MINHASH_BANDS = 8
+MINHASH_PRIME = (1 << 61) - 1
+MINHASH_RANDOM = random.Random(5381)
+MINHASH_PARAMS = [(MINHASH_RANDOM.randrange(1, MINHASH_PRIME), MINHASH_RANDOM.randrange(MINHASH_PRIME)) for _ in range(64)]
+# Response validation: finish reasons that mean the answer was withheld or cut off, letters of the
+# Telugu block, and letters of any other script
+BLOCKED_FINISH_REASONS = {"SAFETY", "RECITATION", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII", "IMAGE_SAFETY", "LANGUAGE", "OTHER", "content_filter"}
+TRUNCATED_FINISH_REASONS = {"MAX_TOKENS", "length"}
+TELUGU_PATTERN = re.compile(r"[\u0C00-\u0C7F]")
+OTHER_LETTER_PATTERN = re.compile(r"[^\W\d_\u0C00-\u0C7F]")
+CODE_FENCE_PATTERN = re.compile(r"^```[a-zA-Z]*\s*|\s*```$")
+# First word of every result store index ("GPSTORE1" read as a native-order integer)
+STORE_INDEX_MAGIC = int.from_bytes(b"GPSTORE1", sys.byteorder)
+TRANSLATE_PROMPT = 'use new telugu and write this question into telugu and keep it casually asking 2025 words, make it look like you are asking another person, Question: "{question}"'
+ANSWER_PROMPT = ' Answer this Question: "{question}" \n ' + QUESTION_PROMPT
+# Built-in templates that pipeline stages can name instead of spelling out
+PROMPT_TEMPLATES = {"translate": TRANSLATE_PROMPT, "answer": ANSWER_PROMPT}
+# Pipeline stage options and the GeminiProcessor arguments they override
+PIPELINE_OPTIONS = {
+    "system_prompt": "system_prompt_file",
+    "api_url": "api_url",
+    "concurrency": "concurrency",
+    "max_concurrency": "max_concurrency",
+    "pack_size": "pack_size",
+    "stream": "stream",
+    "expected_output_tokens": "expected_output_tokens",
+}
+
+
+class QuotaLedger:
+    def __init__(self, path: str, busy_timeout: float = 30):
+        self.path = path
+        self.lock = threading.Lock()
+        
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        
+        # WAL mode plus BEGIN IMMEDIATE transactions let several processes on one host share the
+        # ledger: each reservation is an atomic read-modify-write of one key's row.
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=busy_timeout)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS key_quota ("
+            "key_hash TEXT PRIMARY KEY, tokens REAL NOT NULL, refill_time REAL NOT NULL, "
+            "requests_today INTEGER NOT NULL, daily_reset_time REAL NOT NULL, "
+            "disabled_until REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+    
+    @staticmethod
+    def key_hash(key: str) -> str:
+        # Keys themselves are never written to disk
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+    
+    def _read(self, key_hash: str, rpm_limit: int, now: float) -> Dict[str, float]:
+        row = self.conn.execute(
+            "SELECT tokens, refill_time, requests_today, daily_reset_time, disabled_until FROM key_quota WHERE key_hash = ?",
+            (key_hash,)
+        ).fetchone()
+        if row is None:
+            return {
+                'tokens': float(rpm_limit),
+                'refill_time': now,
+                'requests_today': 0,
+                'daily_reset_time': now,
+                'disabled_until': 0.0
+            }
+        
+        state = {
+            'tokens': row[0],
+            'refill_time': row[1],
+            'requests_today': row[2],
+            'daily_reset_time': row[3],
+            'disabled_until': row[4]
+        }
+        elapsed = now - state['refill_time']
+        if elapsed > 0:
+            state['tokens'] = min(float(rpm_limit), state['tokens'] + elapsed * rpm_limit / 60.0)
+            state['refill_time'] = now
+        if now - state['daily_reset_time'] >= 24 * 60 * 60:
+            state['requests_today'] = 0
+            state['daily_reset_time'] = now
+        return state
+    
+    def _write(self, key_hash: str, state: Dict[str, float], now: float) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO key_quota "
+            "(key_hash, tokens, refill_time, requests_today, daily_reset_time, disabled_until, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key_hash, state['tokens'], state['refill_time'], state['requests_today'],
+             state['daily_reset_time'], state['disabled_until'], now)
+        )
+    
+    def load(self, key_hashes: List[str], rpm_limit: int) -> Dict[str, Dict[str, float]]:
+        now = time.time()
+        with self.lock:
+            return {key_hash: self._read(key_hash, rpm_limit, now) for key_hash in key_hashes}
+    
+    def reserve(self, key_hash: str, rpm_limit: int, daily_limit: int, now: float) -> tuple:
+        # Takes one request from the shared bucket if this key has capacity. Returns (granted, state)
+        # where state is the key's up-to-date usage as seen by every process.
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                state = self._read(key_hash, rpm_limit, now)
+                granted = (
+                    state['disabled_until'] <= now and
+                    state['tokens'] >= 1 and
+                    state['requests_today'] < daily_limit
+                )
+                if granted:
+                    state['tokens'] -= 1
+                    state['requests_today'] += 1
+                    self._write(key_hash, state, now)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            return granted, state
+    
+    def update(self, key_hash: str, rpm_limit: int, tokens: Optional[float] = None, disabled_until: Optional[float] = None) -> None:
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                state = self._read(key_hash, rpm_limit, now)
+                if tokens is not None:
+                    state['tokens'] = min(state['tokens'], tokens)
+                if disabled_until is not None:
+                    state['disabled_until'] = max(state['disabled_until'], disabled_until)
+                self._write(key_hash, state, now)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+    
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+class KeyManager:
+    def __init__(
+        self,
+        api_keys: List[str],
+        rpm_limit: int = 9,
+        daily_limit: int = 1450,
+        min_interval: float = 0.1,
+        ledger: Optional[QuotaLedger] = None,
+        breaker_cooldown: float = 30.0,
+        probe_timeout: float = 60.0,
+        health_alpha: float = 0.2,
+        tpm_limit: Optional[int] = None
+    ):
+        self.rpm_limit = rpm_limit
+        self.daily_limit = daily_limit
+        self.min_interval = min_interval
+        self.refill_rate = rpm_limit / 60.0
+        # Tokens per minute: a second bucket per key. A key is only offered once its bucket holds
+        # a typical request's worth of tokens; each request is then charged its own estimate,
+        # corrected to the real usage when the response arrives.
+        self.tpm_limit = tpm_limit
+        self.tpm_rate = tpm_limit / 60.0 if tpm_limit else 0.0
+        self.request_tokens = 0.0
+        # Circuit breaker: a failing key is opened for breaker_cooldown, doubling for every failed
+        # probe up to cooldown_seconds, then lets one probe request through before closing again.
+        self.breaker_cooldown = breaker_cooldown
+        self.cooldown_seconds = 5 * 60
+        self.probe_timeout = probe_timeout
+        self.health_alpha = health_alpha
+        self.ledger = ledger
+        self.keys = []
+        self.key_index: Dict[str, Dict[str, Any]] = {}
+        self.lock = TimedLock("KeyManager.lock")
+        
+        # Keys that can be handed out right now, plus a heap of (next_available, seq, version, key_data)
+        # for keys waiting on their RPM bucket, daily window or cool-down. Stale heap entries are
+        # skipped by comparing versions, so rescheduling a key never needs a linear search.
+        self._ready: List[Dict[str, Any]] = []
+        self._heap: List[tuple] = []
+        self._seq = itertools.count()
+        self._waiters: deque = deque()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_due = 0.0
+        
+        now = time.time()
+        for key in api_keys:
+            key = key.strip()
+            if key and key not in self.key_index:  # Skip empty lines and duplicates
+                key_data = {
+                    'key': key,
+                    'tokens': float(rpm_limit),
+                    'tpm_tokens': float(tpm_limit or 0),
+                    'tokens_used': 0,
+                    'refill_time': now,
+                    'requests_today': 0,
+                    'last_request_time': 0,
+                    'daily_reset_time': now,
+                    'is_available': True,
+                    'disabled_until': 0,
+                    'consecutive_errors': 0,
+                    'latency_ewma': None,
+                    'error_rate': 0.0,
+                    'circuit': 'closed',
+                    'trips': 0,
+                    'probe_started': 0.0,
+                    'ledger_key': QuotaLedger.key_hash(key) if ledger is not None else None,
+                    'version': 0,
+                    'ready_index': -1
+                }
+                self.keys.append(key_data)
+                self.key_index[key] = key_data
+        
+        # Start from the usage other runs and processes have already recorded for these keys
+        if ledger is not None:
+            try:
+                states = ledger.load([k['ledger_key'] for k in self.keys], rpm_limit)
+                for key_data in self.keys:
+                    self._apply_ledger_state(key_data, states[key_data['ledger_key']])
+            except Exception as e:
+                logger.error(f"Error loading quota ledger {ledger.path}: {e}")
+        
+        for key_data in self.keys:
+            self._reschedule(key_data, now)
+        
+        logger.info(f"Initialized {len(self.keys)} API keys")
+    
+    def _apply_ledger_state(self, key_data: Dict[str, Any], state: Dict[str, float]) -> None:
+        key_data['tokens'] = state['tokens']
+        key_data['refill_time'] = state['refill_time']
+        key_data['requests_today'] = state['requests_today']
+        key_data['daily_reset_time'] = state['daily_reset_time']
+        if state['disabled_until'] > max(time.time(), key_data['disabled_until']):
+            key_data['disabled_until'] = state['disabled_until']
+            key_data['is_available'] = False
+    
+    def _add_ready(self, key_data: Dict[str, Any]) -> None:
+        if key_data['ready_index'] < 0:
+            key_data['ready_index'] = len(self._ready)
+            self._ready.append(key_data)
+    
+    def _remove_ready(self, key_data: Dict[str, Any]) -> None:
+        index = key_data['ready_index']
+        if index >= 0:
+            last = self._ready.pop()
+            if last is not key_data:
+                self._ready[index] = last
+                last['ready_index'] = index
+            key_data['ready_index'] = -1
+    
+    def _refill(self, key_data: Dict[str, Any], now: float) -> None:
+        elapsed = now - key_data['refill_time']
+        if elapsed > 0:
+            key_data['tokens'] = min(float(self.rpm_limit), key_data['tokens'] + elapsed * self.refill_rate)
+            if self.tpm_limit:
+                key_data['tpm_tokens'] = min(float(self.tpm_limit), key_data['tpm_tokens'] + elapsed * self.tpm_rate)
+            key_data['refill_time'] = now
+        
+        if now - key_data['daily_reset_time'] >= 24 * 60 * 60:
+            key_data['requests_today'] = 0
+            key_data['daily_reset_time'] = now
+        
+        if not key_data['is_available'] and now >= key_data['disabled_until']:
+            key_data['is_available'] = True
+            key_data['consecutive_errors'] = 0
+            if key_data['circuit'] == 'open':
+                key_data['circuit'] = 'half_open'
+                logger.info("Circuit half-open for API key %s..., sending a probe request", key_data['key'][:8], extra={"event": "circuit"})
+            else:
+                logger.info(f"Re-enabled API key after cool-down: {key_data['key'][:8]}...")
+    
+    def _next_available(self, key_data: Dict[str, Any], now: float) -> float:
+        if key_data['requests_today'] >= self.daily_limit:
+            return key_data['daily_reset_time'] + 24 * 60 * 60
+        
+        next_time = max(now, key_data['last_request_time'] + self.min_interval)
+        if not key_data['is_available']:
+            next_time = max(next_time, key_data['disabled_until'])
+        if key_data['circuit'] == 'half_open' and key_data['probe_started']:
+            # One probe at a time; a probe that never reports back is replaced after probe_timeout
+            next_time = max(next_time, key_data['probe_started'] + self.probe_timeout)
+        if key_data['tokens'] < 1:
+            next_time = max(next_time, key_data['refill_time'] + (1 - key_data['tokens']) / self.refill_rate)
+        if self.tpm_limit:
+            needed = min(self.request_tokens, float(self.tpm_limit))
+            if key_data['tpm_tokens'] < needed:
+                next_time = max(next_time, key_data['refill_time'] + (needed - key_data['tpm_tokens']) / self.tpm_rate)
+        return next_time
+    
+    def _reschedule(self, key_data: Dict[str, Any], now: float) -> None:
+        self._refill(key_data, now)
+        next_time = self._next_available(key_data, now)
+        key_data['version'] += 1
+        
+        if next_time <= now:
+            self._add_ready(key_data)
+        else:
+            self._remove_ready(key_data)
+            heapq.heappush(self._heap, (next_time, next(self._seq), key_data['version'], key_data))
+    
+    def _promote(self, now: float) -> None:
+        while self._heap and self._heap[0][0] <= now:
+            _, _, version, key_data = heapq.heappop(self._heap)
+            if version == key_data['version']:
+                self._reschedule(key_data, now)
+    
+    def _next_wakeup(self) -> Optional[float]:
+        while self._heap and self._heap[0][2] != self._heap[0][3]['version']:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+    
+    def _health_score(self, key_data: Dict[str, Any]) -> float:
+        # Lower is better. Keys without a latency sample yet score best so they get tried.
+        latency = key_data['latency_ewma'] or 0.0
+        return latency * (1 + 4 * key_data['error_rate']) + key_data['error_rate']
+    
+    def _choose_ready(self, exclude: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        # Power of two choices: compare two random ready keys and take the healthier one. Slow
+        # or flaky keys get little traffic without every request piling onto the single best key.
+        candidates = self._ready if exclude is None else [k for k in self._ready if k['key'] != exclude]
+        if len(candidates) <= 1:
+            return candidates[0] if candidates else None
+        first, second = random.sample(candidates, 2)
+        for key_data in (first, second):
+            if key_data['circuit'] == 'half_open':
+                return key_data
+        return first if self._health_score(first) <= self._health_score(second) else second
+    
+    def _take_ready(self, now: float, exclude: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        while True:
+            self._promote(now)
+            key_data = self._choose_ready(exclude)
+            if key_data is None:
+                return None
+            
+            self._refill(key_data, now)
+            
+            if self._reserve_in_ledger(key_data, now):
+                key_data['last_request_time'] = now
+                if key_data['circuit'] == 'half_open':
+                    key_data['probe_started'] = now
+                self._reschedule(key_data, now)
+                return key_data
+            
+            # Another process used this key's capacity; requeue it at the time the ledger allows
+            self._reschedule(key_data, now)
+    
+    def _reserve_in_ledger(self, key_data: Dict[str, Any], now: float) -> bool:
+        if self.ledger is not None:
+            try:
+                granted, state = self.ledger.reserve(key_data['ledger_key'], self.rpm_limit, self.daily_limit, now)
+                self._apply_ledger_state(key_data, state)
+                return granted
+            except Exception as e:
+                logger.error(f"Error updating quota ledger, using local counts: {e}")
+        
+        key_data['tokens'] -= 1
+        key_data['requests_today'] += 1
+        return True
+    
+    def _update_ledger(self, key_data: Dict[str, Any], tokens: Optional[float] = None, disabled_until: Optional[float] = None) -> None:
+        if self.ledger is not None:
+            try:
+                self.ledger.update(key_data['ledger_key'], self.rpm_limit, tokens=tokens, disabled_until=disabled_until)
+            except Exception as e:
+                logger.error(f"Error updating quota ledger: {e}")
+    
+    def get_next_key(self) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            return self._take_ready(time.time())
+    
+    def try_acquire_key(self, exclude: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        # Never waits: a key only if one is free now and no caller is already queued for one
+        with self.lock:
+            if self._loop is asyncio.get_running_loop():
+                while self._waiters and self._waiters[0].done():
+                    self._waiters.popleft()
+                if self._waiters:
+                    return None
+            return self._take_ready(time.time(), exclude)
+    
+    async def acquire_key(self, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        loop = asyncio.get_running_loop()
+        
+        with self.lock:
+            if self._loop is not loop:
+                self._loop = loop
+                self._waiters = deque()
+                self._timer = None
+            
+            while self._waiters and self._waiters[0].done():
+                self._waiters.popleft()
+            
+            if not self._waiters:
+                key_data = self._take_ready(time.time())
+                if key_data or not self.keys:
+                    return key_data
+            
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            self._arm_timer()
+        
+        try:
+            return await asyncio.wait_for(waiter, timeout=timeout)
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                return waiter.result()
+            return None
+    
+    def _arm_timer(self) -> None:
+        # A single loop timer fires at the exact moment the earliest key frees up and hands
+        # keys to waiters in FIFO order, so waiting callers never poll or sleep blindly.
+        wakeup = time.time() if self._ready else self._next_wakeup()
+        if wakeup is None or self._loop is None:
+            return
+        if self._timer is not None:
+            if self._timer_due <= wakeup:
+                return
+            self._timer.cancel()
+        self._timer_due = wakeup
+        self._timer = self._loop.call_later(max(0.0, wakeup - time.time()), self._dispatch_waiters)
+    
+    def _dispatch_waiters(self) -> None:
+        with self.lock:
+            self._timer = None
+            now = time.time()
+            while self._waiters:
+                if self._waiters[0].done():
+                    self._waiters.popleft()
+                    continue
+                key_data = self._take_ready(now)
+                if not key_data:
+                    break
+                self._waiters.popleft().set_result(key_data)
+            
+            if self._waiters:
+                self._arm_timer()
+    
+    def _trip(self, key_data: Dict[str, Any], now: float, reason: str) -> None:
+        key_data['trips'] += 1
+        cooldown = min(self.cooldown_seconds, self.breaker_cooldown * (2 ** (key_data['trips'] - 1)))
+        key_data['circuit'] = 'open'
+        key_data['probe_started'] = 0.0
+        key_data['is_available'] = False
+        key_data['disabled_until'] = max(key_data['disabled_until'], now + cooldown)
+        self._update_ledger(key_data, disabled_until=key_data['disabled_until'])
+        self._reschedule(key_data, now)
+        logger.warning("Circuit open for API key %s... for %.0fs (%s)", key_data['key'][:8], cooldown, reason, extra={"event": "circuit"})
+    
+    def mark_error(self, key: str) -> None:
+        with self.lock:
+            key_data = self.key_index.get(key)
+            if key_data is None:
+                return
+            
+            key_data['consecutive_errors'] += 1
+            key_data['error_rate'] += self.health_alpha * (1 - key_data['error_rate'])
+            if key_data['circuit'] == 'half_open':
+                self._trip(key_data, time.time(), "probe request failed")
+            elif key_data['consecutive_errors'] >= 3 and key_data['circuit'] == 'closed':
+                self._trip(key_data, time.time(), f"{key_data['consecutive_errors']} consecutive errors")
+    
+    def mark_rate_limited(self, key: str, retry_after: Optional[float] = None) -> None:
+        with self.lock:
+            key_data = self.key_index.get(key)
+            if key_data is None:
+                return
+            
+            # The server says this key is over its limit: drain its bucket so it is only
+            # offered again once a full token has been refilled, or not before its Retry-After.
+            now = time.time()
+            self._refill(key_data, now)
+            key_data['tokens'] = min(key_data['tokens'], 0.0)
+            if self.tpm_limit:
+                key_data['tpm_tokens'] = min(key_data['tpm_tokens'], 0.0)
+            # A rate-limited probe says nothing about the key's health; probe again once it refills
+            key_data['probe_started'] = 0.0
+            if retry_after and now + retry_after > key_data['disabled_until']:
+                key_data['is_available'] = False
+                key_data['disabled_until'] = now + retry_after
+                self._update_ledger(key_data, tokens=0.0, disabled_until=key_data['disabled_until'])
+            else:
+                self._update_ledger(key_data, tokens=0.0)
+            self._reschedule(key_data, now)
+            if self._waiters:
+                self._arm_timer()
+    
+    def charge_tokens(self, key: str, tokens: float, request: bool = False) -> None:
+        # request=True for the up-front estimate of a new request, which also tracks the typical
+        # request size used for admission; corrections and refunds pass request=False.
+        with self.lock:
+            key_data = self.key_index.get(key)
+            if key_data is None:
+                return
+            
+            key_data['tokens_used'] += tokens
+            if request:
+                self.request_tokens = tokens if not self.request_tokens else self.request_tokens + 0.1 * (tokens - self.request_tokens)
+            if self.tpm_limit:
+                now = time.time()
+                self._refill(key_data, now)
+                key_data['tpm_tokens'] = min(float(self.tpm_limit), key_data['tpm_tokens'] - tokens)
+                self._reschedule(key_data, now)
+                if self._waiters:
+                    self._arm_timer()
+    
+    def mark_success(self, key: str, latency: Optional[float] = None) -> None:
+        with self.lock:
+            key_data = self.key_index.get(key)
+            if key_data is None:
+                return
+            
+            key_data['consecutive_errors'] = 0
+            key_data['error_rate'] -= self.health_alpha * key_data['error_rate']
+            if latency is not None:
+                previous = key_data['latency_ewma']
+                key_data['latency_ewma'] = latency if previous is None else previous + self.health_alpha * (latency - previous)
+            if key_data['circuit'] == 'half_open':
+                key_data['circuit'] = 'closed'
+                key_data['trips'] = 0
+                key_data['probe_started'] = 0.0
+                self._reschedule(key_data, time.time())
+                if self._waiters:
+                    self._arm_timer()
+                logger.info("Circuit closed for API key %s... after a successful probe", key[:8], extra={"event": "circuit"})
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            total_requests = sum(k['requests_today'] for k in self.keys)
+            available_keys = sum(1 for k in self.keys if k['is_available'])
+            
+            return {
+                'total_keys': len(self.keys),
+                'available_keys': available_keys,
+                'ready_keys': len(self._ready),
+                'tpm_limit': self.tpm_limit,
+                'typical_request_tokens': int(self.request_tokens),
+                'open_circuits': sum(1 for k in self.keys if k['circuit'] == 'open'),
+                'half_open_circuits': sum(1 for k in self.keys if k['circuit'] == 'half_open'),
+                'waiting_callers': len(self._waiters),
+                'total_requests_today': total_requests,
+                'estimated_remaining_capacity': (len(self.keys) * self.daily_limit) - total_requests
+            }
+    
+    def get_key_stats(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            now = time.time()
+            return [
+                {
+                    'key': k['key'],
+                    'tokens': min(float(self.rpm_limit), k['tokens'] + max(0.0, now - k['refill_time']) * self.refill_rate),
+                    'tpm_tokens': min(float(self.tpm_limit), k['tpm_tokens'] + max(0.0, now - k['refill_time']) * self.tpm_rate) if self.tpm_limit else None,
+                    'tokens_used': k['tokens_used'],
+                    'requests_today': k['requests_today'],
+                    'remaining_today': max(0, self.daily_limit - k['requests_today']),
+                    'available': k['is_available'] or now >= k['disabled_until'],
+                    'ready': k['ready_index'] >= 0,
+                    'circuit': k['circuit'],
+                    'latency_ewma': round(k['latency_ewma'], 3) if k['latency_ewma'] is not None else None,
+                    'error_rate': round(k['error_rate'], 3)
+                }
+                for k in self.keys
+            ]
+
+
+class ConcurrencyLimiter:
+    def __init__(
+        self,
+        initial_limit: int,
+        min_limit: int = 1,
+        max_limit: Optional[int] = None,
+        adaptive: bool = False,
+        latency_spike_factor: float = 2.5
+    ):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit if max_limit is not None else initial_limit)
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.adaptive = adaptive
+        self.latency_spike_factor = latency_spike_factor
+        self.in_flight = 0
+        self.latency_ewma: Optional[float] = None
+        self.latency_samples = 0
+        self.increases = 0
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._waiters: deque = deque()
+        # Retries that have come due are let in ahead of new work
+        self._priority_waiters: deque = deque()
+    
+    def try_acquire(self, priority: bool = False) -> bool:
+        if (priority or not self._waiters) and not self._priority_waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return True
+        return False
+    
+    async def acquire(self, priority: bool = False) -> None:
+        if self.try_acquire(priority):
+            return
+        
+        waiter = asyncio.get_running_loop().create_future()
+        (self._priority_waiters if priority else self._waiters).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+    
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._wake()
+    
+    def _wake(self) -> None:
+        for waiters in (self._priority_waiters, self._waiters):
+            while waiters and self.in_flight < int(self.limit):
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    self.in_flight += 1
+                    waiter.set_result(None)
+    
+    def on_success(self, latency: float) -> None:
+        if not self.adaptive:
+            return
+        
+        spike = (
+            self.latency_ewma is not None and self.latency_samples >= 10 and
+            latency > self.latency_spike_factor * self.latency_ewma
+        )
+        self.latency_ewma = latency if self.latency_ewma is None else 0.9 * self.latency_ewma + 0.1 * latency
+        self.latency_samples += 1
+        
+        if spike:
+            self._decrease("latency spike")
+        elif self.limit < self.max_limit:
+            # Additive increase: about +1 for every `limit` successful requests
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self.increases += 1
+            self._wake()
+    
+    def on_rate_limited(self) -> None:
+        if self.adaptive:
+            self._decrease("429 response")
+    
+    def _decrease(self, reason: str) -> None:
+        # Multiplicative decrease, at most once per typical round trip so a burst of 429s
+        # from requests that were already in flight only halves the limit once.
+        now = time.time()
+        if now - self._last_decrease < max(1.0, self.latency_ewma or 0.0):
+            return
+        
+        self._last_decrease = now
+        previous = int(self.limit)
+        self.limit = max(float(self.min_limit), self.limit / 2)
+        self.decreases += 1
+        logger.info(f"Concurrency limit lowered from {previous} to {int(self.limit)} ({reason})")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'limit': int(self.limit),
+            'adaptive': self.adaptive,
+            'min_limit': self.min_limit,
+            'max_limit': self.max_limit,
+            'in_flight': self.in_flight,
+            'latency_ewma': round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+            'increases': self.increases,
+            'decreases': self.decreases
+        }
+
+
+class RetryDeferred(Exception):
+    # Raised instead of sleeping when a request should be tried again later; the caller parks
+    # the question in the retry queue and its concurrency slot goes to the next question.
+    def __init__(self, error: str, delay: float, attempts: int):
+        super().__init__(error)
+        self.error = error
+        self.delay = delay
+        self.attempts = attempts
+
+
+class RetryQueue:
+    def __init__(self, base_delay: float = 2.0, max_delay: float = 30.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.waiting = 0
+        self.scheduled_total = 0
+        self.retry_after_total = 0
+        
+        # Heap of (due, seq, future) served by a single loop timer, the same way KeyManager
+        # hands out keys, so parked retries cost nothing until they come due.
+        self._heap: List[tuple] = []
+        self._seq = itertools.count()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_due = 0.0
+        self._room_waiters: deque = deque()
+    
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        # Exponential backoff with equal jitter, so retries from a burst of failures spread out
+        # instead of coming back together. A server-supplied Retry-After wins when it is given.
+        if retry_after is not None:
+            self.retry_after_total += 1
+            return retry_after + random.uniform(0, min(1.0, self.base_delay))
+        delay = min(self.max_delay, self.base_delay * (2 ** max(0, attempt - 1)))
+        return delay / 2 + random.uniform(0, delay / 2)
+    
+    async def wait(self, delay: float) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._heap = []
+            self._timer = None
+            self._room_waiters = deque()
+        
+        due = time.time() + delay
+        waiter = loop.create_future()
+        heapq.heappush(self._heap, (due, next(self._seq), waiter))
+        self.waiting += 1
+        self.scheduled_total += 1
+        self._arm_timer()
+        try:
+            await waiter
+        finally:
+            self.waiting -= 1
+            self._wake_room()
+    
+    async def wait_for_room(self, limit: int) -> None:
+        # Backpressure for the dispatcher: new questions wait while too many retries are parked
+        while self.waiting >= limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._room_waiters.append(waiter)
+            await waiter
+    
+    def _wake_room(self) -> None:
+        while self._room_waiters:
+            waiter = self._room_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+    
+    def _arm_timer(self) -> None:
+        while self._heap and self._heap[0][2].done():
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return
+        due = self._heap[0][0]
+        if self._timer is not None:
+            if self._timer_due <= due:
+                return
+            self._timer.cancel()
+        self._timer_due = due
+        self._timer = self._loop.call_later(max(0.0, due - time.time()), self._fire)
+    
+    def _fire(self) -> None:
+        self._timer = None
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, waiter = heapq.heappop(self._heap)
+            if not waiter.done():
+                waiter.set_result(None)
+        self._arm_timer()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        next_due = min((due for due, _, waiter in self._heap if not waiter.done()), default=None)
+        return {
+            'waiting': self.waiting,
+            'scheduled_total': self.scheduled_total,
+            'retry_after_total': self.retry_after_total,
+            'next_due_in': round(max(0.0, next_due - time.time()), 3) if next_due is not None else None
+        }
+
+
+class TokenEstimator:
+    def __init__(self, chars_per_token: float = 4.0, output_tokens: float = 1024, alpha: float = 0.1):
+        # Characters per prompt token and output tokens per answer, both calibrated from the
+        # usageMetadata of real responses; the defaults only hold until the first few arrive.
+        self.chars_per_token = chars_per_token
+        self.output_tokens = float(output_tokens)
+        self.alpha = alpha
+        self.samples = 0
+    
+    def request_tokens(self, prompt_chars: int, items: int = 1) -> int:
+        return int(prompt_chars / self.chars_per_token + 0.5) + int(self.output_tokens * items + 0.5)
+    
+    def observe(self, prompt_chars: int, items: int, usage: Dict[str, Any]) -> None:
+        prompt_tokens = usage.get("promptTokenCount") or 0
+        output_tokens = (usage.get("totalTokenCount") or 0) - prompt_tokens
+        if output_tokens <= 0:
+            output_tokens = usage.get("candidatesTokenCount") or 0
+        # Converge fast at first, then follow slowly
+        alpha = max(self.alpha, 1.0 / (self.samples + 1))
+        if prompt_tokens > 0 and prompt_chars > 0:
+            self.chars_per_token += alpha * (prompt_chars / prompt_tokens - self.chars_per_token)
+        if output_tokens > 0:
+            self.output_tokens += alpha * (output_tokens / max(1, items) - self.output_tokens)
+        self.samples += 1
+
+
+class Metrics:
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+    
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS, window: int = 60):
+        self.buckets = list(buckets)
+        self.window = window
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stage_histograms: Dict[str, Dict[str, Any]] = {}
+        self.key_histograms: Dict[str, Dict[str, Any]] = {}
+        self.key_counters: Dict[str, Dict[str, int]] = {}
+        # (second, completions) pairs covering the last `window` seconds, for a live rate
+        self.completions: deque = deque()
+        self.labels: Dict[str, str] = {}
+    
+    def key_label(self, key: str) -> str:
+        # Keys are never exported in full, only in the truncated form the logs already use
+        label = self.labels.get(key)
+        if label is None:
+            label = f"{key[:8]}...{key[-4:]}"
+            self.labels[key] = label
+        return label
+    
+    def _observe(self, histograms: Dict[str, Dict[str, Any]], name: str, seconds: float) -> None:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            histograms[name] = histogram
+        histogram['counts'][bisect.bisect_left(self.buckets, seconds)] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+    
+    def observe_stage(self, stage: str, seconds: float) -> None:
+        with self.lock:
+            self._observe(self.stage_histograms, stage, seconds)
+    
+    def observe_request(self, key: str, outcome: str, seconds: float) -> None:
+        # outcome is "ok", "error" or "rate_limited"
+        with self.lock:
+            label = self.key_label(key)
+            counters = self.key_counters.get(label)
+            if counters is None:
+                counters = {'ok': 0, 'error': 0, 'rate_limited': 0}
+                self.key_counters[label] = counters
+            counters[outcome] += 1
+            self._observe(self.key_histograms, label, seconds)
+    
+    def record_completions(self, count: int = 1) -> None:
+        now = int(time.time())
+        with self.lock:
+            if self.completions and self.completions[-1][0] == now:
+                self.completions[-1][1] += count
+            else:
+                self.completions.append([now, count])
+            while self.completions and self.completions[0][0] <= now - self.window:
+                self.completions.popleft()
+    
+    def recent_rate(self) -> float:
+        now = time.time()
+        with self.lock:
+            recent = sum(count for second, count in self.completions if second > now - self.window)
+        return recent / min(self.window, max(1.0, now - self.started))
+    
+    def quantile(self, histogram: Dict[str, Any], q: float) -> Optional[float]:
+        # Linear interpolation inside the bucket holding the q-th observation, as Prometheus does
+        if not histogram['count']:
+            return None
+        rank = q * histogram['count']
+        cumulative = 0
+        for i, count in enumerate(histogram['counts']):
+            if cumulative + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+    
+    def summarize(self, histogram: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'count': histogram['count'],
+            'mean': histogram['sum'] / histogram['count'] if histogram['count'] else None,
+            'p50': self.quantile(histogram, 0.5),
+            'p95': self.quantile(histogram, 0.95),
+            'p99': self.quantile(histogram, 0.99),
+            'total_seconds': histogram['sum']
+        }
+    
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            stages = {name: {'counts': list(h['counts']), 'sum': h['sum'], 'count': h['count']} for name, h in self.stage_histograms.items()}
+            keys = {label: {'counts': list(h['counts']), 'sum': h['sum'], 'count': h['count']} for label, h in self.key_histograms.items()}
+            counters = {label: dict(c) for label, c in self.key_counters.items()}
+        return {'stages': stages, 'keys': keys, 'key_counters': counters}
+
+
+def retry_after_seconds(response: Optional[httpx.Response]) -> Optional[float]:
+    # Retry-After header (seconds or an HTTP date), else the RetryInfo detail Gemini puts in 429 bodies
+    if response is None:
+        return None
+    value = response.headers.get("retry-after")
+    try:
+        if value:
+            if value.strip().isdigit():
+                return float(value)
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        for detail in response.json().get("error", {}).get("details", []):
+            delay = detail.get("retryDelay") if isinstance(detail, dict) else None
+            if isinstance(delay, str) and delay.endswith("s"):
+                return float(delay[:-1])
+    except Exception:
+        pass
+    return None
+
+
+def http_error_message(prefix: str, status_code: Optional[int], response: Optional[httpx.Response]) -> str:
+    retry_after = retry_after_seconds(response)
+    if retry_after is not None:
+        return f"ERROR: {prefix}HTTP error {status_code} (retry after {retry_after:.1f}s)"
+    return f"ERROR: {prefix}HTTP error {status_code}"
+
+
+class GeminiBackend:
+    name = "gemini"
+    
+    def __init__(self, api_url: str = GEMINI_API_URL):
+        self.api_url = api_url
+    
+    def request_url(self, api_key: str, stream: bool = False) -> str:
+        if stream:
+            return f"{self.api_url.replace(':generateContent', ':streamGenerateContent')}?alt=sse&key={api_key}"
+        return f"{self.api_url}?key={api_key}"
+    
+    def build_request(self, system_prompt: str, prompt: str, generation_config: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        data: Dict[str, Any] = {
+            "contents": {
+                "parts": [
+                    {
+                        "text": prompt,
+                    },
+                ],
+            },
+            "system_instruction": {
+                "parts": [
+                    {
+                        "text": system_prompt,
+                    },
+                ],
+            },
+        }
+        if generation_config:
+            data["generationConfig"] = generation_config
+        return data
+    
+    @staticmethod
+    def response_text(response_data: Dict[str, Any]) -> Optional[str]:
+        if response_data.get("candidates") and response_data["candidates"][0].get("content") and response_data["candidates"][0]["content"].get("parts"):
+            return response_data["candidates"][0]["content"]["parts"][0]["text"]
+        return None
+    
+    @staticmethod
+    def prompt_chars(data: Dict[str, Any]) -> int:
+        return sum(
+            len(part.get("text", ""))
+            for section in (data.get("system_instruction"), data.get("contents"))
+            for part in (section or {}).get("parts", [])
+        )
+    
+    @staticmethod
+    def finish_reason(response_data: Dict[str, Any]) -> Optional[str]:
+        # A prompt blocked outright comes back with a block reason and no candidates
+        block_reason = (response_data.get("promptFeedback") or {}).get("blockReason")
+        return block_reason or (response_data.get("candidates") or [{}])[0].get("finishReason")
+    
+    @staticmethod
+    def stream_event(event: Dict[str, Any]) -> tuple:
+        # (text, finish_reason) carried by one server-sent event
+        candidate = (event.get("candidates") or [{}])[0]
+        text = "".join(part.get("text", "") for part in (candidate.get("content") or {}).get("parts") or [])
+        return text, candidate.get("finishReason") or (event.get("promptFeedback") or {}).get("blockReason")
+
+
+class OpenAICompatibleBackend:
+    # Any server speaking the OpenAI chat completions API, e.g. llama.cpp's llama-server. Started
+    # with --parallel N it decodes N requests at once with continuous batching, so up to N
+    # requests are kept in flight, one per slot.
+    name = "local"
+    
+    def __init__(
+        self,
+        base_url: str = "http://127.0.0.1:8080",
+        model: str = "local",
+        slots: Optional[int] = None,
+        api_key: Optional[str] = None,
+        max_tokens: Optional[int] = None
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.api_key = api_key
+        self.max_tokens = max_tokens
+        self.slots = slots
+        self.limiter: Optional[ConcurrencyLimiter] = ConcurrencyLimiter(slots) if slots else None
+    
+    def request_url(self) -> str:
+        return f"{self.base_url}/v1/chat/completions"
+    
+    def headers(self) -> Dict[str, str]:
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+    
+    def build_request(self, system_prompt: str, prompt: str) -> Dict[str, Any]:
+        data: Dict[str, Any] = {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt},
+            ],
+            "stream": False,
+        }
+        if self.max_tokens:
+            data["max_tokens"] = self.max_tokens
+        return data
+    
+    @staticmethod
+    def response_text(response_data: Dict[str, Any]) -> Optional[str]:
+        choices = response_data.get("choices") or []
+        if choices and isinstance(choices[0].get("message"), dict):
+            return choices[0]["message"].get("content")
+        return None
+    
+    @staticmethod
+    def finish_reason(response_data: Dict[str, Any]) -> Optional[str]:
+        return (response_data.get("choices") or [{}])[0].get("finish_reason")
+    
+    async def detect_slots(self, client: httpx.AsyncClient) -> int:
+        # llama-server reports its --parallel setting as total_slots on /props
+        if self.limiter is None:
+            slots = 1
+            try:
+                response = await client.get(f"{self.base_url}/props", headers=self.headers(), timeout=10)
+                response.raise_for_status()
+                slots = int(response.json().get("total_slots") or 1)
+            except Exception as e:
+                logger.warning(f"Could not read the slot count from {self.base_url}/props, using 1 slot: {e}")
+            self.slots = slots
+            self.limiter = ConcurrencyLimiter(slots)
+        return self.slots
+
+
+def validate_response(text: str, finish_reason: Optional[str], rules: Dict[str, Any]) -> Optional[str]:
+    # Returns None for a usable answer, otherwise the reason code it was rejected for. Runs in the
+    # validation process pool, so it only takes and returns plain values.
+    if finish_reason in BLOCKED_FINISH_REASONS or (not text and finish_reason is None):
+        return "blocked"
+    if finish_reason in TRUNCATED_FINISH_REASONS:
+        return "truncated"
+    
+    stripped = text.strip()
+    if len(stripped) < rules.get("min_chars", 0):
+        return "too_short"
+    
+    min_ratio = rules.get("min_script_ratio", 0)
+    if min_ratio > 0:
+        telugu = len(TELUGU_PATTERN.findall(stripped))
+        letters = telugu + len(OTHER_LETTER_PATTERN.findall(stripped))
+        if letters == 0 or telugu / letters < min_ratio:
+            return "wrong_script"
+    
+    if rules.get("expect_json"):
+        try:
+            json.loads(CODE_FENCE_PATTERN.sub("", stripped))
+        except json.JSONDecodeError:
+            return "invalid_json"
+    return None
+
+
+def question_id(question: Any) -> int:
+    # Stable 64-bit ID: an explicit "id" field when the input provides one, otherwise a content hash
+    if isinstance(question, dict):
+        source = question.get("id")
+        if source is None:
+            source = question.get("question", "")
+    else:
+        source = question
+    digest = hashlib.blake2b(str(source).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def normalize_question(text: str) -> str:
+    # Case, compatibility forms, punctuation, spacing and the script digits are written in do not
+    # make a different question: "౧౨" becomes "12"
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = NUMBER_PATTERN.sub(lambda match: "".join(str(unicodedata.decimal(c)) for c in match.group()), text)
+    return " ".join(NORMALIZE_PATTERN.sub(" ", text).split())
+
+
+def minhash_signatures(texts: List[str]) -> List[bytes]:
+    # Runs in worker processes: a MinHash signature over character shingles of each normalized text,
+    # after a hash of the numbers in it. Shingles barely notice "1 hour" vs "5 hours", so questions
+    # with different numbers are never treated as duplicates.
+    signatures = []
+    for text in texts:
+        text = normalize_question(text)
+        shingles = {text[i:i + MINHASH_SHINGLE] for i in range(max(1, len(text) - MINHASH_SHINGLE + 1))}
+        hashes = [zlib.crc32(shingle.encode("utf-8")) for shingle in shingles]
+        signature = array('I', [zlib.crc32(" ".join(NUMBER_PATTERN.findall(text)).encode("ascii"))])
+        signature.extend(min((a * h + b) % MINHASH_PRIME for h in hashes) & 0xFFFFFFFF for a, b in MINHASH_PARAMS)
+        signatures.append(signature.tobytes())
+    return signatures
+
+
+class NearDuplicateIndex:
+    def __init__(self, threshold: float = 0.9):
+        # LSH over MINHASH_BANDS bands of the signature: questions sharing any band are candidates,
+        # and a candidate counts as a duplicate when its estimated Jaccard similarity reaches threshold.
+        # Only representatives are stored, so memory grows with distinct questions, not input size.
+        self.threshold = threshold
+        self.buckets: Dict[int, int] = {}
+        self.signatures: List[bytes] = []
+    
+    @staticmethod
+    def similarity(first: bytes, second: bytes) -> float:
+        if first[:4] != second[:4]:
+            return 0.0
+        return sum(a == b for a, b in zip(memoryview(first)[4:].cast('I'), memoryview(second)[4:].cast('I'))) / len(MINHASH_PARAMS)
+    
+    def add(self, signature: bytes) -> Optional[int]:
+        # Returns the number of the representative this signature duplicates, or None after
+        # registering it as a new representative
+        numbers, minhashes = signature[:4], signature[4:]
+        band_bytes = len(minhashes) // MINHASH_BANDS
+        keys = [hash(numbers + minhashes[band * band_bytes:(band + 1) * band_bytes]) + band for band in range(MINHASH_BANDS)]
+        best, best_score = None, self.threshold
+        for key in keys:
+            candidate = self.buckets.get(key)
+            if candidate is not None and candidate != best:
+                score = self.similarity(signature, self.signatures[candidate])
+                if score >= best_score:
+                    best, best_score = candidate, score
+        if best is not None:
+            return best
+        
+        self.signatures.append(signature)
+        for key in keys:
+            self.buckets.setdefault(key, len(self.signatures) - 1)
+        return None
+
+
+def find_near_duplicates(
+    questions: Iterable[Any],
+    threshold: float = 0.9,
+    workers: Optional[int] = None,
+    chunk_size: int = 2000
+) -> Dict[int, List[Any]]:
+    # Returns {representative question ID: [near-duplicate questions]} for clusters with more than one
+    # question; the first question of a cluster in input order represents it. Signatures are computed
+    # in a process pool a bounded number of chunks ahead, so the input is never held in memory.
+    index = NearDuplicateIndex(threshold)
+    representatives = array('Q')
+    clusters: Dict[int, List[Any]] = {}
+    workers = workers or os.cpu_count() or 1
+    
+    def assign(chunk: List[Any], signatures: List[bytes]) -> None:
+        for question, signature in zip(chunk, signatures):
+            qid = question_id(question)
+            number = index.add(signature)
+            if number is None:
+                representatives.append(qid)
+            elif representatives[number] != qid:
+                # Exact repeats of a question are already shared by the in-flight and cache lookups
+                clusters.setdefault(representatives[number], []).append(question)
+    
+    pending: deque = deque()
+    end = object()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        chunk: List[Any] = []
+        for question in itertools.chain(questions, [end]):
+            if question is not end:
+                chunk.append(question)
+                if len(chunk) < chunk_size:
+                    continue
+            if chunk:
+                pending.append((chunk, pool.submit(minhash_signatures, [question_text(q) for q in chunk])))
+                chunk = []
+            while pending and (len(pending) > 2 * workers or question is end):
+                done_chunk, future = pending.popleft()
+                assign(done_chunk, future.result())
+    return clusters
+
+
+class CheckpointLog:
+    def __init__(self, checkpoint_dir: str, name: str, snapshot_every: int = 10000):
+        self.wal_path = os.path.join(checkpoint_dir, f"{name}.wal")
+        self.snapshot_path = os.path.join(checkpoint_dir, f"{name}.snapshot")
+        self.snapshot_every = snapshot_every
+        self.lock = threading.Lock()
+        
+        # Completed work is a sorted array of 8-byte IDs (the snapshot) plus a set of IDs appended
+        # to the write-ahead log since the last compaction (the tail, 17 bytes per line on disk).
+        self._snapshot = array('Q')
+        self._tail: Set[int] = set()
+        self._file = None
+    
+    def load(self) -> "CheckpointLog":
+        with self.lock:
+            self._snapshot = array('Q')
+            self._tail = set()
+            
+            if os.path.exists(self.snapshot_path):
+                with open(self.snapshot_path, 'rb') as f:
+                    data = f.read()
+                self._snapshot.frombytes(data[:len(data) - len(data) % self._snapshot.itemsize])
+            
+            if os.path.exists(self.wal_path):
+                with open(self.wal_path, 'r', encoding='ascii', errors='ignore') as f:
+                    for line in f:
+                        line = line.strip()
+                        if len(line) == 16:
+                            try:
+                                self._tail.add(int(line, 16))
+                            except ValueError:
+                                pass
+            
+            logger.info(f"Loaded checkpoint: {len(self._snapshot)} IDs from snapshot, {len(self._tail)} from log tail")
+        return self
+    
+    def reset(self) -> None:
+        with self.lock:
+            self._close_file()
+            for path in (self.wal_path, self.snapshot_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._snapshot = array('Q')
+            self._tail = set()
+    
+    def __contains__(self, qid: int) -> bool:
+        if qid in self._tail:
+            return True
+        index = bisect.bisect_left(self._snapshot, qid)
+        return index < len(self._snapshot) and self._snapshot[index] == qid
+    
+    def __len__(self) -> int:
+        return len(self._snapshot) + len(self._tail)
+    
+    def append(self, ids: List[int]) -> None:
+        if not ids:
+            return
+        
+        with self.lock:
+            if self._file is None:
+                self._file = open(self.wal_path, 'a', encoding='ascii')
+            self._file.write("".join(f"{qid:016x}\n" for qid in ids))
+            self._file.flush()
+            self._tail.update(ids)
+            
+            # Compact once the tail is as big as the snapshot, so total compaction work stays linear
+            if len(self._tail) >= max(self.snapshot_every, len(self._snapshot)):
+                self._compact()
+    
+    def sync(self) -> None:
+        with self.lock:
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+    
+    def compact(self) -> None:
+        with self.lock:
+            if self._tail:
+                self._compact()
+    
+    def _compact(self) -> None:
+        merged = array('Q')
+        previous = None
+        for qid in heapq.merge(self._snapshot, sorted(self._tail)):
+            if qid != previous:
+                merged.append(qid)
+                previous = qid
+        
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            merged.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        
+        # Safe to truncate only after the snapshot is durable; a crash in between just leaves
+        # duplicate IDs in the log, which replay ignores.
+        self._close_file()
+        self._file = open(self.wal_path, 'w', encoding='ascii')
+        self._snapshot = merged
+        self._tail = set()
+        logger.info(f"Compacted checkpoint log into snapshot ({len(merged)} completed questions)")
+    
+    def _close_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+    
+    def close(self) -> None:
+        with self.lock:
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+            self._close_file()
+
+
+class ResultWriter:
+    def __init__(
+        self,
+        path: str,
+        append: bool = False,
+        checkpoint: Optional[CheckpointLog] = None,
+        flush_interval: float = 0.5,
+        fsync_interval: float = 5.0,
+        batch_size: int = 256,
+        metrics: Optional[Metrics] = None
+    ):
+        self.path = path
+        self.checkpoint = checkpoint
+        self.metrics = metrics
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+        self.written_count = 0
+        self.queue: queue.Queue = queue.Queue()
+        
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        
+        self._file = open(path, 'a' if append else 'w', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name="result-writer", daemon=True)
+        self._thread.start()
+    
+    def write(self, record: Dict[str, Any], qid: Optional[int] = None) -> None:
+        # Never blocks the caller: serialization, writes and fsync all happen on the writer thread.
+        self.queue.put((record, qid))
+    
+    def close(self) -> None:
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+    
+    def _run(self) -> None:
+        last_fsync = time.time()
+        closing = False
+        
+        while not closing:
+            batch = []
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+                if item is None:
+                    closing = True
+                else:
+                    batch.append(item)
+                
+                while not closing and len(batch) < self.batch_size:
+                    item = self.queue.get_nowait()
+                    if item is None:
+                        closing = True
+                    else:
+                        batch.append(item)
+            except queue.Empty:
+                pass
+            
+            try:
+                if batch:
+                    serialize_start = time.time()
+                    lines = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r, _ in batch)
+                    write_start = time.time()
+                    if self.metrics is not None:
+                        self.metrics.observe_stage("serialize", write_start - serialize_start)
+                    self._file.write(lines)
+                    self._file.flush()
+                    self.written_count += len(batch)
+                    
+                    # Checkpoint entries are only logged after their results reach the file,
+                    # so a resumed run never skips a question whose answer was lost.
+                    if self.checkpoint is not None:
+                        self.checkpoint.append([qid for _, qid in batch if qid is not None])
+                    if self.metrics is not None:
+                        self.metrics.observe_stage("persist", time.time() - write_start)
+                
+                if closing or (batch and time.time() - last_fsync >= self.fsync_interval):
+                    fsync_start = time.time()
+                    os.fsync(self._file.fileno())
+                    if self.checkpoint is not None:
+                        self.checkpoint.sync()
+                    last_fsync = time.time()
+                    if self.metrics is not None:
+                        self.metrics.observe_stage("fsync", last_fsync - fsync_start)
+            except Exception as e:
+                logger.error(f"Error writing results to {self.path}: {e}")
+        
+        self._file.close()
+
+
+def iter_jsonl(path: str):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final line from a crash mid-write; everything before it is intact
+                    logger.warning(f"Skipping unreadable line in {path}")
 
-shutdown_requested = False
-processing_lock = threading.Lock()
-QUESTION_PROMPT = ''' Before giving the output ,
-1- read through all the instructions i have given you , 
-2 - prepare a checklist of what you have to deliverand
- 3- make sure you are passing thorough all of them
 
-4-You won't need to write all the words in Telugu, You are free to use words which are English but written in Telugu(for example - సక్సెస్, ట్రస్ట్ like this) And make sure to keep the answer casual and very informational , use new telugu instrctions.
+def has_partial_records(jsonl_path: str) -> bool:
+    # Cheap text scan; a false positive only costs the full check in superseded_partials()
+    with open(jsonl_path, 'r', encoding='utf-8') as f:
+        return any('"partial": true' in line for line in f)
 
-5- Go through all the words you are going to use and context where you gonna use them , plan it all
-6- then decide the whole information you wat to write  - A 10 point plan of what information should output have and very information rich'''
+
+def superseded_partials(records: Iterable[Dict[str, Any]]) -> Set[int]:
+    # IDs of questions that have a complete answer, so partial answers saved by an
+    # interrupted stream can be dropped once a resumed run has finished them
+    return set(question_id(record) for record in records if not record.get("partial"))
+
+
+def iter_final_records(jsonl_path: str):
+    # Journal records minus partial answers that a resumed run has since completed
+    complete = superseded_partials(iter_jsonl(jsonl_path)) if has_partial_records(jsonl_path) else set()
+    for record in iter_jsonl(jsonl_path):
+        if complete and record.get("partial") and question_id(record) in complete:
+            continue
+        yield record
+
+
+def write_questions_json(records: Iterable[Dict[str, Any]], json_path: str) -> int:
+    # Streams records into the legacy {"questions": [...]} layout without loading them into memory
+    count = 0
+    tmp_path = f"{json_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as out:
+        out.write('{\n  "questions": [')
+        for record in records:
+            body = json.dumps(record, indent=2, ensure_ascii=False).replace("\n", "\n    ")
+            out.write(("," if count else "") + "\n    " + body)
+            count += 1
+        out.write("\n  ]\n}" if count else "]\n}")
+    os.replace(tmp_path, json_path)
+    return count
+
+
+def compact_jsonl_to_json(jsonl_path: str, json_path: str) -> int:
+    return write_questions_json(iter_final_records(jsonl_path), json_path)
+
+
+def store_codec(name: str, level: int = 3) -> tuple:
+    # (compress, decompress) for a result store's blocks; zlib stands in when zstandard is missing
+    if name == "zstd":
+        if not ZSTD_AVAILABLE:
+            raise RuntimeError("This result store is zstd-compressed; install the zstandard package to use it")
+        return zstandard.ZstdCompressor(level=level).compress, zstandard.ZstdDecompressor().decompress
+    if name == "zlib":
+        return lambda data: zlib.compress(data, 6), zlib.decompress
+    raise ValueError(f"Unknown result store codec: {name}")
+
+
+class ResultStoreWriter:
+    def __init__(self, path: str, shard_records: int = 500000, block_bytes: int = 256 * 1024, level: int = 3):
+        # A store is a directory of shards. Each shard holds JSONL records compressed in independent
+        # blocks of about block_bytes, plus an index of (question ID, block << 32 | offset in block)
+        # pairs sorted by ID, so one record costs a binary search and one block to decompress.
+        self.path = path
+        self.shard_records = shard_records
+        self.block_bytes = block_bytes
+        self.codec = "zstd" if ZSTD_AVAILABLE else "zlib"
+        self._compress = store_codec(self.codec, level)[0]
+        self.shards: List[Dict[str, Any]] = []
+        self.count = 0
+        
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._open_shard()
+    
+    def _open_shard(self) -> None:
+        self._name = f"shard-{len(self.shards):05d}"
+        self._file = open(os.path.join(self.path, f"{self._name}.jsonl.{self.codec}"), 'wb')
+        self._blocks = array('Q')
+        self._entries: List[tuple] = []
+        self._buffer: List[bytes] = []
+        self._buffered = 0
+    
+    def write(self, record: Dict[str, Any], qid: Optional[int] = None) -> None:
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        self._entries.append((question_id(record) if qid is None else qid, (len(self._blocks) // 2) << 32 | self._buffered))
+        self._buffer.append(line)
+        self._buffered += len(line)
+        self.count += 1
+        
+        if self._buffered >= self.block_bytes:
+            self._flush_block()
+        if len(self._entries) >= self.shard_records:
+            self._close_shard()
+            self._open_shard()
+    
+    def _flush_block(self) -> None:
+        if not self._buffer:
+            return
+        frame = self._compress(b"".join(self._buffer))
+        self._blocks.extend((self._file.tell(), len(frame)))
+        self._file.write(frame)
+        self._buffer = []
+        self._buffered = 0
+    
+    def _close_shard(self) -> None:
+        self._flush_block()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        
+        # Sorting by (ID, location) keeps a question written twice in write order, newest last
+        entries = array('Q', itertools.chain.from_iterable(sorted(self._entries)))
+        header = array('Q', (STORE_INDEX_MAGIC, len(self._blocks) // 2, len(self._entries)))
+        index_path = os.path.join(self.path, f"{self._name}.idx")
+        with open(f"{index_path}.tmp", 'wb') as f:
+            header.tofile(f)
+            self._blocks.tofile(f)
+            entries.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{index_path}.tmp", index_path)
+        self.shards.append({"name": self._name, "records": len(self._entries), "blocks": len(self._blocks) // 2})
+    
+    def close(self) -> None:
+        if self._entries or not self.shards:
+            self._close_shard()
+        else:
+            self._file.close()
+            os.remove(self._file.name)
         
+        manifest = {"format": 1, "codec": self.codec, "records": self.count, "shards": self.shards}
+        manifest_path = os.path.join(self.path, "store.json")
+        with open(f"{manifest_path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
 
 
-class KeyManager:
-    def __init__(self, api_keys: List[str], rpm_limit: int = 9, daily_limit: int = 1450):
-        self.rpm_limit = rpm_limit
-        self.daily_limit = daily_limit
-        self.keys = []
+class ResultStore:
+    def __init__(self, path: str, cache_blocks: int = 16):
+        # Shard files and indexes are memory-mapped, so opening a store of any size reads only its
+        # manifest, and the OS page cache decides what stays resident.
+        self.path = path
+        self.cache_blocks = cache_blocks
         self.lock = threading.Lock()
+        self._cache: OrderedDict = OrderedDict()
+        self.shards: List[Dict[str, Any]] = []
         
-        for key in api_keys:
-            key = key.strip()
-            if key:  # Skip empty lines
-                self.keys.append({
-                    'key': key,
-                    'requests_this_minute': 0,
-                    'requests_today': 0,
-                    'last_request_time': 0,
-                    'minute_reset_time': time.time(),
-                    'daily_reset_time': time.time(),
-                    'is_available': True,
-                    'consecutive_errors': 0
-                })
+        with open(os.path.join(path, "store.json"), 'r', encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        self._decompress = store_codec(self.manifest["codec"])[1]
         
-        logger.info(f"Initialized {len(self.keys)} API keys")
+        for shard in self.manifest["shards"]:
+            if not shard["records"]:
+                continue
+            maps = []
+            for name in (f"{shard['name']}.jsonl.{self.manifest['codec']}", f"{shard['name']}.idx"):
+                with open(os.path.join(path, name), 'rb') as f:
+                    maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            index = memoryview(maps[1]).cast('Q')
+            if index[0] != STORE_INDEX_MAGIC:
+                raise ValueError(f"Not a result store index: {shard['name']}.idx (written on a machine with different byte order?)")
+            block_count, entry_count = index[1], index[2]
+            entries = index[3 + 2 * block_count:3 + 2 * block_count + 2 * entry_count]
+            self.shards.append({
+                "name": shard["name"],
+                "data": maps[0],
+                "blocks": index[3:3 + 2 * block_count],
+                "ids": entries[0::2],
+                "locations": entries[1::2],
+                "maps": maps,
+                "views": [index]
+            })
     
-    def get_next_key(self) -> Optional[Dict[str, Any]]:
+    def __len__(self) -> int:
+        return self.manifest["records"]
+    
+    def __contains__(self, question: Any) -> bool:
+        return self.get(question) is not None
+    
+    def get(self, question: Any) -> Optional[Dict[str, Any]]:
+        # Accepts a question (text or object) or its "id"
+        return self.get_by_id(question_id(question))
+    
+    def get_by_id(self, qid: int) -> Optional[Dict[str, Any]]:
+        # Later shards were written later, so the newest record for a question wins
+        for shard in reversed(self.shards):
+            ids = shard["ids"]
+            i = bisect.bisect_right(ids, qid) - 1
+            if i >= 0 and ids[i] == qid:
+                location = shard["locations"][i]
+                block = self._block(shard, location >> 32)
+                start = location & 0xFFFFFFFF
+                return json.loads(block[start:block.index(b"\n", start)])
+        return None
+    
+    def _read_block(self, shard: Dict[str, Any], number: int) -> bytes:
+        offset, length = shard["blocks"][2 * number], shard["blocks"][2 * number + 1]
+        return self._decompress(shard["data"][offset:offset + length])
+    
+    def _block(self, shard: Dict[str, Any], number: int) -> bytes:
+        key = (shard["name"], number)
         with self.lock:
-            now = time.time()
-            
-            for key_data in self.keys:
-                if now - key_data['minute_reset_time'] >= 60:
-                    key_data['requests_this_minute'] = 0
-                    key_data['minute_reset_time'] = now
-                
-                if now - key_data['daily_reset_time'] >= 24 * 60 * 60:
-                    key_data['requests_today'] = 0
-                    key_data['daily_reset_time'] = now
-            
-            available_keys = [
-                k for k in self.keys 
-                if k['is_available'] and 
-                k['requests_this_minute'] < self.rpm_limit and
-                k['requests_today'] < self.daily_limit and
-                k['consecutive_errors'] < 3 and
-                (now - k['last_request_time']) >= 0.1
-            ]
-            
-            if not available_keys:
+            block = self._cache.get(key)
+            if block is not None:
+                self._cache.move_to_end(key)
+                return block
+        
+        block = self._read_block(shard, number)
+        with self.lock:
+            self._cache[key] = block
+            while len(self._cache) > self.cache_blocks:
+                self._cache.popitem(last=False)
+        return block
+    
+    def __iter__(self):
+        # Records in the order they were written, one decompressed block in memory at a time
+        for shard in self.shards:
+            for number in range(len(shard["blocks"]) // 2):
+                for line in self._read_block(shard, number).split(b"\n")[:-1]:
+                    yield json.loads(line)
+    
+    def export_json(self, json_path: str) -> int:
+        return write_questions_json(self, json_path)
+    
+    def close(self) -> None:
+        # The memoryviews pin the maps, so they are released first
+        for shard in self.shards:
+            for key in ("blocks", "ids", "locations"):
+                shard[key].release()
+            for view in shard["views"]:
+                view.release()
+            for m in shard["maps"]:
+                m.close()
+        self.shards = []
+        self._cache.clear()
+
+
+def build_result_store(jsonl_path: str, store_path: str, shard_records: int = 500000) -> int:
+    # Packs a results journal into a store next to the old one, then swaps it into place
+    tmp_path = f"{store_path}.tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    writer = ResultStoreWriter(tmp_path, shard_records=shard_records)
+    for record in iter_final_records(jsonl_path):
+        writer.write(record)
+    writer.close()
+    
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.replace(tmp_path, store_path)
+    return writer.count
+
+
+class ResponseCache:
+    def __init__(self, path: str, max_age: Optional[float] = None, max_bytes: Optional[int] = None, evict_every: int = 500):
+        self.path = path
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._puts_since_evict = 0
+        
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL, size INTEGER NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self.evict()
+    
+    @staticmethod
+    def make_key(*parts: str) -> str:
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(part.encode('utf-8'))
+            digest.update(b"\x00")
+        return digest.hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.max_age is not None and now - row[1] > self.max_age):
+                self.misses += 1
                 return None
             
-            key_data = random.choice(available_keys)
-            
-            key_data['requests_this_minute'] += 1
-            key_data['requests_today'] += 1
-            key_data['last_request_time'] = now
-            
-            return key_data
+            self.conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
     
-    def mark_error(self, key: str) -> None:
+    def put(self, key: str, response: str) -> None:
+        now = time.time()
         with self.lock:
-            for key_data in self.keys:
-                if key_data['key'] == key:
-                    key_data['consecutive_errors'] += 1
-                    
-                    if key_data['consecutive_errors'] >= 3:
-                        key_data['is_available'] = False
-                        
-                        def reenable_key():
-                            with self.lock:
-                                for k in self.keys:
-                                    if k['key'] == key:
-                                        k['is_available'] = True
-                                        k['consecutive_errors'] = 0
-                                        logger.info(f"Re-enabled API key after cool-down: {key[:8]}...")
-                        
-                        timer = threading.Timer(5 * 60, reenable_key)
-                        timer.daemon = True
-                        timer.start()
-                    break
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, accessed_at, size) VALUES (?, ?, ?, ?, ?)",
+                (key, response, now, now, len(response.encode('utf-8')))
+            )
+            self._puts_since_evict += 1
+            if self._puts_since_evict < self.evict_every:
+                return
+            self._puts_since_evict = 0
+        self.evict()
     
-    def mark_success(self, key: str) -> None:
-        with self.lock:
-            for key_data in self.keys:
-                if key_data['key'] == key:
-                    key_data['consecutive_errors'] = 0
-                    break
+    def evict(self) -> None:
+        try:
+            with self.lock:
+                if self.max_age is not None:
+                    self.conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age,))
+                
+                if self.max_bytes is not None:
+                    total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                    while total > self.max_bytes:
+                        # Drop least recently used entries in batches until back under the limit
+                        rows = self.conn.execute("SELECT key, size FROM responses ORDER BY accessed_at LIMIT 500").fetchall()
+                        if not rows:
+                            break
+                        self.conn.executemany("DELETE FROM responses WHERE key = ?", [(row[0],) for row in rows])
+                        total -= sum(row[1] for row in rows)
+        except Exception as e:
+            logger.error(f"Error evicting response cache entries: {e}")
     
     def get_stats(self) -> Dict[str, Any]:
         with self.lock:
-            total_requests = sum(k['requests_today'] for k in self.keys)
-            available_keys = sum(1 for k in self.keys if k['is_available'])
-            
+            entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
             return {
-                'total_keys': len(self.keys),
-                'available_keys': available_keys,
-                'total_requests_today': total_requests,
-                'estimated_remaining_capacity': (len(self.keys) * self.daily_limit) - total_requests
+                'entries': entries,
+                'size_bytes': size,
+                'hits': self.hits,
+                'misses': self.misses
             }
+    
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+class _StreamingJsonReader:
+    def __init__(self, f, chunk_size: int = 1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+    
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        if self.pos > self.chunk_size:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        self.buf += chunk
+        return True
+    
+    def next_char(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                char = self.buf[self.pos]
+                self.pos += 1
+                return char
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON input")
+    
+    def peek_char(self) -> str:
+        char = self.next_char()
+        self.pos -= 1
+        return char
+    
+    def value(self) -> Any:
+        first = self.peek_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # Strings and containers end at their closing character. A number or literal cut off
+                # at the buffer edge ("1." of "1.5e10") still decodes, so it only counts once a
+                # delimiter follows it.
+                complete = end < len(self.buf) and (first in '{["' or self.buf[end] in ',]} \t\r\n')
+                if complete or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+def iter_questions(path: str, chunk_size: int = 1 << 16):
+    # Yields questions one at a time from JSONL (one question string or object per line) or from the
+    # {"questions": [...]} layout, parsed incrementally so memory does not grow with the file size.
+    if path.endswith((".jsonl", ".ndjson")):
+        yield from iter_jsonl(path)
+        return
+    
+    with open(path, 'r', encoding='utf-8') as f:
+        reader = _StreamingJsonReader(f, chunk_size)
+        if reader.next_char() != "{":
+            raise ValueError("Invalid questions format in input file")
+        if reader.peek_char() == "}":
+            raise ValueError("Invalid questions format in input file")
+        
+        found = False
+        while True:
+            key = reader.value()
+            if reader.next_char() != ":":
+                raise ValueError("Invalid JSON in input file")
+            
+            if key == "questions" and not found:
+                if reader.next_char() != "[":
+                    raise ValueError("Invalid questions format in input file")
+                found = True
+                if reader.peek_char() == "]":
+                    reader.next_char()
+                else:
+                    while True:
+                        yield reader.value()
+                        char = reader.next_char()
+                        if char == "]":
+                            break
+                        if char != ",":
+                            raise ValueError("Invalid JSON in questions list")
+            else:
+                reader.value()
+            
+            char = reader.next_char()
+            if char == "}":
+                break
+            if char != ",":
+                raise ValueError("Invalid JSON in input file")
+        
+        if not found:
+            raise ValueError("Invalid questions format in input file")
+
+
+def question_text(question: Any) -> str:
+    if isinstance(question, dict):
+        return str(question.get("question", ""))
+    return str(question)
 
 
 class GeminiProcessor:
@@ -143,30 +2137,185 @@ class GeminiProcessor:
         checkpoint_dir: str = "checkpoints",
         concurrency: int = 5,
         max_retries: int = 5,
-        save_sample_request: bool = False
+        save_sample_request: bool = False,
+        max_connections: int = 100,
+        rpm_limit: int = 9,
+        daily_limit: int = 1450,
+        key_wait_timeout: Optional[float] = 600,
+        output_format: str = "json",
+        fsync_interval: float = 5.0,
+        queue_size: Optional[int] = None,
+        pack_size: int = 1,
+        quota_ledger_path: Optional[str] = None,
+        adaptive_concurrency: bool = False,
+        min_concurrency: int = 1,
+        max_concurrency: Optional[int] = None,
+        cache_path: Optional[str] = None,
+        cache_max_age: Optional[float] = None,
+        cache_max_bytes: Optional[int] = None,
+        api_url: str = GEMINI_API_URL,
+        collect_metrics: bool = False,
+        stream: bool = False,
+        local_backend: Optional[OpenAICompatibleBackend] = None,
+        retry_base_delay: float = 2.0,
+        retry_max_delay: float = 30.0,
+        tpm_limit: Optional[int] = None,
+        expected_output_tokens: int = 1024,
+        input_token_price: float = 0.10,
+        output_token_price: float = 0.40,
+        request_timeout: Optional[float] = 120,
+        connect_timeout: float = 10,
+        hedge: bool = False,
+        hedge_quantile: float = 0.95,
+        hedge_budget: float = 0.05,
+        profile: bool = False,
+        prompt_template: str = TRANSLATE_PROMPT,
+        key_manager: Optional[KeyManager] = None,
+        validation: Optional[Dict[str, Any]] = None,
+        validation_retries: int = 2,
+        validation_workers: int = 2
     ):
-        self.key_manager = KeyManager(api_keys)
+        # Pipeline stages pass in one shared key_manager so they draw on the same per-key limits
+        self.quota_ledger = QuotaLedger(quota_ledger_path) if quota_ledger_path and key_manager is None else None
+        self.key_manager = key_manager or KeyManager(api_keys, rpm_limit=rpm_limit, daily_limit=daily_limit, ledger=self.quota_ledger, tpm_limit=tpm_limit)
+        self.token_estimator = TokenEstimator(output_tokens=expected_output_tokens)
+        # USD per million tokens, for the run's cost report
+        self.input_token_price = input_token_price
+        self.output_token_price = output_token_price
+        self.prompt_tokens_total = 0
+        self.output_tokens_total = 0
+        self.estimated_tokens_total = 0
+        self.token_estimate_error = 0
+        self.key_wait_timeout = key_wait_timeout
         self.system_prompt = self._read_system_prompt(system_prompt_file)
-        self.output_file = output_file
-        self.checkpoint_dir = checkpoint_dir
+        self.fsync_interval = fsync_interval
+        self.result_writer: Optional[ResultWriter] = None
+        self.resumed_results: List[Dict[str, Any]] = []
+        self.configure_output(output_file, checkpoint_dir, output_format)
+        self.input_file: Optional[str] = None
         self.concurrency = concurrency
+        # Bounds in-flight requests; with adaptive_concurrency it follows AIMD between the bounds
+        self.concurrency_limiter = ConcurrencyLimiter(
+            concurrency,
+            min_limit=min_concurrency,
+            max_limit=(max_concurrency or 10 * concurrency) if adaptive_concurrency else concurrency,
+            adaptive=adaptive_concurrency
+        )
+        self.pack_size = max(1, pack_size)
+        self.queue_size = queue_size or max(2 * concurrency * self.pack_size, 100)
         self.max_retries = max_retries
-        self.api_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+        # Failed requests wait here for their backoff without holding a concurrency slot
+        self.retry_queue = RetryQueue(retry_base_delay, retry_max_delay)
+        self.retry_attempts: Dict[str, int] = {}
+        self.defer_retries = False
+        self.api_url = api_url
+        self.backend = GeminiBackend(api_url)
+        # Requests overflow to the local backend whenever no Gemini key is free
+        self.local_backend = local_backend
+        self.local_answered: Dict[str, str] = {}
+        self.overflow_count = 0
+        self.stream = stream
+        # Text received so far for each question being streamed, kept across a failed or
+        # cancelled attempt so an interrupted answer can still be saved as partial
+        self.partial_responses: Dict[str, List[str]] = {}
+        self.first_token_total = 0.0
+        self.first_token_count = 0
+        self.prompt_template = prompt_template
         self.save_sample_request = save_sample_request
         self.sample_saved = False
+        self.response_cache = ResponseCache(cache_path, cache_max_age, cache_max_bytes) if cache_path else None
+        # Requests currently on the wire, by cache key, so duplicate questions share one call
+        self.pending_requests: Dict[str, asyncio.Future] = {}
+        self.deduplicated_count = 0
+        self.max_connections = max_connections
+        # Total deadline for a request (between chunks when streaming) and for opening a connection
+        self.request_timeout = request_timeout
+        self.connect_timeout = connect_timeout
+        # Hedging: a request still running past the hedge_quantile latency of recent successful
+        # requests gets a duplicate on another key, and the first good answer wins. hedge_budget
+        # caps duplicates as a fraction of all requests sent.
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_budget = hedge_budget
+        self.hedge_delay: Optional[float] = None
+        self.request_latencies: deque = deque(maxlen=1000)
+        self.latency_samples = 0
+        self.requests_sent = 0
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self.client: Optional[httpx.AsyncClient] = None
+        # Stage and per-key latency histograms, filled only when a metrics endpoint or --profile is enabled
+        self.metrics = Metrics() if collect_metrics or profile else None
+        if profile:
+            processing_lock.timed = True
+            self.key_manager.lock.timed = True
+        self.work_queue: Optional[asyncio.Queue] = None
+        # Called with every recorded question and result, e.g. to feed the next pipeline stage
+        self.on_result: Optional[Callable[[Any, Dict[str, Any]], None]] = None
+        # Near-duplicate clusters (see apply_clusters): the representative of each question's cluster,
+        # and the members still waiting for their representative's answer
+        self.cluster_of: Dict[int, int] = {}
+        self.cluster_members: Dict[int, List[Any]] = {}
+        self.unanswered_members: Set[int] = set()
+        self.send_all_members = False
+        self.near_duplicate_count = 0
+        # Response validation (see validate_response) with its own retry budget: a rejected answer is
+        # requeued up to validation_retries times and then recorded as an error. The checks run in
+        # a process pool of validation_workers, or on the event loop when that is 0.
+        self.validation_rules = validation
+        self.validation_retries = validation_retries
+        self.validation_workers = validation_workers
+        self.validation_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self.validation_attempts: Dict[str, int] = {}
+        self.finish_reasons: Dict[str, Optional[str]] = {}
+        self.validation_failed: Dict[str, str] = {}
+        self.validation_stats: Dict[str, Any] = {"checked": 0, "passed": 0, "requeued": 0, "rejected": 0, "reasons": {}}
         
         self.is_processing = False
         self.processed_count = 0
         self.total_count = 0
-        self.results = []
+        self.skipped_count = 0
+        self.input_complete = False
+        self.input_error: Optional[str] = None
+        self.in_flight = 0
         self.current_index = 0
         self.start_time = None
         self.error_count = 0
         self.success_count = 0
+        self.stop_requested = False
+    
+    def configure_output(self, output_file: str, checkpoint_dir: str, output_format: str = "json") -> None:
+        # Points results and checkpoints at a new location, e.g. the next shard of a distributed run,
+        # while the key scheduler, connection pool and caches stay warm.
+        self.output_file = output_file
+        self.output_format = output_format
+        # Results are appended to a JSONL journal as they complete; in "json" mode the journal is
+        # compacted into the legacy {"questions": [...]} file once processing ends.
+        if output_format == "jsonl":
+            self.results_journal = output_file
+        else:
+            self.results_journal = os.path.splitext(output_file)[0] + ".jsonl"
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_name = os.path.splitext(os.path.basename(output_file))[0]
+        self.checkpoint_log = CheckpointLog(checkpoint_dir, self.checkpoint_name)
         
         if not os.path.exists(checkpoint_dir):
             os.makedirs(checkpoint_dir)
     
+    def _should_stop(self) -> bool:
+        return shutdown_requested or self.stop_requested
+    
+    def apply_clusters(self, clusters: Dict[int, List[Any]], send_all: bool = False) -> None:
+        # Results of clustered questions carry their cluster. Unless send_all is set, only the
+        # representative is sent and each member is recorded with a copy of its answer.
+        self.cluster_of = {}
+        for representative, members in clusters.items():
+            self.cluster_of[representative] = representative
+            for member in members:
+                self.cluster_of[question_id(member)] = representative
+        self.cluster_members = {} if send_all else clusters
+        self.send_all_members = send_all
+    
     def _read_system_prompt(self, system_prompt_file: str) -> str:
         try:
             with open(system_prompt_file, 'r', encoding='utf-8') as f:
@@ -182,7 +2331,7 @@ class GeminiProcessor:
                     "contents": {
                         "parts": [
                             {
-                                "text": f' Answer this Question: "{question}" \n {QUESTION_PROMPT}',
+                                "text": ANSWER_PROMPT.format(question=question),
                             },
                         ],
                     },
@@ -207,203 +2356,1057 @@ class GeminiProcessor:
             except Exception as e:
                 logger.error(f"Error saving sample request: {e}")
     
-    async def make_gemini_request(self, question: str, api_key: str) -> str:
+    def _get_client(self) -> httpx.AsyncClient:
+        # One pooled client per event loop, shared by every key. Keys travel in the
+        # query string, so all requests can reuse the same keep-alive connections.
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=60
+                ),
+                # Waiting for a pooled connection is already bounded by the concurrency limiter
+                timeout=httpx.Timeout(self.request_timeout, connect=self.connect_timeout, pool=None)
+            )
+        return self.client
+    
+    async def aclose(self) -> None:
+        if self.client is not None and not self.client.is_closed:
+            await self.client.aclose()
+        self.client = None
+        if self.validation_pool is not None:
+            self.validation_pool.shutdown(wait=False)
+            self.validation_pool = None
+    
+    async def run_single_request(self, question: str, api_key: str) -> str:
         try:
-            # Save sample request if needed
-            self._save_sample_request(question, api_key)
-            
-            data = {
-                "contents": {
-                    "parts": [
-                        {
-                            "text": f'use new telugu and write this question into telugu and keep it casually asking 2025 words, make it look like you are asking another person, Question: "{question}"',
-                        },
-                    ],
-                },
-                "system_instruction": {
-                    "parts": [
-                        {
-                            "text": self.system_prompt,
-                        },
-                    ],
-                },
-            }
-            
-            url = f"{self.api_url}?key={api_key}"
+            return await self.make_gemini_request(question, api_key)
+        finally:
+            await self.aclose()
+    
+    def _charge_estimate(self, data: Dict[str, Any], api_key: str, items: int) -> tuple:
+        prompt_chars = self.backend.prompt_chars(data)
+        estimate = self.token_estimator.request_tokens(prompt_chars, items)
+        self.key_manager.charge_tokens(api_key, estimate, request=True)
+        return prompt_chars, estimate
+    
+    def _record_usage(self, api_key: str, prompt_chars: int, items: int, estimate: int, usage: Optional[Dict[str, Any]]) -> None:
+        # Replaces the estimate charged to the key by what the response says it used
+        if not usage:
+            return
+        prompt_tokens = usage.get("promptTokenCount") or 0
+        total_tokens = usage.get("totalTokenCount") or prompt_tokens + (usage.get("candidatesTokenCount") or 0)
+        self.token_estimator.observe(prompt_chars, items, usage)
+        self.key_manager.charge_tokens(api_key, total_tokens - estimate)
+        with processing_lock:
+            self.prompt_tokens_total += prompt_tokens
+            self.output_tokens_total += total_tokens - prompt_tokens
+            self.estimated_tokens_total += estimate
+            self.token_estimate_error += abs(total_tokens - estimate)
+    
+    async def _send_gemini_request(self, data: Dict[str, Any], api_key: str, items: int = 1) -> Any:
+        # Returns the decoded response body, or an "ERROR: ..." string after marking the key
+        prompt_chars, estimate = self._charge_estimate(data, api_key, items)
+        try:
+            url = self.backend.request_url(api_key)
             headers = {"Content-Type": "application/json"}
             
-            response = requests.post(url, headers=headers, json=data)
+            network_start = time.time()
+            response = await self._get_client().post(url, headers=headers, json=data)
+            if self.metrics is not None:
+                self.metrics.observe_stage("network", time.time() - network_start)
             response.raise_for_status()
             
+            parse_start = time.time()
             response_data = response.json()
+            if self.metrics is not None:
+                self.metrics.observe_stage("parse", time.time() - parse_start)
+            self._record_usage(api_key, prompt_chars, items, estimate, response_data.get("usageMetadata"))
+            return response_data
+        except httpx.HTTPStatusError as e:
+            status_code = e.response.status_code if e.response is not None else None
+            # A rejected request used no tokens
+            self.key_manager.charge_tokens(api_key, -estimate)
+            if status_code != 429:
+                self.key_manager.mark_error(api_key)
+            logger.error("HTTP error with key %s...: %s (Status: %s)", api_key[:8], e, status_code,
+                         extra={"event": "http_error", "status": status_code})
+            return http_error_message("", status_code, e.response) if status_code else f"ERROR: {str(e)}"
+        except Exception as e:
+            self.key_manager.mark_error(api_key)
+            logger.error("Error making request with key %s...: %r", api_key[:8], e, extra={"event": "request_error"})
+            # httpx timeouts carry no message of their own
+            return f"ERROR: {str(e) or type(e).__name__}"
+    
+    async def _stream_gemini_request(self, data: Dict[str, Any], api_key: str, question: str) -> Any:
+        # Reads server-sent event chunks from streamGenerateContent as they arrive. Returns the
+        # joined text, or an "ERROR: ..." string after marking the key.
+        chunks: List[str] = []
+        prompt_chars, estimate = self._charge_estimate(data, api_key, 1)
+        try:
+            url = self.backend.request_url(api_key, stream=True)
+            headers = {"Content-Type": "application/json"}
+            finish_reason = None
+            first_token = None
+            usage = None
             
-            if response_data.get("candidates") and response_data["candidates"][0].get("content") and response_data["candidates"][0]["content"].get("parts"):
-                self.key_manager.mark_success(api_key)
-                return response_data["candidates"][0]["content"]["parts"][0]["text"]
+            network_start = time.time()
+            async with self._get_client().stream("POST", url, headers=headers, json=data) as response:
+                if response.is_error:
+                    await response.aread()
+                response.raise_for_status()
+                
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    event = json.loads(line[5:])
+                    usage = event.get("usageMetadata") or usage
+                    text, event_finish_reason = self.backend.stream_event(event)
+                    if text:
+                        if first_token is None:
+                            first_token = time.time() - network_start
+                            # Only an attempt that produced text replaces the previous attempt's partial answer
+                            self.partial_responses[question] = chunks
+                            with processing_lock:
+                                self.first_token_total += first_token
+                                self.first_token_count += 1
+                            if self.metrics is not None:
+                                self.metrics.observe_stage("first_token", first_token)
+                        chunks.append(text)
+                    finish_reason = event_finish_reason or finish_reason
             
-            return "ERROR: Unexpected response format"
-        except requests.exceptions.HTTPError as e:
-            status_code = e.response.status_code if hasattr(e, 'response') else None
-            self.key_manager.mark_error(api_key)
-            logger.error(f"HTTP error with key {api_key[:8]}...: {e} (Status: {status_code})")
-            return f"ERROR: HTTP error {status_code}" if status_code else f"ERROR: {str(e)}"
+            if self.metrics is not None:
+                self.metrics.observe_stage("network", time.time() - network_start)
+            if finish_reason is None:
+                raise httpx.ReadError("stream ended before the answer was complete")
+            self._record_usage(api_key, prompt_chars, 1, estimate, usage)
+            if self.validation_rules is not None:
+                self.finish_reasons[question] = finish_reason
+            return "".join(chunks)
+        except httpx.HTTPStatusError as e:
+            status_code = e.response.status_code if e.response is not None else None
+            self.key_manager.charge_tokens(api_key, -estimate)
+            if status_code != 429:
+                self.key_manager.mark_error(api_key)
+            logger.error("HTTP error with key %s...: %s (Status: %s)", api_key[:8], e, status_code,
+                         extra={"event": "http_error", "status": status_code})
+            return http_error_message("", status_code, e.response) if status_code else f"ERROR: {str(e)}"
         except Exception as e:
             self.key_manager.mark_error(api_key)
-            logger.error(f"Error making request with key {api_key[:8]}...: {e}")
-            return f"ERROR: {str(e)}"
+            logger.error("Error streaming request with key %s... after %d chunks: %r", api_key[:8], len(chunks), e, extra={"event": "request_error"})
+            return f"ERROR: {str(e) or type(e).__name__}"
+    
+    async def make_local_request(self, question: str) -> str:
+        backend = self.local_backend
+        try:
+            request_start = time.time()
+            response = await self._get_client().post(
+                backend.request_url(),
+                headers=backend.headers(),
+                json=backend.build_request(self.system_prompt, self.prompt_template.format(question=question))
+            )
+            if self.metrics is not None:
+                self.metrics.observe_stage("local", time.time() - request_start)
+            response.raise_for_status()
+            
+            response_data = response.json()
+            text = backend.response_text(response_data)
+            if self.validation_rules is not None:
+                self.finish_reasons[question] = backend.finish_reason(response_data)
+            if not text:
+                return "ERROR: Unexpected response format from local backend"
+            self.local_answered[question] = backend.name
+            with processing_lock:
+                self.overflow_count += 1
+            return text
+        except httpx.HTTPStatusError as e:
+            status_code = e.response.status_code if e.response is not None else None
+            logger.error(f"HTTP error from local backend {backend.base_url}: {e} (Status: {status_code})")
+            return http_error_message("Local backend ", status_code, e.response)
+        except Exception as e:
+            logger.error(f"Error making request to local backend {backend.base_url}: {e}")
+            return f"ERROR: Local backend: {str(e)}"
+    
+    async def make_gemini_request(self, question: str, api_key: str) -> str:
+        # Save sample request if needed
+        self._save_sample_request(question, api_key)
+        
+        data = self.backend.build_request(self.system_prompt, self.prompt_template.format(question=question))
+        
+        if self.stream:
+            text = await self._stream_gemini_request(data, api_key, question)
+            if text.startswith("ERROR:"):
+                return text
+        else:
+            response_data = await self._send_gemini_request(data, api_key)
+            if isinstance(response_data, str):
+                return response_data
+            text = self.backend.response_text(response_data)
+            if self.validation_rules is not None:
+                self.finish_reasons[question] = self.backend.finish_reason(response_data)
+        
+        if text:
+            return text
+        if self.validation_rules is not None:
+            # An empty or blocked answer is left to validation and its separate retry budget
+            return text or ""
+        
+        return "ERROR: Unexpected response format"
+    
+    async def make_gemini_packed_request(self, questions: List[str], api_key: str) -> Any:
+        # Sends several questions in one call with a structured JSON response. Returns one entry per
+        # question (None where the answer could not be matched up) or an "ERROR: ..." string.
+        items = json.dumps([{"id": i, "question": q} for i, q in enumerate(questions)], ensure_ascii=False, indent=1)
+        data = self.backend.build_request(
+            self.system_prompt,
+            PACKED_PROMPT.format(instruction=self.prompt_template.format(question="<QUESTION>"), items=items),
+            {
+                "responseMimeType": "application/json",
+                "responseSchema": PACKED_RESPONSE_SCHEMA,
+            }
+        )
+        
+        response_data = await self._send_gemini_request(data, api_key, items=len(questions))
+        if isinstance(response_data, str):
+            return response_data
+        
+        text = self.backend.response_text(response_data)
+        if text is None:
+            return "ERROR: Unexpected response format"
+        
+        answers: List[Optional[str]] = [None] * len(questions)
+        try:
+            parsed = json.loads(text)
+        except json.JSONDecodeError:
+            logger.warning(f"Could not parse packed response for {len(questions)} questions, falling back to single requests")
+            return answers
+        
+        for item in parsed if isinstance(parsed, list) else []:
+            if not isinstance(item, dict):
+                continue
+            index = item.get("id")
+            answer = item.get("response")
+            if isinstance(index, int) and 0 <= index < len(answers) and isinstance(answer, str) and answer.strip():
+                answers[index] = answer
+        return answers
+    
+    async def _validate_response(self, question: str, text: str) -> str:
+        # Returns the text once it passes or is out of validation retries; a rejected answer with
+        # retries left is handed back to the dispatcher to be asked again right away.
+        finish_reason = self.finish_reasons.pop(question, None)
+        validate_start = time.time()
+        if self.validation_workers > 0:
+            if self.validation_pool is None:
+                self.validation_pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.validation_workers)
+            reason = await asyncio.get_running_loop().run_in_executor(
+                self.validation_pool, validate_response, text, finish_reason, self.validation_rules
+            )
+        else:
+            reason = validate_response(text, finish_reason, self.validation_rules)
+        if self.metrics is not None:
+            self.metrics.observe_stage("validate", time.time() - validate_start)
+        
+        attempts = self.validation_attempts.pop(question, 0)
+        with processing_lock:
+            stats = self.validation_stats
+            stats["checked"] += 1
+            if reason is None:
+                stats["passed"] += 1
+                return text
+            stats["reasons"][reason] = stats["reasons"].get(reason, 0) + 1
+            requeue = self.defer_retries and attempts < self.validation_retries
+            stats["requeued" if requeue else "rejected"] += 1
+        
+        error = f"ERROR: Response failed validation ({reason})"
+        if requeue:
+            self.validation_attempts[question] = attempts + 1
+            logger.info("%s for question: %s... Requeueing (validation attempt %d/%d)", error, question[:50], attempts + 1, self.validation_retries,
+                        extra={"event": "validation", "reason": reason})
+            raise RetryDeferred(error, 0, self.retry_attempts.get(question, 0))
+        logger.warning("%s for question: %s...", error, question[:50], extra={"event": "validation", "reason": reason})
+        self.validation_failed[question] = reason
+        return text
+    
+    def _cache_key(self, question: str) -> str:
+        return ResponseCache.make_key(self.api_url, self.system_prompt, self.prompt_template, question)
+    
+    def _cache_get(self, cache_key: str) -> Optional[str]:
+        # SQLite lookups run on the event loop thread, so they are timed as their own stage
+        cache_start = time.time()
+        cached = self.response_cache.get(cache_key)
+        if self.metrics is not None:
+            self.metrics.observe_stage("cache", time.time() - cache_start)
+        return cached
+    
+    def _cache_put(self, cache_key: str, response: str) -> None:
+        cache_start = time.time()
+        self.response_cache.put(cache_key, response)
+        if self.metrics is not None:
+            self.metrics.observe_stage("cache", time.time() - cache_start)
     
     async def make_gemini_request_with_retry(self, question: str) -> str:
-        retry_count = 0
+        cache_key = self._cache_key(question)
+        
+        if self.response_cache is not None:
+            cached = self._cache_get(cache_key)
+            if cached is not None:
+                return cached
+        
+        pending = self.pending_requests.get(cache_key)
+        if pending is not None:
+            with processing_lock:
+                self.deduplicated_count += 1
+            return await asyncio.shield(pending)
+        
+        future = asyncio.get_running_loop().create_future()
+        # Nobody may be waiting on the shared future, so mark its exception as retrieved
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.pending_requests[cache_key] = future
+        
+        try:
+            result = await self._request_with_retry(
+                lambda api_key: self.make_gemini_request(question, api_key),
+                local_send=lambda: self.make_local_request(question),
+                attempts=self.retry_attempts.get(question, 0)
+            )
+            if self.validation_rules is not None and not result.startswith("ERROR:"):
+                result = await self._validate_response(question, result)
+            # Local answers are a stand-in and are not cached, so a later run asks Gemini again
+            cacheable = question not in self.local_answered and question not in self.validation_failed
+            if self.response_cache is not None and not result.startswith("ERROR:") and cacheable:
+                self._cache_put(cache_key, result)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            if not future.done():
+                future.set_exception(e)
+            raise
+        finally:
+            self.pending_requests.pop(cache_key, None)
+    
+    async def make_gemini_packed_request_with_retry(self, questions: List[str]) -> List[Any]:
+        responses: List[Optional[str]] = [None] * len(questions)
+        owned: Dict[str, List[int]] = {}
+        shared: List[tuple] = []
+        loop = asyncio.get_running_loop()
+        
+        # Same cache and in-flight sharing as single requests; only the remainder is packed
+        for i, question in enumerate(questions):
+            cache_key = self._cache_key(question)
+            if cache_key in owned:
+                owned[cache_key].append(i)
+                continue
+            
+            if self.response_cache is not None:
+                cached = self._cache_get(cache_key)
+                if cached is not None:
+                    responses[i] = cached
+                    continue
+            
+            pending = self.pending_requests.get(cache_key)
+            if pending is not None:
+                with processing_lock:
+                    self.deduplicated_count += 1
+                shared.append((i, pending))
+                continue
+            
+            future = loop.create_future()
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self.pending_requests[cache_key] = future
+            owned[cache_key] = [i]
+        
+        cache_keys = list(owned)
+        try:
+            texts = [questions[owned[cache_key][0]] for cache_key in cache_keys]
+            answers: Any = [None] * len(texts)
+            async def unpacked() -> List[Optional[str]]:
+                # The packed prompt relies on Gemini's structured output; overflowing items go to
+                # the local backend one at a time through the fallback below
+                return [None] * len(texts)
+            
+            if len(texts) > 1:
+                try:
+                    answers = await self._request_with_retry(
+                        lambda api_key: self.make_gemini_packed_request(texts, api_key),
+                        local_send=unpacked
+                    )
+                except RetryDeferred as e:
+                    answers = e
+                if isinstance(answers, (str, RetryDeferred)):
+                    answers = [answers] * len(texts)
+            
+            # Items the packed response did not answer usably are sent on their own
+            missing = [j for j, answer in enumerate(answers) if answer is None]
+            if len(texts) > 1 and missing:
+                logger.info(f"Packed response missing {len(missing)}/{len(texts)} answers, sending them individually")
+            fallback = await asyncio.gather(*(
+                self._request_with_retry(
+                    lambda api_key, text=texts[j]: self.make_gemini_request(text, api_key),
+                    local_send=lambda text=texts[j]: self.make_local_request(text)
+                )
+                for j in missing
+            ), return_exceptions=True)
+            for j, answer in zip(missing, fallback):
+                if isinstance(answer, BaseException) and not isinstance(answer, RetryDeferred):
+                    raise answer
+                answers[j] = answer
+            
+            if self.validation_rules is not None:
+                checked = await asyncio.gather(*(
+                    self._validate_response(text, answer)
+                    for text, answer in zip(texts, answers)
+                    if not isinstance(answer, RetryDeferred) and not answer.startswith("ERROR:")
+                ), return_exceptions=True)
+                checked_iter = iter(checked)
+                for j, answer in enumerate(answers):
+                    if not isinstance(answer, RetryDeferred) and not answer.startswith("ERROR:"):
+                        answers[j] = next(checked_iter)
+                        if isinstance(answers[j], BaseException) and not isinstance(answers[j], RetryDeferred):
+                            raise answers[j]
+            
+            # Deferred items are handed back one by one so each is retried on its own
+            for cache_key, text, answer in zip(cache_keys, texts, answers):
+                if isinstance(answer, RetryDeferred):
+                    self.pending_requests.pop(cache_key).set_exception(answer)
+                else:
+                    cacheable = text not in self.local_answered and text not in self.validation_failed
+                    if self.response_cache is not None and not answer.startswith("ERROR:") and cacheable:
+                        self._cache_put(cache_key, answer)
+                    self.pending_requests.pop(cache_key).set_result(answer)
+                for i in owned[cache_key]:
+                    responses[i] = answer
+        except BaseException as e:
+            for cache_key in cache_keys:
+                future = self.pending_requests.pop(cache_key, None)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            raise
+        
+        for i, pending in shared:
+            try:
+                responses[i] = await asyncio.shield(pending)
+            except RetryDeferred as e:
+                responses[i] = e
+        return responses
+    
+    async def _acquire_key_or_local_slot(self) -> tuple:
+        # Overflow routing: a free Gemini key always wins. When none is free right now (all
+        # rate-limited, cooling down or out of daily quota) a free local slot is used instead of
+        # waiting, and when both are busy the request takes whichever frees up first.
+        key_data = self.key_manager.try_acquire_key()
+        if key_data is not None:
+            return key_data, False
+        limiter = self.local_backend.limiter
+        if limiter.try_acquire():
+            return None, True
+        
+        key_task = asyncio.ensure_future(self.key_manager.acquire_key(timeout=self.key_wait_timeout))
+        slot_task = asyncio.ensure_future(limiter.acquire())
+        use_local = False
+        try:
+            await asyncio.wait([key_task, slot_task], return_when=asyncio.FIRST_COMPLETED)
+            key_data = key_task.result() if key_task.done() else None
+            if key_data is None:
+                # A key wait that timed out still leaves the local slot
+                await slot_task
+                use_local = True
+        finally:
+            key_task.cancel()
+            slot_task.cancel()
+            await asyncio.gather(key_task, slot_task, return_exceptions=True)
+            if not use_local and slot_task.done() and not slot_task.cancelled() and slot_task.exception() is None:
+                limiter.release()
+        return key_data, use_local
+    
+    async def _retry_later(self, error: str, retry_count: int, label: str) -> None:
+        # Hands the request back to the dispatcher's retry queue instead of sleeping on its slot.
+        # Outside the dispatcher the backoff is slept here before the next attempt. After the last
+        # attempt it only logs, and the caller gives up.
+        if retry_count >= self.max_retries:
+            logger.info("%s: %s (attempt %d/%d)", label, error, retry_count, self.max_retries, extra={"event": "retry"})
+            return
+        match = RETRY_AFTER_PATTERN.search(error)
+        delay = self.retry_queue.backoff(retry_count, float(match.group(1)) if match else None)
+        logger.info("%s: %s. Retrying in %.2fs (attempt %d/%d)", label, error, delay, retry_count, self.max_retries, extra={"event": "retry"})
+        if self.defer_retries:
+            raise RetryDeferred(error, delay, retry_count)
+        await asyncio.sleep(delay)
+    
+    def _observe_latency(self, latency: float) -> None:
+        self.request_latencies.append(latency)
+        self.latency_samples += 1
+        # The hedge threshold is refreshed every 50 samples rather than sorted per request
+        if self.hedge and len(self.request_latencies) >= 20 and (self.hedge_delay is None or self.latency_samples % 50 == 0):
+            ordered = sorted(self.request_latencies)
+            self.hedge_delay = ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_quantile))]
+    
+    async def _send_with_deadline(self, send: Callable[[str], Awaitable[Any]], api_key: str) -> Any:
+        try:
+            # A stream may legitimately run long; its deadline is the read timeout between chunks
+            if self.stream or self.request_timeout is None:
+                return await send(api_key)
+            return await asyncio.wait_for(send(api_key), self.request_timeout)
+        except asyncio.TimeoutError:
+            self.key_manager.mark_error(api_key)
+            logger.error("Request with key %s... timed out after %gs", api_key[:8], self.request_timeout, extra={"event": "request_error"})
+            return f"ERROR: Request timed out after {self.request_timeout:g}s"
+    
+    def _take_hedge_key(self, key_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        with processing_lock:
+            if self.hedges_sent >= self.hedge_budget * self.requests_sent:
+                return None
+        hedge_key = self.key_manager.try_acquire_key(exclude=key_data['key'])
+        if hedge_key is not None:
+            with processing_lock:
+                self.hedges_sent += 1
+                self.requests_sent += 1
+        return hedge_key
+    
+    async def _send_hedged(self, send: Callable[[str], Awaitable[Any]], key_data: Dict[str, Any]) -> tuple:
+        # Returns (result, key_data of the request that produced it)
+        with processing_lock:
+            self.requests_sent += 1
+        # Streams write partial answers per question, so only one attempt may run at a time
+        if not self.hedge or self.stream or self.hedge_delay is None:
+            return await self._send_with_deadline(send, key_data['key']), key_data
+        
+        primary = asyncio.ensure_future(self._send_with_deadline(send, key_data['key']))
+        tasks = {primary: key_data}
+        try:
+            done, _ = await asyncio.wait([primary], timeout=self.hedge_delay)
+            if done:
+                return primary.result(), key_data
+            
+            hedge_key = self._take_hedge_key(key_data)
+            if hedge_key is None:
+                return await primary, key_data
+            logger.info("Request on key %s... passed %.2fs, hedging on key %s...", key_data['key'][:8], self.hedge_delay, hedge_key['key'][:8],
+                        extra={"event": "hedge"})
+            tasks[asyncio.ensure_future(self._send_with_deadline(send, hedge_key['key']))] = hedge_key
+            
+            # The first good answer wins; an error only counts once the other attempt has failed too
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if not isinstance(result, str) or not result.startswith("ERROR:"):
+                        if task is not primary:
+                            with processing_lock:
+                                self.hedges_won += 1
+                        return result, tasks[task]
+            return result, tasks[task]
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def _request_with_retry(
+        self,
+        send: Callable[[str], Awaitable[Any]],
+        local_send: Optional[Callable[[], Awaitable[Any]]] = None,
+        attempts: int = 0
+    ) -> Any:
+        retry_count = attempts
         
         while retry_count < self.max_retries:
-            key_data = None
+            # Waiting for a key does not use up retries: the scheduler wakes us exactly
+            # when a bucket refills, and only gives up after key_wait_timeout.
+            wait_start = time.time()
+            use_local = False
+            if local_send is not None and self.local_backend is not None:
+                key_data, use_local = await self._acquire_key_or_local_slot()
+            else:
+                key_data = await self.key_manager.acquire_key(timeout=self.key_wait_timeout)
+            if self.metrics is not None:
+                self.metrics.observe_stage("key_wait", time.time() - wait_start)
             
-            while not key_data and retry_count < self.max_retries:
-                key_data = self.key_manager.get_next_key()
+            if use_local:
+                try:
+                    result = await local_send()
+                finally:
+                    self.local_backend.limiter.release()
                 
-                if not key_data:
-                    wait_time = min(1000 * (2 ** retry_count), 30000) / 1000.0
-                    logger.info(f"No keys available. Waiting {wait_time:.2f}s before retry...")
-                    time.sleep(wait_time)
-                    retry_count += 1
+                if not isinstance(result, str) or not result.startswith("ERROR:"):
+                    return result
+                retry_count += 1
+                await self._retry_later(result, retry_count, "Local backend error")
+                continue
             
             if not key_data:
+                logger.info("No keys available after waiting %ss", self.key_wait_timeout, extra={"event": "no_keys"})
                 return "ERROR: No API keys available after retries"
             
             try:
-                result = await self.make_gemini_request(question, key_data['key'])
+                request_start = time.time()
+                result, key_data = await self._send_hedged(send, key_data)
                 
-                if "429" in result:
+                failed = isinstance(result, str) and result.startswith("ERROR:")
+                if not failed:
+                    latency = time.time() - request_start
+                    self.concurrency_limiter.on_success(latency)
+                    self.key_manager.mark_success(key_data['key'], latency)
+                    self._observe_latency(latency)
+                if self.metrics is not None:
+                    outcome = ("rate_limited" if "429" in result else "error") if failed else "ok"
+                    self.metrics.observe_request(key_data['key'], outcome, time.time() - request_start)
+                
+                if not isinstance(result, str):
+                    return result
+                elif result.startswith("ERROR:") and "429" in result:
+                    # Other keys are unaffected, so a rate limit is retried at once on the next free key
                     retry_count += 1
-                    backoff_time = min(1000 * (2 ** retry_count), 30000) / 1000.0
-                    logger.info(f"Rate limit hit. Retrying in {backoff_time:.2f}s (attempt {retry_count}/{self.max_retries})")
-                    time.sleep(backoff_time)
+                    match = RETRY_AFTER_PATTERN.search(result)
+                    self.concurrency_limiter.on_rate_limited()
+                    self.key_manager.mark_rate_limited(key_data['key'], float(match.group(1)) if match else None)
+                    logger.info("Rate limit hit on key %s..., retrying on the next free key (attempt %d/%d)", key_data['key'][:8], retry_count, self.max_retries,
+                                extra={"event": "rate_limited"})
                 elif result.startswith("ERROR:"):
                     retry_count += 1
-                    backoff_time = min(1000 * (2 ** retry_count), 30000) / 1000.0
-                    logger.info(f"Error: {result}. Retrying in {backoff_time:.2f}s (attempt {retry_count}/{self.max_retries})")
-                    time.sleep(backoff_time)
+                    await self._retry_later(result, retry_count, "Error")
                 else:
                     return result
+            except RetryDeferred:
+                raise
             except Exception as e:
                 retry_count += 1
-                backoff_time = min(1000 * (2 ** retry_count), 30000) / 1000.0
-                logger.error(f"Unexpected error: {e}. Retrying in {backoff_time:.2f}s (attempt {retry_count}/{self.max_retries})")
-                time.sleep(backoff_time)
+                await self._retry_later(f"ERROR: {str(e)}", retry_count, "Unexpected error")
         
         return "ERROR: Maximum retries exceeded"
     
-    def process_question(self, question: str) -> Dict[str, str]:
-        if shutdown_requested:
-            return {"question": question, "response": "ERROR: Processing interrupted"}
+    @staticmethod
+    def _new_result(question: Any) -> Dict[str, Any]:
+        text = question_text(question)
+        result: Dict[str, Any] = {"question": text}
+        if isinstance(question, dict):
+            if question.get("id") is not None:
+                result = {"id": question["id"], "question": text}
+            # Set on the questions of later pipeline stages, see pipeline_item
+            if question.get("source_question") is not None:
+                result["source_question"] = question["source_question"]
+        return result
+    
+    async def process_question(self, question: Any) -> Dict[str, Any]:
+        text = question_text(question)
+        result = self._new_result(question)
+        
+        if self._should_stop():
+            result["response"] = "ERROR: Processing interrupted"
+            return result
         
         try:
-            logger.info(f"Processing question: {question[:50]}...")
+            logger.info("Processing question: %s...", text[:50], extra={"event": "question"})
             
-            response = asyncio.run(self.make_gemini_request_with_retry(question))
+            try:
+                response = await self.make_gemini_request_with_retry(text)
+            except RetryDeferred as e:
+                # Not counted yet; any partial answer is kept for the next attempt
+                result["retry"] = e
+                return result
+            partial = self.partial_responses.pop(text, None)
+            backend = self.local_answered.pop(text, None)
+            if backend is not None:
+                result["backend"] = backend
+            invalid = self.validation_failed.pop(text, None)
             
-            if response.startswith("ERROR:"):
+            if invalid is not None:
+                # Out of validation retries: the last answer is kept alongside the error
                 with processing_lock:
                     self.error_count += 1
+                result["error"] = f"ERROR: Response failed validation ({invalid})"
+            elif response.startswith("ERROR:"):
+                with processing_lock:
+                    self.error_count += 1
+                if partial:
+                    # The answer broke off mid-stream; keep the text from the last attempt that produced any
+                    result["partial"] = True
+                    result["error"] = response
+                    response = "".join(partial)
             else:
                 with processing_lock:
                     self.success_count += 1
             
-            return {"question": question, "response": response}
+            result["response"] = response
+            return result
         except Exception as e:
             logger.error(f"Failed to process question: {e}")
             with processing_lock:
                 self.error_count += 1
-            return {"question": question, "response": f"ERROR: {str(e)}"}
+            result["response"] = f"ERROR: {str(e)}"
+            return result
+    
+    async def process_question_batch(self, questions: List[Any]) -> List[Dict[str, Any]]:
+        if len(questions) == 1:
+            return [await self.process_question(questions[0])]
+        
+        texts = [question_text(q) for q in questions]
+        results = [self._new_result(q) for q in questions]
+        
+        try:
+            logger.info("Processing packed batch of %d questions: %s...", len(questions), texts[0][:50], extra={"event": "question"})
+            responses = await self.make_gemini_packed_request_with_retry(texts)
+        except Exception as e:
+            logger.error(f"Failed to process packed batch: {e}")
+            responses = [f"ERROR: {str(e)}"] * len(questions)
+        
+        for result, text, response in zip(results, texts, responses):
+            if isinstance(response, RetryDeferred):
+                result["retry"] = response
+                continue
+            result["response"] = response
+            backend = self.local_answered.pop(text, None)
+            if backend is not None:
+                result["backend"] = backend
+            invalid = self.validation_failed.pop(text, None)
+            if invalid is not None:
+                result["error"] = f"ERROR: Response failed validation ({invalid})"
+            with processing_lock:
+                if invalid is not None or response.startswith("ERROR:"):
+                    self.error_count += 1
+                else:
+                    self.success_count += 1
+        return results
+    
+    def process_questions(self, questions: Iterable[Any], resume: bool = False, completed: Optional[Any] = None) -> None:
+        asyncio.run(self.process_questions_async(questions, resume=resume, completed=completed))
+    
+    def _produce_questions(
+        self,
+        questions: Iterable[Any],
+        work_queue: asyncio.Queue,
+        loop: asyncio.AbstractEventLoop,
+        stop: threading.Event,
+        completed: Optional[Any]
+    ) -> None:
+        # Runs on a worker thread so parsing overlaps with dispatch; blocks whenever the bounded
+        # queue is full, which keeps memory flat regardless of input size.
+        def put(item: Any) -> bool:
+            future = asyncio.run_coroutine_threadsafe(work_queue.put(item), loop)
+            while True:
+                try:
+                    future.result(timeout=0.5)
+                    return True
+                except concurrent.futures.TimeoutError:
+                    if stop.is_set():
+                        future.cancel()
+                        return False
+        
+        try:
+            for question in questions:
+                if stop.is_set() or self._should_stop():
+                    break
+                qid = question_id(question)
+                if completed is not None and qid in completed:
+                    with processing_lock:
+                        self.skipped_count += 1
+                    # Members of a representative answered in an earlier run (e.g. before the
+                    # clusters changed) get no copy in this one, so they are sent themselves
+                    for member in self.cluster_members.pop(qid, []):
+                        self.unanswered_members.add(question_id(member))
+                    continue
+                if not self.send_all_members and self.cluster_of.get(qid, qid) != qid and qid not in self.unanswered_members:
+                    # Recorded along with its cluster's representative
+                    continue
+                if not put(question):
+                    break
+                with processing_lock:
+                    self.total_count += 1
+        except Exception as e:
+            logger.error(f"Error reading questions: {e}")
+            self.input_error = str(e)
+        finally:
+            with processing_lock:
+                self.input_complete = True
+            put(None)
+    
+    def _save_partial_results(self, questions: List[Any]) -> None:
+        # Requests cancelled by a shutdown mid-stream: the text that arrived is journaled as partial
+        # but not checkpointed, so a resumed run asks again and compaction keeps the complete answer.
+        for question in questions:
+            partial = self.partial_responses.pop(question_text(question), None)
+            if partial and self.result_writer is not None:
+                result = self._new_result(question)
+                result["response"] = "".join(partial)
+                result["partial"] = True
+                result["error"] = "ERROR: Processing interrupted"
+                self.result_writer.write(result)
+                logger.info(f"Saved partial answer ({len(result['response'])} chars) for interrupted question: {result['question'][:50]}...")
+    
+    def _record_result(self, question: Any, result: Dict[str, Any]) -> None:
+        with processing_lock:
+            self.processed_count += 1
+            processed_count = self.processed_count
+        
+        if processed_count % 10 == 0 or (self.input_complete and processed_count == self.total_count):
+            elapsed = time.time() - self.start_time
+            rate = processed_count / elapsed if elapsed > 0 else 0
+            logger.info("Processed %d/%d questions (%.2f/sec)", processed_count, self.total_count, rate, extra={"event": "progress"})
+        
+        qid = question_id(question)
+        if qid in self.cluster_of:
+            result["cluster"] = f"{self.cluster_of[qid]:016x}"
+        self.result_writer.write(result, qid)
+        if self.on_result is not None:
+            self.on_result(question, result)
+        members = self.cluster_members.pop(qid, None)
+        if members:
+            self._record_members(result, members)
+        
+        if processed_count % 10 == 0:
+            self.save_checkpoint()
+    
+    def _record_members(self, result: Dict[str, Any], members: List[Any]) -> None:
+        failed = "error" in result or result["response"].startswith("ERROR:")
+        for member in members:
+            record = self._new_result(member)
+            record.update((k, v) for k, v in result.items() if k not in ("id", "question"))
+            record["duplicate_of"] = result["question"]
+            self.result_writer.write(record, question_id(member))
+            if self.on_result is not None:
+                self.on_result(member, record)
+        
+        with processing_lock:
+            self.near_duplicate_count += len(members)
+            self.total_count += len(members)
+            self.processed_count += len(members)
+            if failed:
+                self.error_count += len(members)
+            else:
+                self.success_count += len(members)
     
-    def process_questions(self, questions: List[str]) -> None:
+    async def process_questions_async(self, questions: Iterable[Any], resume: bool = False, completed: Optional[Any] = None) -> None:
         if self.is_processing:
             logger.warning("Processing already in progress")
             return
         
         try:
             with processing_lock:
-                self.total_count = len(questions)
+                self.total_count = 0
                 self.processed_count = 0
+                self.skipped_count = 0
+                self.input_complete = False
+                self.input_error = None
                 self.current_index = 0
                 self.is_processing = True
                 self.start_time = time.time()
-                self.results = []
                 self.error_count = 0
                 self.success_count = 0
             
-            logger.info(f"Processing {self.total_count} questions with {self.key_manager.get_stats()['total_keys']} API keys")
-            logger.info(f"Using concurrency limit of {self.concurrency}")
+            # A fresh run starts a new journal and checkpoint log; a resumed run appends to both
+            if not resume:
+                self.checkpoint_log.reset()
+            self.result_writer = ResultWriter(
+                self.results_journal,
+                append=resume,
+                checkpoint=self.checkpoint_log,
+                fsync_interval=self.fsync_interval,
+                metrics=self.metrics
+            )
+            for result in self.resumed_results:
+                self.result_writer.write(result, question_id(result["question"]))
+            self.resumed_results = []
             
-            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
-                future_to_question = {executor.submit(self.process_question, q): q for q in questions}
-                
-                for i, future in enumerate(concurrent.futures.as_completed(future_to_question)):
-                    if shutdown_requested:
-                        logger.info("Shutdown requested, stopping processing...")
-                        executor.shutdown(wait=False)
+            logger.info(f"Processing questions with {self.key_manager.get_stats()['total_keys']} API keys")
+            self.defer_retries = True
+            if self.local_backend is not None:
+                slots = await self.local_backend.detect_slots(self._get_client())
+                logger.info(f"Overflowing to local backend {self.local_backend.base_url} with {slots} parallel slots when no API key is free")
+            limiter = self.concurrency_limiter
+            if limiter.adaptive:
+                logger.info(f"Using adaptive concurrency limit starting at {int(limiter.limit)} (bounds {limiter.min_limit}-{limiter.max_limit}, HTTP/2: {HTTP2_AVAILABLE}, max connections: {self.max_connections})")
+            else:
+                logger.info(f"Using concurrency limit of {self.concurrency} (HTTP/2: {HTTP2_AVAILABLE}, max connections: {self.max_connections})")
+            
+            # In-flight requests are bounded by the limiter rather than by OS threads,
+            # so the concurrency limit can be raised well past what a thread pool allows.
+            work_queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+            self.work_queue = work_queue
+            stop = threading.Event()
+            loop = asyncio.get_running_loop()
+            in_flight: Set[asyncio.Task] = set()
+            
+            def retry_later(question: Any, retry: RetryDeferred) -> None:
+                self.retry_attempts[question_text(question)] = retry.attempts
+                task = asyncio.create_task(run([question], retry_delay=retry.delay))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+            
+            async def run(batch: List[Any], retry_delay: Optional[float] = None) -> None:
+                if retry_delay is not None:
+                    # A parked retry holds no slot while it waits, and jumps ahead of new
+                    # questions for the next free one once it is due
+                    try:
+                        await self.retry_queue.wait(retry_delay)
+                        await limiter.acquire(priority=True)
+                    except asyncio.CancelledError:
+                        self._save_partial_results(batch)
+                        raise
+                    self.in_flight += len(batch)
+                try:
+                    # Questions interrupted by a shutdown are left out of the journal and the
+                    # checkpoint log so that a resumed run picks them up again.
+                    if self._should_stop():
+                        self._save_partial_results(batch)
+                        return
+                    batch_start = time.time()
+                    results = await self.process_question_batch(batch)
+                    completed_count = 0
+                    for question, result in zip(batch, results):
+                        retry = result.pop("retry", None)
+                        if retry is not None:
+                            if self._should_stop():
+                                self._save_partial_results([question])
+                            else:
+                                retry_later(question, retry)
+                            continue
+                        if self._should_stop() and result["response"] == "ERROR: Processing interrupted":
+                            continue
+                        self.retry_attempts.pop(result["question"], None)
+                        self._record_result(question, result)
+                        completed_count += 1
+                    if self.metrics is not None:
+                        self.metrics.observe_stage("question", time.time() - batch_start)
+                        self.metrics.record_completions(completed_count)
+                except asyncio.CancelledError:
+                    self._save_partial_results(batch)
+                    raise
+                except Exception as e:
+                    logger.error(f"Error processing question result: {e}")
+                finally:
+                    self.in_flight -= len(batch)
+                    limiter.release()
+            
+            async def dispatch() -> None:
+                input_done = False
+                while not input_done:
+                    question = await work_queue.get()
+                    if question is None or self._should_stop():
                         break
                     
-                    try:
-                        result = future.result()
-                        with processing_lock:
-                            self.results.append(result)
-                            self.processed_count += 1
-                        
-                        if self.processed_count % 10 == 0 or self.processed_count == self.total_count:
-                            elapsed = time.time() - self.start_time
-                            rate = self.processed_count / elapsed if elapsed > 0 else 0
-                            logger.info(f"Processed {self.processed_count}/{self.total_count} questions ({rate:.2f}/sec)")
-                        
-                        if self.processed_count % 10 == 0:
-                            self.save_checkpoint()
-                        
-                        self.save_results()
-                    except Exception as e:
-                        logger.error(f"Error processing question result: {e}")
+                    # With packing enabled, take whatever else is already queued (up to pack_size)
+                    # into the same request instead of waiting for more to arrive.
+                    batch = [question]
+                    while len(batch) < self.pack_size and not work_queue.empty():
+                        question = work_queue.get_nowait()
+                        if question is None:
+                            input_done = True
+                            break
+                        batch.append(question)
+                    
+                    limiter_start = time.time()
+                    await self.retry_queue.wait_for_room(self.queue_size)
+                    await limiter.acquire()
+                    if self.metrics is not None:
+                        self.metrics.observe_stage("concurrency_wait", time.time() - limiter_start)
+                    self.in_flight += len(batch)
+                    task = asyncio.create_task(run(batch))
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
+                
+                # Finishing requests may park more retries, so wait until none are left
+                while in_flight:
+                    await asyncio.gather(*list(in_flight), return_exceptions=True)
+            
+            async def watch_shutdown() -> None:
+                while not self._should_stop():
+                    await asyncio.sleep(0.5)
+                logger.info("Stop requested, stopping processing...")
+            
+            producer = loop.run_in_executor(None, self._produce_questions, questions, work_queue, loop, stop, completed)
+            dispatcher = asyncio.create_task(dispatch())
+            watcher = asyncio.create_task(watch_shutdown())
+            
+            try:
+                await asyncio.wait([dispatcher, watcher], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                stop.set()
+                watcher.cancel()
+                dispatcher.cancel()
+                for task in list(in_flight):
+                    task.cancel()
+                await asyncio.gather(dispatcher, watcher, *list(in_flight), return_exceptions=True)
+                await producer
+                await self.aclose()
             
+            if self.skipped_count:
+                logger.info(f"Skipped {self.skipped_count} previously processed questions")
             logger.info(f"Processing completed: {self.success_count} successful, {self.error_count} errors")
+            if self.overflow_count:
+                logger.info(f"{self.overflow_count} questions were answered by the local backend")
+            if self.validation_rules is not None:
+                stats = self.validation_stats
+                logger.info(
+                    f"Validation: {stats['passed']}/{stats['checked']} answers passed, {stats['requeued']} requeued, "
+                    f"{stats['rejected']} rejected {stats['reasons']}; {self._usable_per_request():.2f} usable answers per request"
+                )
             
             self.save_results()
+            if not self._should_stop() and not self.input_error:
+                self.checkpoint_log.compact()
+            self.checkpoint_log.close()
             self.save_checkpoint(label="final")
             
             with processing_lock:
                 self.is_processing = False
+                self.defer_retries = False
         except Exception as e:
             logger.error(f"Error in process_questions: {e}")
+            if self.result_writer is not None:
+                self.result_writer.close()
+            self.checkpoint_log.close()
             with processing_lock:
                 self.is_processing = False
+                self.defer_retries = False
     
     def save_checkpoint(self, label: str = "") -> None:
+        # Completed questions are already in the write-ahead log; this only refreshes a small
+        # metadata file, so a checkpoint costs the same at result 10 and at result 10 million.
         try:
+            checkpoint_start = time.time()
             timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-            checkpoint_file = f"checkpoint_{label + '_' if label else ''}{timestamp}.json"
-            checkpoint_path = os.path.join(self.checkpoint_dir, checkpoint_file)
+            checkpoint_path = os.path.join(self.checkpoint_dir, f"{self.checkpoint_name}.meta.json")
             
             with processing_lock:
                 checkpoint_data = {
                     "timestamp": timestamp,
+                    "label": label,
+                    "input_file": self.input_file,
                     "processed_count": self.processed_count,
                     "total_count": self.total_count,
                     "success_count": self.success_count,
                     "error_count": self.error_count,
                     "elapsed_time": time.time() - self.start_time if self.start_time else 0,
-                    "key_stats": self.key_manager.get_stats(),
-                    "results": self.results
+                    "completed_questions": len(self.checkpoint_log),
+                    "key_stats": self.key_manager.get_stats()
                 }
             
-            with open(checkpoint_path, 'w', encoding='utf-8') as f:
+            tmp_path = f"{checkpoint_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
                 json.dump(checkpoint_data, f, indent=2, ensure_ascii=False)
+            os.replace(tmp_path, checkpoint_path)
+            if self.metrics is not None:
+                self.metrics.observe_stage("checkpoint", time.time() - checkpoint_start)
             
-            logger.info(f"Checkpoint saved: {checkpoint_path}")
+            logger.info("Checkpoint saved: %s", checkpoint_path, extra={"event": "checkpoint"})
         except Exception as e:
             logger.error(f"Error saving checkpoint: {e}")
     
     def save_results(self) -> None:
         try:
-            with processing_lock:
-                with open(self.output_file, 'w', encoding='utf-8') as f:
-                    json.dump({"questions": self.results}, f, indent=2, ensure_ascii=False)
+            if self.result_writer is not None:
+                self.result_writer.close()
+            
+            if self.output_format in ("json", "store"):
+                compact_start = time.time()
+                if self.output_format == "json":
+                    count = compact_jsonl_to_json(self.results_journal, self.output_file)
+                else:
+                    count = build_result_store(self.results_journal, self.output_file)
+                if self.metrics is not None:
+                    self.metrics.observe_stage("compact", time.time() - compact_start)
+                logger.info(f"Compacted {count} results from {self.results_journal} into {self.output_file}")
         except Exception as e:
             logger.error(f"Error saving results: {e}")
     
@@ -417,11 +3420,16 @@ class GeminiProcessor:
             rate = self.processed_count / elapsed if elapsed > 0 and self.processed_count > 0 else 0
             estimated_remaining = remaining / rate if rate > 0 else 0
             
+            # While the input is still streaming, total_count is the number of questions read so far
             return {
-                "status": "completed" if self.processed_count == self.total_count else "processing",
+                "status": "completed" if self.input_complete and self.processed_count == self.total_count else "processing",
                 "progress": {
                     "total": self.total_count,
+                    "input_complete": self.input_complete,
+                    "skipped": self.skipped_count,
                     "processed": self.processed_count,
+                    "in_flight": self.in_flight,
+                    "retry_waiting": self.retry_queue.waiting,
                     "successful": self.success_count,
                     "errors": self.error_count,
                     "percentage": f"{(self.processed_count / self.total_count * 100):.2f}%" if self.total_count > 0 else "0%",
@@ -430,10 +3438,47 @@ class GeminiProcessor:
                     "elapsed_time": self._format_time(elapsed),
                     "estimated_remaining": self._format_time(estimated_remaining),
                     "questions_per_second": f"{rate:.2f}",
+                    "concurrency_limit": int(self.concurrency_limiter.limit),
+                    "concurrency": self.concurrency_limiter.get_stats(),
                     "api_keys": self.key_manager.get_stats(),
+                    "deduplicated_requests": self.deduplicated_count,
+                    "near_duplicates_answered": self.near_duplicate_count,
+                    "retries": self.retry_queue.get_stats(),
+                    "local_answers": self.overflow_count,
+                    "mean_time_to_first_token": f"{self.first_token_total / self.first_token_count:.3f}s" if self.first_token_count else None,
+                    "response_cache": self.response_cache.get_stats() if self.response_cache else None,
+                    "tokens": self._token_report(),
+                    "validation": dict(self.validation_stats, usable_per_request=round(self._usable_per_request(), 3)) if self.validation_rules is not None else None,
+                    "hedging": {
+                        "enabled": self.hedge,
+                        "delay": round(self.hedge_delay, 3) if self.hedge_delay is not None else None,
+                        "sent": self.hedges_sent,
+                        "won": self.hedges_won,
+                        "extra_requests": f"{self.hedges_sent / self.requests_sent * 100:.1f}%" if self.requests_sent else "0%"
+                    },
                 }
             }
     
+    def _usable_per_request(self) -> float:
+        # Answers that made it into the results per request sent to Gemini: what a unit of quota buys
+        return self.success_count / self.requests_sent if self.requests_sent else 0.0
+    
+    def _token_report(self) -> Dict[str, Any]:
+        estimator = self.token_estimator
+        total_tokens = self.prompt_tokens_total + self.output_tokens_total
+        cost = (self.prompt_tokens_total * self.input_token_price + self.output_tokens_total * self.output_token_price) / 1e6
+        return {
+            "prompt_tokens": self.prompt_tokens_total,
+            "output_tokens": self.output_tokens_total,
+            "total_tokens": total_tokens,
+            "estimated_cost_usd": round(cost, 4),
+            "tokens_per_question": round(total_tokens / self.processed_count, 1) if self.processed_count else None,
+            "estimate_error": f"{self.token_estimate_error / total_tokens * 100:.1f}%" if total_tokens else None,
+            "chars_per_token": round(estimator.chars_per_token, 2),
+            "expected_output_tokens": int(estimator.output_tokens),
+            "tpm_limit": self.key_manager.tpm_limit
+        }
+    
     def _format_time(self, seconds: float) -> str:
         if seconds < 0 or not seconds:
             return "0s"
@@ -448,40 +3493,1189 @@ class GeminiProcessor:
         else:
             return f"{seconds}s"
     
-    def resume_from_checkpoint(self, checkpoint_file: str) -> None:
+    def resume_from_checkpoint(self, checkpoint_file: str, input_file: str = "english_questions.json") -> None:
         if self.is_processing:
             logger.warning("Cannot resume, processing already in progress")
             return
         
         try:
-            checkpoint_path = os.path.join(self.checkpoint_dir, checkpoint_file)
-            if not os.path.exists(checkpoint_path):
-                logger.error(f"Checkpoint file not found: {checkpoint_file}")
-                return
+            name = os.path.basename(checkpoint_file)
+            for suffix in (".meta.json", ".wal", ".snapshot"):
+                if name.endswith(suffix):
+                    name = name[:-len(suffix)]
             
-            with open(checkpoint_path, 'r', encoding='utf-8') as f:
-                checkpoint_data = json.load(f)
-            
-            with processing_lock:
-                self.results = checkpoint_data.get("results", [])
+            legacy_path = os.path.join(self.checkpoint_dir, checkpoint_file)
+            if name.endswith(".json") and os.path.exists(legacy_path):
+                # Full-results checkpoint from older versions: carry its results into the journal
+                with open(legacy_path, 'r', encoding='utf-8') as f:
+                    self.resumed_results = json.load(f).get("results", [])
+                completed = set(question_id(r["question"]) for r in self.resumed_results)
+                resume = False
+            else:
+                if name != self.checkpoint_name:
+                    self.checkpoint_name = name
+                    self.checkpoint_log = CheckpointLog(self.checkpoint_dir, name)
+                # A run stopped before its first completed result only left its metadata (and maybe partial answers)
+                meta_path = os.path.join(self.checkpoint_dir, f"{name}.meta.json")
+                if not any(os.path.exists(path) for path in (self.checkpoint_log.wal_path, self.checkpoint_log.snapshot_path, meta_path)):
+                    logger.error(f"Checkpoint not found: {checkpoint_file}")
+                    return
+                completed = self.checkpoint_log.load()
+                resume = True
             
-            processed_questions = set(r["question"] for r in self.results)
+            self.input_file = input_file
+            logger.info(f"Resuming from {input_file}, skipping {len(completed)} previously processed questions")
             
-            with open("english_questions.json", 'r', encoding='utf-8') as f:
-                questions_data = json.load(f)
+            asyncio.run(self.process_questions_async(iter_questions(input_file), resume=resume, completed=completed))
+        except Exception as e:
+            logger.error(f"Error resuming from checkpoint: {e}")
+
+
+class MetricsServer:
+    def __init__(self, processor: GeminiProcessor, host: str = "127.0.0.1", port: int = 9464):
+        self.processor = processor
+        server = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
             
-            if not questions_data.get("questions") or not isinstance(questions_data["questions"], list):
-                logger.error("Invalid questions format in file")
+            def do_GET(self) -> None:
+                try:
+                    path = self.path.split("?", 1)[0]
+                    if path == "/metrics":
+                        body = server.render_prometheus().encode("utf-8")
+                        content_type = "text/plain; version=0.0.4; charset=utf-8"
+                    elif path in ("/metrics.json", "/progress"):
+                        body = json.dumps(server.render_json(), ensure_ascii=False, indent=2).encode("utf-8")
+                        content_type = "application/json"
+                    else:
+                        self.send_error(404)
+                        return
+                except Exception as e:
+                    logger.error(f"Error rendering metrics: {e}")
+                    self.send_error(500)
+                    return
+                
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics-server", daemon=True)
+    
+    def start(self) -> "MetricsServer":
+        self.thread.start()
+        host, port = self.httpd.server_address[:2]
+        logger.info(f"Serving metrics at http://{host}:{port}/metrics and /metrics.json")
+        return self
+    
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+    
+    def _gauges(self) -> Dict[str, Any]:
+        processor = self.processor
+        with processing_lock:
+            elapsed = time.time() - processor.start_time if processor.start_time else 0
+            gauges = {
+                'processed': processor.processed_count,
+                'successful': processor.success_count,
+                'errors': processor.error_count,
+                'total': processor.total_count,
+                'skipped': processor.skipped_count,
+                'in_flight': processor.in_flight,
+                'deduplicated': processor.deduplicated_count,
+                'elapsed': elapsed
+            }
+        gauges['queue_depth'] = processor.work_queue.qsize() if processor.work_queue is not None else 0
+        gauges['writer_queue_depth'] = processor.result_writer.queue.qsize() if processor.result_writer is not None else 0
+        gauges['concurrency_limit'] = int(processor.concurrency_limiter.limit)
+        gauges['retry_waiting'] = processor.retry_queue.waiting
+        gauges['retries_scheduled'] = processor.retry_queue.scheduled_total
+        gauges['throughput'] = gauges['processed'] / elapsed if elapsed > 0 else 0
+        gauges['recent_throughput'] = processor.metrics.recent_rate()
+        gauges['validation'] = json.loads(json.dumps(processor.validation_stats)) if processor.validation_rules is not None else None
+        gauges['hedges_sent'] = processor.hedges_sent
+        gauges['hedges_won'] = processor.hedges_won
+        gauges['prompt_tokens'] = processor.prompt_tokens_total
+        gauges['output_tokens'] = processor.output_tokens_total
+        return gauges
+    
+    def render_json(self) -> Dict[str, Any]:
+        metrics = self.processor.metrics
+        snapshot = metrics.snapshot()
+        summarize = metrics.summarize
+        
+        keys = {}
+        for key_stats in self.processor.key_manager.get_key_stats():
+            label = metrics.key_label(key_stats.pop('key'))
+            key_stats['requests'] = snapshot['key_counters'].get(label, {'ok': 0, 'error': 0, 'rate_limited': 0})
+            if label in snapshot['keys']:
+                key_stats['latency'] = summarize(snapshot['keys'][label])
+            keys[label] = key_stats
+        
+        return {
+            'progress': self._gauges(),
+            'api_keys': self.processor.key_manager.get_stats(),
+            'stages': {stage: summarize(histogram) for stage, histogram in snapshot['stages'].items()},
+            'keys': keys
+        }
+    
+    def render_prometheus(self) -> str:
+        metrics = self.processor.metrics
+        snapshot = metrics.snapshot()
+        gauges = self._gauges()
+        key_manager_stats = self.processor.key_manager.get_stats()
+        lines: List[str] = []
+        
+        def metric(name: str, kind: str, help_text: str, samples: List[tuple]) -> None:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        
+        def histogram(name: str, help_text: str, label_name: str, histograms: Dict[str, Dict[str, Any]]) -> None:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for label, h in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip(metrics.buckets + ["+Inf"], h['counts']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{label_name}="{label}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{label_name}="{label}"}} {h["sum"]}')
+                lines.append(f'{name}_count{{{label_name}="{label}"}} {h["count"]}')
+        
+        metric("gemini_questions_processed_total", "counter", "Questions with a recorded result", [((), gauges['processed'])])
+        metric("gemini_questions_successful_total", "counter", "Questions answered successfully", [((), gauges['successful'])])
+        metric("gemini_questions_failed_total", "counter", "Questions that ended in an error", [((), gauges['errors'])])
+        metric("gemini_questions_read_total", "counter", "Questions read from the input so far", [((), gauges['total'])])
+        metric("gemini_hedged_requests_total", "counter", "Duplicate requests sent for slow requests, and how many answered first", [
+            ((("outcome", "sent"),), gauges['hedges_sent']),
+            ((("outcome", "won"),), gauges['hedges_won'])
+        ])
+        if gauges['validation'] is not None:
+            validation = gauges['validation']
+            metric("gemini_validation_total", "counter", "Answers checked by response validation, by outcome",
+                [((("outcome", outcome),), validation[outcome]) for outcome in ("passed", "requeued", "rejected")])
+            metric("gemini_validation_failures_total", "counter", "Answers that failed response validation, by reason",
+                [((("reason", reason),), count) for reason, count in sorted(validation['reasons'].items())])
+        metric("gemini_tokens_total", "counter", "Tokens reported in usageMetadata", [
+            ((("kind", "prompt"),), gauges['prompt_tokens']),
+            ((("kind", "output"),), gauges['output_tokens'])
+        ])
+        metric("gemini_throughput_questions_per_second", "gauge", "Questions recorded per second over the last minute", [((), gauges['recent_throughput'])])
+        metric("gemini_in_flight_questions", "gauge", "Questions currently being requested", [((), gauges['in_flight'])])
+        metric("gemini_queue_depth", "gauge", "Questions read ahead and waiting for dispatch", [((), gauges['queue_depth'])])
+        metric("gemini_writer_queue_depth", "gauge", "Results waiting to be written", [((), gauges['writer_queue_depth'])])
+        metric("gemini_concurrency_limit", "gauge", "Current concurrency limit", [((), gauges['concurrency_limit'])])
+        metric("gemini_keys_available", "gauge", "API keys not in cool-down", [((), key_manager_stats['available_keys'])])
+        metric("gemini_keys_ready", "gauge", "API keys that can be used right now", [((), key_manager_stats['ready_keys'])])
+        metric("gemini_key_waiting_callers", "gauge", "Requests waiting for a free API key", [((), key_manager_stats['waiting_callers'])])
+        metric("gemini_remaining_daily_capacity", "gauge", "Requests left today across all keys", [((), key_manager_stats['estimated_remaining_capacity'])])
+        
+        metric("gemini_key_requests_total", "counter", "Requests sent per API key by outcome", [
+            ((("key", label), ("outcome", outcome)), count)
+            for label, counters in sorted(snapshot['key_counters'].items())
+            for outcome, count in counters.items()
+        ])
+        key_stats = [(metrics.key_label(k['key']), k) for k in self.processor.key_manager.get_key_stats()]
+        metric("gemini_key_tokens", "gauge", "Requests the key's RPM bucket allows right now",
+            [((("key", label),), k['tokens']) for label, k in key_stats])
+        metric("gemini_key_remaining_today", "gauge", "Requests left in the key's daily limit",
+            [((("key", label),), k['remaining_today']) for label, k in key_stats])
+        metric("gemini_key_available", "gauge", "1 unless the key is in cool-down",
+            [((("key", label),), int(k['available'])) for label, k in key_stats])
+        metric("gemini_key_circuit_state", "gauge", "Circuit breaker state: 0 closed, 1 half-open, 2 open",
+            [((("key", label),), ('closed', 'half_open', 'open').index(k['circuit'])) for label, k in key_stats])
+        metric("gemini_key_error_rate", "gauge", "Exponentially weighted error rate of the key's requests",
+            [((("key", label),), k['error_rate']) for label, k in key_stats])
+        metric("gemini_key_latency_ewma_seconds", "gauge", "Exponentially weighted latency of the key's successful requests",
+            [((("key", label),), k['latency_ewma']) for label, k in key_stats if k['latency_ewma'] is not None])
+        metric("gemini_keys_open_circuits", "gauge", "API keys whose circuit breaker is open", [((), key_manager_stats['open_circuits'])])
+        
+        histogram("gemini_stage_latency_seconds", "Time spent per processing stage", "stage", snapshot['stages'])
+        histogram("gemini_key_request_latency_seconds", "Network round trip per API key", "key", snapshot['keys'])
+        return "\n".join(lines) + "\n"
+
+
+class StackSampler:
+    def __init__(self, interval: float = 0.005):
+        # Samples every thread's stack from a background thread, like py-spy but in-process. Output
+        # is in collapsed-stack form ("thread;outer;...;inner count") for flame graph tools.
+        self.interval = interval
+        self.samples = 0
+        self.stacks: Dict[str, int] = {}
+        self.leaves: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+    
+    def start(self) -> "StackSampler":
+        self._thread.start()
+        return self
+    
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+    
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if not frames:
+                    continue
+                stack = ";".join([names.get(thread_id, str(thread_id))] + frames[::-1])
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.leaves[frames[0]] = self.leaves.get(frames[0], 0) + 1
+            self.samples += 1
+    
+    def write(self, path: str) -> None:
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                f.write(f"{stack} {count}\n")
+    
+    def top_functions(self, limit: int = 15) -> List[Dict[str, Any]]:
+        # Share of all thread stacks sampled, so idle threads waiting on a queue show up as such
+        total = sum(self.leaves.values())
+        return [
+            {'function': name, 'samples': count, 'share': round(count / total, 4) if total else 0.0}
+            for name, count in sorted(self.leaves.items(), key=lambda item: -item[1])[:limit]
+        ]
+
+
+class Profiler:
+    def __init__(self, processor: GeminiProcessor, output_path: str, stacks_path: Optional[str] = None, sample_interval: float = 0.005):
+        self.processor = processor
+        self.output_path = output_path
+        self.stacks_path = stacks_path
+        self.sampler = StackSampler(sample_interval) if stacks_path else None
+        self.started = time.time()
+    
+    def start(self) -> "Profiler":
+        self.started = time.time()
+        if self.sampler is not None:
+            self.sampler.start()
+        return self
+    
+    def stop(self) -> Dict[str, Any]:
+        wall_time = time.time() - self.started
+        if self.sampler is not None:
+            self.sampler.stop()
+        processor = self.processor
+        metrics = processor.metrics
+        snapshot = metrics.snapshot()
+        questions = processor.processed_count
+        
+        # Per-question cost of each stage is its total time over all recorded questions. Stages
+        # overlap across concurrent requests, so the totals can add up to more than the wall time.
+        stages = {}
+        for stage, histogram in sorted(snapshot['stages'].items(), key=lambda item: -item[1]['sum']):
+            stages[stage] = metrics.summarize(histogram)
+            stages[stage]['per_question'] = histogram['sum'] / questions if questions else None
+        summary = {
+            'wall_time_seconds': wall_time,
+            'questions': questions,
+            'questions_per_second': questions / wall_time if wall_time > 0 else 0,
+            'concurrency_limit': int(processor.concurrency_limiter.limit),
+            'stages': stages,
+            'locks': {lock.name: lock.get_stats() for lock in (processing_lock, processor.key_manager.lock)}
+        }
+        if self.sampler is not None:
+            summary['samples'] = self.sampler.samples
+            summary['top_functions'] = self.sampler.top_functions()
+        
+        try:
+            with open(self.output_path, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, indent=2, ensure_ascii=False)
+            if self.sampler is not None:
+                self.sampler.write(self.stacks_path)
+                logger.info(f"Stack samples written to {self.stacks_path}")
+        except Exception as e:
+            logger.error(f"Error writing profile: {e}")
+        
+        logger.info(f"Profile ({questions} questions in {wall_time:.1f}s), written to {self.output_path}:")
+        logger.info(f"  {'stage':<18}{'count':>9}{'total s':>11}{'mean ms':>10}{'p95 ms':>10}{'ms/question':>13}")
+        for stage, stats in stages.items():
+            p95 = stats['p95'] * 1000 if stats['p95'] is not None else 0.0
+            per_question = stats['per_question'] * 1000 if stats['per_question'] is not None else 0.0
+            logger.info(f"  {stage:<18}{stats['count']:>9}{stats['total_seconds']:>11.2f}{stats['mean'] * 1000:>10.2f}{p95:>10.2f}{per_question:>13.2f}")
+        for name, stats in summary['locks'].items():
+            logger.info(f"  {name}: {stats['acquisitions']} acquisitions, {stats['contended']} contended, waited {stats['wait_total_seconds']:.4f}s (max {stats['wait_max_seconds'] * 1000:.2f}ms), held {stats['hold_total_seconds']:.4f}s")
+        return summary
+
+
+class ShardCoordinator:
+    def __init__(self, work_dir: str, busy_timeout: float = 60):
+        self.work_dir = work_dir
+        self.shard_dir = os.path.join(work_dir, "shards")
+        self.results_dir = os.path.join(work_dir, "results")
+        self.checkpoint_dir = os.path.join(work_dir, "checkpoints")
+        self.lock = threading.Lock()
+        
+        for directory in (self.shard_dir, self.results_dir, self.checkpoint_dir):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+        
+        # The coordination store lives in the shared work directory. Rollback-journal mode rather
+        # than WAL, since WAL needs shared memory that network filesystems do not provide.
+        self.conn = sqlite3.connect(
+            os.path.join(work_dir, "coordinator.sqlite"),
+            check_same_thread=False,
+            isolation_level=None,
+            timeout=busy_timeout
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS shards ("
+            "shard_id INTEGER PRIMARY KEY, name TEXT NOT NULL, question_count INTEGER NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', owner TEXT, lease_expires REAL NOT NULL DEFAULT 0, "
+            "attempts INTEGER NOT NULL DEFAULT 0, completed_at REAL)"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+    
+    def _transaction(self, statements: Callable[[], Any]) -> Any:
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements()
+                self.conn.execute("COMMIT")
+                return result
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+    
+    def shard_path(self, name: str) -> str:
+        return os.path.join(self.shard_dir, f"{name}.jsonl")
+    
+    def result_path(self, name: str) -> str:
+        return os.path.join(self.results_dir, f"{name}.jsonl")
+    
+    def is_split(self) -> bool:
+        with self.lock:
+            return self.conn.execute("SELECT value FROM meta WHERE name = 'split_complete'").fetchone() is not None
+    
+    def split(self, questions: Iterable[Any], shard_size: int) -> int:
+        # Streams the input into shard files, registering each shard as soon as it is written
+        # so workers can start while the rest of the input is still being split.
+        shard_count = 0
+        batch: List[Any] = []
+        
+        def flush() -> None:
+            nonlocal shard_count, batch
+            name = f"shard-{shard_count:06d}"
+            tmp_path = f"{self.shard_path(name)}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write("".join(json.dumps(q, ensure_ascii=False) + "\n" for q in batch))
+            os.replace(tmp_path, self.shard_path(name))
+            count = len(batch)
+            self._transaction(lambda: self.conn.execute(
+                "INSERT OR REPLACE INTO shards (shard_id, name, question_count) VALUES (?, ?, ?)",
+                (shard_count, name, count)
+            ))
+            shard_count += 1
+            batch = []
+        
+        for question in questions:
+            batch.append(question)
+            if len(batch) >= shard_size:
+                flush()
+        if batch:
+            flush()
+        
+        self._transaction(lambda: self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('split_complete', ?)", (str(shard_count),)))
+        return shard_count
+    
+    def lease(self, worker_id: str, ttl: float) -> Optional[Dict[str, Any]]:
+        def take() -> Optional[Dict[str, Any]]:
+            now = time.time()
+            row = self.conn.execute(
+                "SELECT shard_id, name, question_count, attempts FROM shards "
+                "WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY shard_id LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE shards SET status = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE shard_id = ?",
+                (worker_id, now + ttl, row[0])
+            )
+            return {'shard_id': row[0], 'name': row[1], 'question_count': row[2], 'attempts': row[3] + 1}
+        
+        return self._transaction(take)
+    
+    def renew(self, shard_id: int, worker_id: str, ttl: float) -> bool:
+        cursor = self._transaction(lambda: self.conn.execute(
+            "UPDATE shards SET lease_expires = ? WHERE shard_id = ? AND owner = ? AND status = 'leased'",
+            (time.time() + ttl, shard_id, worker_id)
+        ))
+        return cursor.rowcount > 0
+    
+    def complete(self, shard_id: int, worker_id: str) -> bool:
+        cursor = self._transaction(lambda: self.conn.execute(
+            "UPDATE shards SET status = 'done', lease_expires = 0, completed_at = ? WHERE shard_id = ? AND owner = ? AND status = 'leased'",
+            (time.time(), shard_id, worker_id)
+        ))
+        return cursor.rowcount > 0
+    
+    def release(self, shard_id: int, worker_id: str) -> None:
+        self._transaction(lambda: self.conn.execute(
+            "UPDATE shards SET status = 'pending', owner = NULL, lease_expires = 0 WHERE shard_id = ? AND owner = ? AND status = 'leased'",
+            (shard_id, worker_id)
+        ))
+    
+    def get_progress(self) -> Dict[str, Any]:
+        with self.lock:
+            now = time.time()
+            counts = {'pending': 0, 'leased': 0, 'expired': 0, 'done': 0}
+            questions_done = 0
+            for status, expired, count, questions in self.conn.execute(
+                "SELECT status, status = 'leased' AND lease_expires < ?, COUNT(*), SUM(question_count) FROM shards GROUP BY 1, 2",
+                (now,)
+            ):
+                counts['expired' if expired else status] += count
+                if status == 'done':
+                    questions_done += questions or 0
+            workers = [row[0] for row in self.conn.execute(
+                "SELECT DISTINCT owner FROM shards WHERE status = 'leased' AND lease_expires >= ?", (now,)
+            )]
+        
+        return {
+            'split_complete': self.is_split(),
+            'shards': counts,
+            'total_shards': sum(counts.values()),
+            'questions_done': questions_done,
+            'active_workers': workers
+        }
+    
+    def merge(self, output_file: str, output_format: str = "json") -> int:
+        # Concatenates shard results in input order. A shard that was re-leased after a lost lease
+        # may hold a question twice, so duplicates are dropped per shard.
+        journal = output_file if output_format == "jsonl" else os.path.splitext(output_file)[0] + ".jsonl"
+        count = 0
+        with self.lock:
+            names = [row[0] for row in self.conn.execute("SELECT name FROM shards WHERE status = 'done' ORDER BY shard_id")]
+        
+        with open(journal, 'w', encoding='utf-8') as out:
+            for name in names:
+                seen: Set[int] = set()
+                path = self.result_path(name)
+                if not os.path.exists(path):
+                    continue
+                complete = superseded_partials(iter_jsonl(path)) if has_partial_records(path) else set()
+                for record in iter_jsonl(path):
+                    qid = question_id(record)
+                    if qid in seen or (record.get("partial") and qid in complete):
+                        continue
+                    seen.add(qid)
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    count += 1
+        
+        if output_format == "json":
+            compact_jsonl_to_json(journal, output_file)
+        elif output_format == "store":
+            build_result_store(journal, output_file)
+        return count
+    
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+async def run_shard_worker(
+    processor: "GeminiProcessor",
+    coordinator: ShardCoordinator,
+    worker_id: str,
+    lease_ttl: float = 120,
+    poll_interval: float = 5
+) -> int:
+    shards_done = 0
+    
+    while not shutdown_requested:
+        shard = coordinator.lease(worker_id, lease_ttl)
+        if shard is None:
+            progress = coordinator.get_progress()
+            if progress['split_complete'] and progress['shards']['pending'] == 0 and progress['shards']['leased'] == 0 and progress['shards']['expired'] == 0:
+                break
+            await asyncio.sleep(poll_interval)
+            continue
+        
+        name = shard['name']
+        logger.info(f"Worker {worker_id} leased {name} ({shard['question_count']} questions, attempt {shard['attempts']})")
+        processor.configure_output(coordinator.result_path(name), coordinator.checkpoint_dir, output_format="jsonl")
+        processor.stop_requested = False
+        processor.input_file = coordinator.shard_path(name)
+        
+        # A shard taken over from an expired lease continues from the previous worker's checkpoint
+        completed = None
+        resume = os.path.exists(processor.checkpoint_log.wal_path) or os.path.exists(processor.checkpoint_log.snapshot_path)
+        if resume:
+            completed = processor.checkpoint_log.load()
+        
+        async def heartbeat() -> None:
+            while True:
+                await asyncio.sleep(lease_ttl / 3)
+                if not coordinator.renew(shard['shard_id'], worker_id, lease_ttl):
+                    logger.warning(f"Lost lease on {name}, stopping work on it")
+                    processor.stop_requested = True
+                    return
+        
+        renewer = asyncio.create_task(heartbeat())
+        try:
+            await processor.process_questions_async(iter_jsonl(coordinator.shard_path(name)), resume=resume, completed=completed)
+        finally:
+            renewer.cancel()
+            await asyncio.gather(renewer, return_exceptions=True)
+        
+        if processor.stop_requested:
+            continue
+        if shutdown_requested or processor.input_error:
+            coordinator.release(shard['shard_id'], worker_id)
+            break
+        if coordinator.complete(shard['shard_id'], worker_id):
+            shards_done += 1
+            logger.info(f"Worker {worker_id} completed {name}")
+    
+    return shards_done
+
+
+def run_coordinator(
+    coordinator: ShardCoordinator,
+    input_file: str,
+    output_file: str,
+    output_format: str = "json",
+    shard_size: int = 1000,
+    poll_interval: float = 10
+) -> int:
+    if coordinator.is_split():
+        logger.info(f"Input already split in {coordinator.work_dir}, not splitting again")
+    else:
+        logger.info(f"Splitting {input_file} into shards of {shard_size} questions")
+        shard_count = coordinator.split(iter_questions(input_file), shard_size)
+        logger.info(f"Created {shard_count} shards in {coordinator.shard_dir}")
+    
+    while not shutdown_requested:
+        progress = coordinator.get_progress()
+        shards = progress['shards']
+        logger.info(
+            f"Shards: {shards['done']}/{progress['total_shards']} done, {shards['leased']} leased, "
+            f"{shards['expired']} expired, {shards['pending']} pending; "
+            f"{progress['questions_done']} questions done by {len(progress['active_workers'])} active workers"
+        )
+        if shards['done'] == progress['total_shards']:
+            break
+        time.sleep(poll_interval)
+    
+    if shutdown_requested:
+        logger.info("Coordinator stopped before all shards finished; run it again to keep waiting and merge")
+        return 1
+    
+    count = coordinator.merge(output_file, output_format)
+    logger.info(f"Merged {count} results from {progress['total_shards']} shards into {output_file}")
+    return 0
+
+
+def load_pipeline(path: str) -> List[Dict[str, Any]]:
+    # A pipeline file lists the stages each question passes through, in order, e.g.
+    # {"stages": [{"name": "translate", "template": "translate"},
+    #             {"name": "answer", "template": "answer", "concurrency": 10}]}
+    # "template" is a built-in template name or text containing {question}; "template_file" reads it
+    # from a file. Other keys override the command line options of that stage (see PIPELINE_OPTIONS).
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    stages = config.get("stages") if isinstance(config, dict) else None
+    if not isinstance(stages, list) or not stages:
+        raise ValueError(f"No stages in pipeline file {path}")
+    
+    names = set()
+    for stage in stages:
+        if not isinstance(stage, dict) or not isinstance(stage.get("name"), str) or not stage["name"]:
+            raise ValueError(f"Every stage in {path} needs a name")
+        if stage["name"] in names:
+            raise ValueError(f"Duplicate stage name in {path}: {stage['name']}")
+        names.add(stage["name"])
+        unknown = set(stage) - {"name", "template", "template_file"} - set(PIPELINE_OPTIONS)
+        if unknown:
+            raise ValueError(f"Unknown options for stage {stage['name']}: {', '.join(sorted(unknown))}")
+        
+        if "template_file" in stage:
+            with open(stage["template_file"], 'r', encoding='utf-8') as f:
+                stage["template"] = f.read()
+        template = PROMPT_TEMPLATES.get(stage.get("template", stage["name"]), stage.get("template"))
+        try:
+            if template is None or template.format(question="") == template:
+                raise ValueError
+        except (ValueError, KeyError, IndexError):
+            raise ValueError(f"Stage {stage['name']} needs a template containing {{question}} or one of: {', '.join(PROMPT_TEMPLATES)}")
+        stage["template"] = template
+    return stages
+
+
+def build_pipeline(stages: List[Dict[str, Any]], processor_args: Dict[str, Any]) -> List["GeminiProcessor"]:
+    # The last stage writes the usual output file; earlier stages journal to <output>.<stage>.jsonl.
+    # All stages draw on one key scheduler, so they share the per-key rate limits.
+    processors: List[GeminiProcessor] = []
+    base = os.path.splitext(processor_args["output_file"])[0]
+    for i, stage in enumerate(stages):
+        stage_args = dict(processor_args)
+        stage_args.update({option: stage[key] for key, option in PIPELINE_OPTIONS.items() if key in stage})
+        if i < len(stages) - 1:
+            stage_args.update(output_file=f"{base}.{stage['name']}.jsonl", output_format="jsonl")
+        processors.append(GeminiProcessor(
+            prompt_template=stage["template"],
+            key_manager=processors[0].key_manager if processors else None,
+            **stage_args
+        ))
+    return processors
+
+
+def pipeline_item(result: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # The next stage is asked the previous stage's answer. The original question travels along as
+    # source_question, and its ID only when the input gave one.
+    if "error" in result or result.get("response", "").startswith("ERROR:"):
+        return None
+    item = {"question": result["response"], "source_question": result.get("source_question", result["question"])}
+    if result.get("id") is not None:
+        item = {"id": result["id"], **item}
+    return item
+
+
+def iter_pipeline_feed(journal: str, journal_size: int, feed: queue.Queue):
+    # Results the previous stage finished in an earlier run come first (up to the journal's size at
+    # start, since the stage appends to it again), then new ones as soon as they are recorded.
+    if journal_size:
+        with open(journal, 'rb') as f:
+            while f.tell() < journal_size:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    item = pipeline_item(json.loads(line))
+                except ValueError:
+                    continue
+                if item is not None:
+                    yield item
+    
+    while True:
+        try:
+            item = feed.get(timeout=0.5)
+        except queue.Empty:
+            if shutdown_requested:
                 return
+            continue
+        if item is None:
+            return
+        yield item
+
+
+async def run_pipeline(stages: List["GeminiProcessor"], questions: Iterable[Any], resume: bool = False) -> None:
+    # Every stage runs at once with its own template, backend and concurrency limit; a question
+    # moves on as soon as its stage records it, so total time tracks the slowest stage.
+    inputs: List[Iterable[Any]] = [questions]
+    feeds: List[queue.Queue] = []
+    for upstream in stages[:-1]:
+        feed: queue.Queue = queue.Queue()
+        def forward(question: Any, result: Dict[str, Any], feed: queue.Queue = feed) -> None:
+            item = pipeline_item(result)
+            if item is not None:
+                feed.put(item)
+        upstream.on_result = forward
+        journal_size = os.path.getsize(upstream.results_journal) if resume and os.path.exists(upstream.results_journal) else 0
+        inputs.append(iter_pipeline_feed(upstream.results_journal, journal_size, feed))
+        feeds.append(feed)
+    
+    async def run_stage(index: int, stage: GeminiProcessor) -> None:
+        completed = stage.checkpoint_log.load() if resume else None
+        try:
+            await stage.process_questions_async(inputs[index], resume=resume, completed=completed)
+        finally:
+            # The next stage finishes once it has drained everything this stage produced
+            if index < len(feeds):
+                feeds[index].put(None)
+    
+    await asyncio.gather(*(run_stage(i, stage) for i, stage in enumerate(stages)))
+
+
+class JobService:
+    def __init__(self, processor: GeminiProcessor, jobs_dir: str = "jobs", host: str = "127.0.0.1", port: int = 8080):
+        # One warm processor (key scheduler, quota ledger, connection pool, cache) serves every job.
+        # Running jobs take turns a batch at a time, so a large job cannot starve one submitted later.
+        self.processor = processor
+        self.jobs_dir = jobs_dir
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._turn = 0
+        self._tasks: Set[asyncio.Task] = set()
+        service = self
+        
+        if not os.path.exists(jobs_dir):
+            os.makedirs(jobs_dir)
+        
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+            
+            def send_json(self, status: int, payload: Any) -> None:
+                body = json.dumps(payload, ensure_ascii=False, indent=2).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def route(self) -> tuple:
+                url = urlsplit(self.path)
+                return [part for part in url.path.split("/") if part], parse_qs(url.query)
+            
+            def do_GET(self) -> None:
+                path, query = self.route()
+                try:
+                    if path == ["status"]:
+                        self.send_json(200, service.processor.get_progress())
+                    elif path == ["jobs"]:
+                        self.send_json(200, {"jobs": service.list_jobs()})
+                    elif len(path) in (2, 3) and path[0] == "jobs" and path[2:] in ([], ["results"]):
+                        job = service.get_job(path[1])
+                        if job is None:
+                            self.send_json(404, {"error": f"Unknown job: {path[1]}"})
+                        elif len(path) == 2:
+                            self.send_json(200, job)
+                        else:
+                            # No Content-Length: the response ends when the connection closes
+                            self.send_response(200)
+                            self.send_header("Content-Type", "application/x-ndjson")
+                            self.end_headers()
+                            follow = query.get("follow", ["0"])[0] not in ("0", "false", "")
+                            service.stream_results(path[1], self.wfile, follow=follow)
+                    else:
+                        self.send_json(404, {"error": "Not found"})
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                except Exception as e:
+                    logger.error(f"Error handling GET {self.path}: {e}")
             
-            remaining_questions = [q for q in questions_data["questions"] if q not in processed_questions]
+            def do_POST(self) -> None:
+                path, _ = self.route()
+                if path != ["jobs"]:
+                    self.send_json(404, {"error": "Not found"})
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                    job = service.submit(json.loads(self.rfile.read(length) or b"{}"))
+                except ValueError as e:
+                    self.send_json(400, {"error": str(e)})
+                    return
+                except Exception as e:
+                    logger.error(f"Error submitting job: {e}")
+                    self.send_json(500, {"error": str(e)})
+                    return
+                self.send_json(201, job)
             
-            logger.info(f"Resuming processing with {len(remaining_questions)} remaining questions")
-            logger.info(f"Loaded {len(self.results)} previously processed results")
+            def do_DELETE(self) -> None:
+                path, _ = self.route()
+                job = service.cancel(path[1]) if len(path) == 2 and path[0] == "jobs" else None
+                if job is None:
+                    self.send_json(404, {"error": "Not found"})
+                else:
+                    self.send_json(202, job)
+        
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="job-server", daemon=True)
+    
+    @staticmethod
+    def _public(job: Dict[str, Any]) -> Dict[str, Any]:
+        return {k: v for k, v in job.items() if not k.startswith("_")}
+    
+    def list_jobs(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return [self._public(job) for job in sorted(jobs, key=lambda job: job['created'])]
+    
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            job = self.jobs.get(job_id)
+        return self._public(job) if job is not None else None
+    
+    def _save_job(self, job: Dict[str, Any]) -> None:
+        path = os.path.join(self.jobs_dir, job['id'], "job.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._public(job), f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    
+    @staticmethod
+    def _new_job(job_id: str, name: str, input_file: str) -> Dict[str, Any]:
+        # Underscored fields are runtime state and are neither persisted nor served; every field
+        # exists from the start so request threads can copy a job while the loop updates it.
+        return {
+            "id": job_id,
+            "name": name,
+            "input_file": input_file,
+            "status": "queued",
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+            "total": 0,
+            "processed": 0,
+            "successful": 0,
+            "errors": 0,
+            "skipped": 0,
+            "in_flight": 0,
+            "input_complete": False,
+            "error": None,
+            "_queue": None,
+            "_stop": None,
+            "_writer": None,
+            "_checkpoint": None
+        }
+    
+    def submit(self, request: Any) -> Dict[str, Any]:
+        # Called on a request thread; the job is handed to the event loop once its files exist
+        if not isinstance(request, dict):
+            raise ValueError("Expected a JSON object")
+        questions = request.get("questions")
+        input_file = request.get("input_file")
+        if (questions is None) == (input_file is None):
+            raise ValueError('Give either "input_file" or a "questions" list')
+        if questions is not None and (not isinstance(questions, list) or not questions):
+            raise ValueError('"questions" must be a non-empty list')
+        if input_file is not None and not os.path.isfile(input_file):
+            raise ValueError(f"Input file not found: {input_file}")
+        
+        job_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.urandom(3).hex()}"
+        job_dir = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(job_dir)
+        if questions is not None:
+            # Submitted questions are written out so the job survives a restart of the service
+            input_file = os.path.join(job_dir, "input.jsonl")
+            with open(input_file, 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps(q, ensure_ascii=False) + "\n" for q in questions)
+        
+        job = self._new_job(job_id, str(request.get("name") or job_id), os.path.abspath(input_file))
+        self._save_job(job)
+        with self.lock:
+            self.jobs[job_id] = job
+        self.loop.call_soon_threadsafe(self._start_job, job, False)
+        logger.info(f"Accepted job {job_id} ({job['name']}) reading {job['input_file']}")
+        return self._public(job)
+    
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        self.loop.call_soon_threadsafe(self._cancel, job)
+        return self._public(job)
+    
+    def _cancel(self, job: Dict[str, Any]) -> None:
+        if job['status'] in ("queued", "running"):
+            # Requests already sent still finish and are kept; nothing new is taken from the input
+            job['status'] = "cancelling"
+            job['input_complete'] = True
+            if job['_stop'] is not None:
+                job['_stop'].set()
+            logger.info(f"Cancelling job {job['id']}")
+            self._maybe_finish(job)
+    
+    def _start_job(self, job: Dict[str, Any], resume: bool) -> None:
+        if job['status'] != "queued" and not resume:
+            return
+        job_dir = os.path.join(self.jobs_dir, job['id'])
+        try:
+            checkpoint = CheckpointLog(job_dir, "results")
+            completed = None
+            if resume:
+                checkpoint.load()
+                # Only questions completed before this start are skipped: the live log also gains this
+                # run's results, which would drop every repeat of a question within the same input
+                completed = CheckpointLog(job_dir, "results").load()
+            job['_checkpoint'] = checkpoint
+            job['_writer'] = ResultWriter(
+                os.path.join(job_dir, "results.jsonl"),
+                append=resume,
+                checkpoint=checkpoint,
+                fsync_interval=self.processor.fsync_interval,
+                metrics=self.processor.metrics
+            )
+            job['_queue'] = asyncio.Queue(maxsize=self.processor.queue_size)
+            job['_stop'] = threading.Event()
+            threading.Thread(target=self._produce, args=(job, completed), name=f"job-{job['id']}-reader", daemon=True).start()
+        except Exception as e:
+            logger.error(f"Error starting job {job['id']}: {e}")
+            job['status'] = "failed"
+            job['error'] = str(e)
+            self._save_job(job)
+            return
+        
+        job['status'] = "running"
+        job['started'] = job['started'] or time.time()
+        self._wake.set()
+    
+    def _load_jobs(self) -> None:
+        # Jobs left unfinished by a previous service continue from their checkpoint logs
+        for job_id in sorted(os.listdir(self.jobs_dir)):
+            path = os.path.join(self.jobs_dir, job_id, "job.json")
+            if not os.path.exists(path):
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    job = {**self._new_job(job_id, job_id, ""), **json.load(f)}
+            except Exception as e:
+                logger.error(f"Error loading job {job_id}: {e}")
+                continue
             
-            self.process_questions(remaining_questions)
+            with self.lock:
+                self.jobs[job_id] = job
+            if job['status'] in ("queued", "running", "cancelling", "finishing"):
+                logger.info(f"Resuming job {job_id} ({job['name']})")
+                job.update(status="queued", total=0, processed=0, successful=0, errors=0, skipped=0, in_flight=0, input_complete=False)
+                self._start_job(job, True)
+    
+    def _next_batch(self) -> tuple:
+        with self.lock:
+            running = [job for job in self.jobs.values() if job['status'] == "running" and not job['input_complete']]
+        for offset in range(len(running)):
+            job = running[(self._turn + offset) % len(running)]
+            batch = self._take(job, self.processor.pack_size)
+            if batch:
+                self._turn += offset + 1
+                return job, batch
+        return None, []
+    
+    def _produce(self, job: Dict[str, Any], completed: Optional[CheckpointLog]) -> None:
+        # Reads the job's input on its own thread into a bounded queue, the way the CLI's producer
+        # does, so a slow or large input file never blocks the event loop or the other jobs
+        async def feed(item: Any) -> None:
+            await job['_queue'].put(item)
+            self._wake.set()
+        
+        def put(item: Any) -> bool:
+            future = asyncio.run_coroutine_threadsafe(feed(item), self.loop)
+            while True:
+                try:
+                    future.result(timeout=0.5)
+                    return True
+                except concurrent.futures.TimeoutError:
+                    if job['_stop'].is_set() or shutdown_requested:
+                        future.cancel()
+                        return False
+        
+        try:
+            for question in iter_questions(job['input_file']):
+                if job['_stop'].is_set() or shutdown_requested:
+                    return
+                if completed is not None and question_id(question) in completed:
+                    job['skipped'] += 1
+                    continue
+                if not put(question):
+                    return
         except Exception as e:
-            logger.error(f"Error resuming from checkpoint: {e}")
+            logger.error(f"Error reading questions for job {job['id']}: {e}")
+            job['error'] = str(e)
+        put(None)
+    
+    def _take(self, job: Dict[str, Any], count: int) -> List[Any]:
+        # Never waits: a job whose reader has nothing queued yet gives its turn to the next job
+        batch = []
+        while len(batch) < count:
+            try:
+                question = job['_queue'].get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if question is None:
+                job['input_complete'] = True
+                break
+            batch.append(question)
+        
+        job['total'] += len(batch)
+        job['in_flight'] += len(batch)
+        with processing_lock:
+            self.processor.total_count += len(batch)
+        self._maybe_finish(job)
+        return batch
+    
+    def _spawn(self, coro: Awaitable[None]) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _run(self, job: Dict[str, Any], batch: List[Any], retry_delay: Optional[float] = None) -> None:
+        processor = self.processor
+        limiter = processor.concurrency_limiter
+        # Fresh batches come with a slot the main loop acquired; retries wait for theirs here
+        acquired = retry_delay is None
+        try:
+            if retry_delay is not None:
+                await processor.retry_queue.wait(retry_delay)
+                await limiter.acquire(priority=True)
+                acquired = True
+            processor.in_flight += len(batch)
+            if job['status'] != "running":
+                return
+            batch_start = time.time()
+            results = await processor.process_question_batch(batch)
+            completed_count = 0
+            for question, result in zip(batch, results):
+                retry = result.pop("retry", None)
+                if processor._should_stop():
+                    # Left out of the checkpoint log, so the job asks again after a restart
+                    if retry is not None or result["response"] == "ERROR: Processing interrupted":
+                        continue
+                if retry is not None:
+                    if job['status'] == "running":
+                        processor.retry_attempts[question_text(question)] = retry.attempts
+                        job['in_flight'] += 1
+                        self._spawn(self._run(job, [question], retry_delay=retry.delay))
+                    continue
+                processor.retry_attempts.pop(result["question"], None)
+                self._record(job, question, result)
+                completed_count += 1
+            if processor.metrics is not None:
+                processor.metrics.observe_stage("question", time.time() - batch_start)
+                processor.metrics.record_completions(completed_count)
+        except Exception as e:
+            logger.error(f"Error processing question result for job {job['id']}: {e}")
+        finally:
+            job['in_flight'] -= len(batch)
+            if acquired:
+                processor.in_flight -= len(batch)
+                limiter.release()
+            self._maybe_finish(job)
+    
+    def _record(self, job: Dict[str, Any], question: Any, result: Dict[str, Any]) -> None:
+        job['_writer'].write(result, question_id(question))
+        job['processed'] += 1
+        if "error" in result or result["response"].startswith("ERROR:"):
+            job['errors'] += 1
+        else:
+            job['successful'] += 1
+        with processing_lock:
+            self.processor.processed_count += 1
+    
+    def _maybe_finish(self, job: Dict[str, Any]) -> None:
+        if not job['input_complete'] or job['in_flight'] > 0 or job['status'] not in ("running", "cancelling"):
+            return
+        if shutdown_requested:
+            # Retries cancelled by a shutdown also empty the job; it is resumed, not finished
+            return
+        if job['error']:
+            status = "failed"
+        elif job['status'] == "cancelling":
+            status = "cancelled"
+        else:
+            status = "completed"
+        # Readers following the results only see the final status once every line is on disk
+        job['status'] = "finishing"
+        self.loop.run_in_executor(None, self._close_job, job, status)
+    
+    def _close_job(self, job: Dict[str, Any], status: str) -> None:
+        try:
+            job['_writer'].close()
+            if status == "completed":
+                job['_checkpoint'].compact()
+            job['_checkpoint'].close()
+            job['finished'] = time.time()
+            job['status'] = status
+            self._save_job(job)
+            elapsed = job['finished'] - job['started']
+            logger.info(f"Job {job['id']} {status}: {job['successful']} successful, {job['errors']} errors, {job['skipped']} skipped in {self.processor._format_time(elapsed)}")
+        except Exception as e:
+            logger.error(f"Error finishing job {job['id']}: {e}")
+    
+    def stream_results(self, job_id: str, out: Any, follow: bool = False) -> None:
+        # Sends complete lines only; with follow, keeps sending new results until the job has ended
+        path = os.path.join(self.jobs_dir, job_id, "results.jsonl")
+        position = 0
+        while True:
+            with self.lock:
+                ended = self.jobs[job_id]['status'] in ("completed", "cancelled", "failed")
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    f.seek(position)
+                    lines = []
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            break
+                        lines.append(line)
+                        position += len(line)
+                        if len(lines) >= 256:
+                            out.write(b"".join(lines))
+                            lines = []
+                    if lines:
+                        out.write(b"".join(lines))
+            if ended or not follow or shutdown_requested:
+                return
+            time.sleep(0.5)
+    
+    async def run(self) -> None:
+        processor = self.processor
+        limiter = processor.concurrency_limiter
+        self.loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        with processing_lock:
+            processor.is_processing = True
+            processor.defer_retries = True
+            processor.start_time = time.time()
+        if processor.local_backend is not None:
+            slots = await processor.local_backend.detect_slots(processor._get_client())
+            logger.info(f"Overflowing to local backend {processor.local_backend.base_url} with {slots} parallel slots when no API key is free")
+        
+        self._load_jobs()
+        self.thread.start()
+        host, port = self.httpd.server_address[:2]
+        logger.info(f"Serving jobs at http://{host}:{port}/jobs with {processor.key_manager.get_stats()['total_keys']} API keys")
+        
+        try:
+            while not shutdown_requested:
+                job, batch = self._next_batch()
+                if job is None:
+                    self._wake.clear()
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), timeout=0.5)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                
+                limiter_start = time.time()
+                await processor.retry_queue.wait_for_room(processor.queue_size)
+                await limiter.acquire()
+                if processor.metrics is not None:
+                    processor.metrics.observe_stage("concurrency_wait", time.time() - limiter_start)
+                self._spawn(self._run(job, batch))
+        finally:
+            logger.info("Stopping job service; unfinished jobs resume when it starts again")
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+            for job in list(self.jobs.values()):
+                if job['_stop'] is not None:
+                    job['_stop'].set()
+                if job['_writer'] is not None and job['status'] in ("running", "cancelling"):
+                    # A batch task cancelled before it first ran never reached its finally block
+                    job['in_flight'] = 0
+                    job['_writer'].close()
+                    job['_checkpoint'].close()
+                    self._save_job(job)
+            await processor.aclose()
+            with processing_lock:
+                processor.is_processing = False
+                processor.defer_retries = False
 
 
 def handle_shutdown(signum, frame):
@@ -502,15 +4696,133 @@ def load_api_keys_from_txt(filename: str) -> List[str]:
         return []
 
 
+def log_sample_arg(spec: str) -> tuple:
+    # "question=0.01" keeps one in a hundred "question" events
+    event, _, fraction = spec.partition("=")
+    if not event or not fraction:
+        raise argparse.ArgumentTypeError(f"expected EVENT=FRACTION, got {spec!r}")
+    return event, float(fraction)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Process questions through Gemini API using multiple API keys")
-    parser.add_argument("--input", default="english_questions.json", help="Input JSON file containing questions")
+    parser.add_argument("--input", default="english_questions.json",
+                    help="Input file: JSON with a \"questions\" list, or .jsonl with one question (string or object) per line")
     parser.add_argument("--output", default="results.json", help="Output JSON file for results")
+    parser.add_argument("--output-format", choices=["json", "jsonl", "store"], default="json",
+                    help="json: stream to a .jsonl journal and compact into --output at the end; jsonl: write --output as JSONL only; "
+                         "store: like json, but --output is a directory of compressed, indexed shards (see --read-store)")
+    parser.add_argument("--fsync-interval", type=float, default=5.0,
+                    help="Seconds between fsync calls on the streaming results file")
     parser.add_argument("--api-keys", default="api_keys.txt", help="Text file containing API keys (one per line)")
     parser.add_argument("--system-prompt", default="telugu_prompt.txt", help="File containing system prompt")
-    parser.add_argument("--concurrency", type=int, default=5, help="Number of concurrent requests")
+    parser.add_argument("--concurrency", type=int, default=5,
+                    help="Number of concurrent requests (the starting limit with --adaptive-concurrency)")
+    parser.add_argument("--adaptive-concurrency", action="store_true",
+                    help="Raise the concurrency limit while requests succeed and halve it on 429s or latency spikes")
+    parser.add_argument("--min-concurrency", type=int, default=1, help="Lower bound for --adaptive-concurrency")
+    parser.add_argument("--max-concurrency", type=int, default=None,
+                    help="Upper bound for --adaptive-concurrency (default: 10 x --concurrency)")
+    parser.add_argument("--queue-size", type=int, default=None,
+                    help="Questions read ahead of dispatch (default: max(2 x concurrency, 100))")
+    parser.add_argument("--pack-size", type=int, default=1,
+                    help="Questions packed into one request with a structured JSON response (1 disables packing)")
+    parser.add_argument("--max-connections", type=int, default=100,
+                    help="Maximum pooled keep-alive HTTP connections shared by all API keys")
+    parser.add_argument("--rpm-limit", type=int, default=9, help="Requests per minute allowed per API key")
+    parser.add_argument("--daily-limit", type=int, default=1450, help="Requests per day allowed per API key")
+    parser.add_argument("--quota-ledger", default="quota_ledger.sqlite",
+                    help="SQLite file recording per-key usage, shared across runs and processes on this host")
+    parser.add_argument("--no-quota-ledger", action="store_true", help="Keep per-key usage in memory only")
+    parser.add_argument("--request-timeout", type=float, default=120,
+                    help="Seconds before a request is abandoned and retried (between chunks with --stream)")
+    parser.add_argument("--connect-timeout", type=float, default=10, help="Seconds allowed for opening a connection")
+    parser.add_argument("--hedge", action="store_true",
+                    help="Send a duplicate request on another key when one runs past the --hedge-quantile latency")
+    parser.add_argument("--hedge-quantile", type=float, default=0.95, help="Latency quantile of recent requests that triggers a hedge")
+    parser.add_argument("--hedge-budget", type=float, default=0.05,
+                    help="Maximum hedged requests as a fraction of all requests sent")
+    parser.add_argument("--tpm-limit", type=int, default=None,
+                    help="Tokens per minute allowed per API key; requests are admitted against it using local estimates")
+    parser.add_argument("--expected-output-tokens", type=int, default=1024,
+                    help="Starting estimate of output tokens per answer, refined from real responses")
+    parser.add_argument("--input-token-price", type=float, default=0.10, help="USD per million prompt tokens, for the cost report")
+    parser.add_argument("--output-token-price", type=float, default=0.40, help="USD per million output tokens, for the cost report")
+    parser.add_argument("--key-wait-timeout", type=float, default=600,
+                    help="Seconds a request may wait for a free API key before failing")
+    parser.add_argument("--max-retries", type=int, default=5, help="Attempts per question before it is recorded as an error")
+    parser.add_argument("--retry-base-delay", type=float, default=2.0,
+                    help="Backoff before the first retry of a failed request; doubles per attempt, with jitter")
+    parser.add_argument("--retry-max-delay", type=float, default=30.0, help="Upper bound for the retry backoff")
+    parser.add_argument("--cache-db", default="response_cache.sqlite",
+                    help="SQLite file caching successful responses across runs")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the persistent response cache")
+    parser.add_argument("--cache-max-age-days", type=float, default=30,
+                    help="Evict cached responses older than this many days")
+    parser.add_argument("--cache-max-mb", type=float, default=1024,
+                    help="Evict least recently used cached responses beyond this size")
+    parser.add_argument("--local-backend", metavar="URL", default=None,
+                    help="OpenAI-compatible server (e.g. llama-server at http://127.0.0.1:8080) that takes requests whenever no API key is free")
+    parser.add_argument("--local-model", default="local", help="Model name sent to --local-backend")
+    parser.add_argument("--local-slots", type=int, default=None,
+                    help="Parallel requests for --local-backend (default: total_slots from its /props endpoint)")
+    parser.add_argument("--local-max-tokens", type=int, default=None, help="max_tokens for --local-backend requests")
+    parser.add_argument("--stream", action="store_true",
+                    help="Use streamGenerateContent: answers arrive in chunks and interrupted answers are saved marked as partial (single-question requests only)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                    help="Serve live metrics on this port (/metrics in Prometheus format, /metrics.json)")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="Address for the metrics endpoint")
+    parser.add_argument("--api-url", default=GEMINI_API_URL,
+                    help="generateContent endpoint, e.g. a local mock_gemini_server.py for testing")
+    parser.add_argument("--profile", action="store_true",
+                    help="Time every processing stage and lock wait, and write a summary when the run ends")
+    parser.add_argument("--profile-output", default="profile_summary.json", help="Where --profile writes its summary")
+    parser.add_argument("--profile-stacks", metavar="FILE", default=None,
+                    help="With --profile, also sample all thread stacks into FILE (collapsed format for flame graphs)")
+    parser.add_argument("--profile-interval", type=float, default=0.005, help="Seconds between stack samples for --profile-stacks")
+    parser.add_argument("--pipeline", metavar="FILE",
+                    help="JSON file of stages (e.g. translate, then answer) that every question passes through, with stages running side by side")
+    parser.add_argument("--dedupe", action="store_true",
+                    help="Cluster near-duplicate questions (MinHash/LSH on normalized text) before dispatch and send one per cluster")
+    parser.add_argument("--dedupe-threshold", type=float, default=0.9,
+                    help="Estimated Jaccard similarity of character shingles at which two questions are near duplicates")
+    parser.add_argument("--dedupe-send-all", action="store_true",
+                    help="With --dedupe, still send every question and only record the clusters in the results")
+    parser.add_argument("--dedupe-workers", type=int, default=None, help="Processes computing --dedupe signatures (default: CPU count)")
+    parser.add_argument("--validate", action="store_true",
+                    help="Check every answer (finish reason, length, Telugu script, JSON) and requeue unusable ones")
+    parser.add_argument("--min-response-chars", type=int, default=20, help="With --validate, shortest acceptable answer")
+    parser.add_argument("--min-telugu-ratio", type=float, default=0.5,
+                    help="With --validate, minimum share of letters in the answer that are Telugu (0 disables the check)")
+    parser.add_argument("--expect-json", action="store_true", help="With --validate, answers must parse as JSON")
+    parser.add_argument("--validation-retries", type=int, default=2,
+                    help="Times an answer that fails validation is asked again, separate from --max-retries")
+    parser.add_argument("--validation-workers", type=int, default=2,
+                    help="Processes running the validation checks (0 runs them on the event loop)")
+    parser.add_argument("--log-file", default="gemini_processor.log", help="Log file (an empty string logs to the console only)")
+    parser.add_argument("--log-format", choices=["json", "text"], default="json",
+                    help="Log file format: one JSON event per line, or the same text lines as the console")
+    parser.add_argument("--log-rate-limit", type=float, default=20,
+                    help="Log records per second allowed for each event (e.g. no_keys, retry) before the rest are counted and dropped; 0 disables")
+    parser.add_argument("--log-sample", type=log_sample_arg, action="append", default=[], metavar="EVENT=FRACTION",
+                    help="Keep only this fraction of an event's log records, e.g. question=0.01 (repeatable)")
     parser.add_argument("--checkpoint-dir", default="checkpoints", help="Directory for checkpoints")
-    parser.add_argument("--resume", help="Resume from checkpoint file")
+    parser.add_argument("--resume", help="Resume from a checkpoint name in --checkpoint-dir (defaults to the --output file name, e.g. 'results')")
+    parser.add_argument("--coordinate", metavar="WORK_DIR",
+                    help="Split --input into shards in a shared WORK_DIR, wait for workers and merge their results into --output")
+    parser.add_argument("--worker", metavar="WORK_DIR", help="Lease and process shards from a shared WORK_DIR")
+    parser.add_argument("--worker-index", type=int, default=0,
+                    help="This worker's index; it uses every --worker-count'th API key starting here")
+    parser.add_argument("--worker-count", type=int, default=1, help="Number of workers sharing the API key file")
+    parser.add_argument("--shard-size", type=int, default=1000, help="Questions per shard in --coordinate mode")
+    parser.add_argument("--lease-ttl", type=float, default=120, help="Seconds a shard lease lasts without a heartbeat")
+    parser.add_argument("--serve", metavar="PORT", type=int, default=None,
+                    help="Run as a service: accept jobs over HTTP (POST /jobs) and process them with shared keys and connections")
+    parser.add_argument("--serve-host", default="127.0.0.1", help="Address for --serve")
+    parser.add_argument("--jobs-dir", default="jobs", help="Directory holding each --serve job's input, results and checkpoint log")
+    parser.add_argument("--read-store", metavar="STORE_DIR",
+                    help="Read a result store written with --output-format store: print the record for --lookup, or export it to --output as JSON")
+    parser.add_argument("--lookup", metavar="QUESTION", help="Question text or id to look up with --read-store")
     parser.add_argument("--sample-only", action="store_true", 
                     help="Save a sample request and exit without processing questions")
     parser.add_argument("--save-sample", action="store_true", help="Save a sample request to sample_request.txt")
@@ -523,119 +4835,255 @@ def main():
 
     
     args = parser.parse_args()
+    if args.dedupe and (args.serve is not None or args.worker or args.coordinate):
+        # Clusters are computed up front for a single processor reading --input, which these modes do not use
+        parser.error("--dedupe cannot be combined with --serve, --worker or --coordinate")
+    configure_logging(args.log_file, args.log_format, args.log_rate_limit, dict(args.log_sample), force=True)
     
     signal.signal(signal.SIGINT, handle_shutdown)
     signal.signal(signal.SIGTERM, handle_shutdown)
     
     try:
+        if args.read_store:
+            store = ResultStore(args.read_store)
+            try:
+                if args.lookup is None:
+                    count = store.export_json(args.output)
+                    logger.info(f"Exported {count} results from {args.read_store} to {args.output}")
+                    return 0
+                record = store.get(args.lookup)
+                if record is None:
+                    logger.error(f"No result for {args.lookup!r} in {args.read_store}")
+                    return 1
+                print(json.dumps(record, indent=2, ensure_ascii=False))
+                return 0
+            finally:
+                store.close()
+        
+        # The coordinator only splits and merges shards; it never calls the API
+        if args.coordinate:
+            return run_coordinator(
+                ShardCoordinator(args.coordinate),
+                args.input,
+                args.output,
+                output_format=args.output_format,
+                shard_size=args.shard_size
+            )
+        
         # Load API keys from text file
         api_keys = load_api_keys_from_txt(args.api_keys)
         if not api_keys:
             logger.error("No API keys found in the specified file")
             return 1
         
+        if args.worker:
+            # Workers get disjoint slices of the key pool so they never compete for the same quota
+            if not 0 <= args.worker_index < args.worker_count:
+                logger.error(f"Worker index {args.worker_index} out of range (0-{args.worker_count - 1})")
+                return 1
+            api_keys = api_keys[args.worker_index::args.worker_count]
+            if not api_keys:
+                logger.error("No API keys left for this worker")
+                return 1
+            logger.info(f"Worker {args.worker_index}/{args.worker_count} using {len(api_keys)} API keys")
+        
         # Handle sample-only mode
         if args.sample_only:
             logger.info("Sample-only mode: Creating sample request and exiting")
-            with open(args.input, 'r', encoding='utf-8') as f:
-                questions_data = json.load(f)
-                if questions_data.get("questions") and len(questions_data["questions"]) > 0:
-                    # Create a temporary processor just to save the sample
-                    sample_processor = GeminiProcessor(
-                        api_keys=api_keys[:1],  # Just need one key for the sample
-                        system_prompt_file=args.system_prompt,
-                        output_file=args.output,
-                        checkpoint_dir=args.checkpoint_dir,
-                        save_sample_request=True
-                    )
-                    sample_question = questions_data["questions"][0]
-                    # Save the sample without making an actual API call
-                    sample_processor._save_sample_request(sample_question, "SAMPLE_API_KEY")
-                    logger.info("Sample request saved to sample_request.txt. Exiting as requested.")
-                    return 0
-                else:
-                    logger.error("No questions found to create sample request")
-                    return 1
+            sample_question = next(iter_questions(args.input), None)
+            if sample_question is not None:
+                # Create a temporary processor just to save the sample
+                sample_processor = GeminiProcessor(
+                    api_keys=api_keys[:1],  # Just need one key for the sample
+                    system_prompt_file=args.system_prompt,
+                    output_file=args.output,
+                    checkpoint_dir=args.checkpoint_dir,
+                    save_sample_request=True,
+                    api_url=args.api_url
+                )
+                # Save the sample without making an actual API call
+                sample_processor._save_sample_request(question_text(sample_question), "SAMPLE_API_KEY")
+                logger.info("Sample request saved to sample_request.txt. Exiting as requested.")
+                return 0
+            else:
+                logger.error("No questions found to create sample request")
+                return 1
         
 
         if args.test_one:
             logger.info("Test-one mode: Processing a single question")
-            with open(args.input, 'r', encoding='utf-8') as f:
-                questions_data = json.load(f)
-                if not questions_data.get("questions") or not isinstance(questions_data["questions"], list):
-                    logger.error("Invalid questions format in input file")
-                    return 1
+            # Make sure the index is valid
+            if args.question_index < 0:
+                logger.error(f"Question index {args.question_index} out of range")
+                return 1
                     
-                # Make sure the index is valid
-                if args.question_index < 0 or args.question_index >= len(questions_data["questions"]):
-                    logger.error(f"Question index {args.question_index} out of range (0-{len(questions_data['questions'])-1})")
-                    return 1
+            # Only reads the input up to the selected question
+            selected_question = next(itertools.islice(iter_questions(args.input), args.question_index, None), None)
+            if selected_question is None:
+                logger.error(f"Question index {args.question_index} out of range")
+                return 1
+            selected_question = question_text(selected_question)
                     
-                # Make sure we have at least one API key
-                if args.api_key_index < 0 or args.api_key_index >= len(api_keys):
-                    logger.error(f"API key index {args.api_key_index} out of range (0-{len(api_keys)-1})")
-                    return 1
+            # Make sure we have at least one API key
+            if args.api_key_index < 0 or args.api_key_index >= len(api_keys):
+                logger.error(f"API key index {args.api_key_index} out of range (0-{len(api_keys)-1})")
+                return 1
                     
-                # Get the selected question and API key
-                selected_question = questions_data["questions"][args.question_index]
-                selected_api_key = api_keys[args.api_key_index]
+            # Get the selected API key
+            selected_api_key = api_keys[args.api_key_index]
                 
-                logger.info(f"Testing with question {args.question_index}: {selected_question}")
-                logger.info(f"Using API key index {args.api_key_index}: {selected_api_key[:8]}...")
+            logger.info(f"Testing with question {args.question_index}: {selected_question}")
+            logger.info(f"Using API key index {args.api_key_index}: {selected_api_key[:8]}...")
                 
-                # Create a temporary processor
-                test_processor = GeminiProcessor(
-                    api_keys=[selected_api_key],  # Just use one key
-                    system_prompt_file=args.system_prompt,
-                    output_file=args.output,
-                    save_sample_request=args.save_sample
-                )
+            # Create a temporary processor
+            test_processor = GeminiProcessor(
+                api_keys=[selected_api_key],  # Just use one key
+                system_prompt_file=args.system_prompt,
+                output_file=args.output,
+                save_sample_request=args.save_sample,
+                api_url=args.api_url,
+                stream=args.stream
+            )
                 
-                # Process the single question
-                try:
-                    logger.info("Sending request to Gemini API...")
-                    response = asyncio.run(test_processor.make_gemini_request(selected_question, selected_api_key))
+            # Process the single question
+            try:
+                logger.info("Sending request to Gemini API...")
+                response = asyncio.run(test_processor.run_single_request(selected_question, selected_api_key))
                     
-                    logger.info("Response received:")
-                    logger.info("-" * 40)
-                    logger.info(response)
-                    logger.info("-" * 40)
+                logger.info("Response received:")
+                logger.info("-" * 40)
+                logger.info(response)
+                logger.info("-" * 40)
                     
-                    # Save to a simple result file
-                    with open("test_result.json", "w", encoding="utf-8") as f:
-                        json.dump({
-                            "question": selected_question,
-                            "response": response,
-                            "api_key": selected_api_key[:8] + "..."  # Truncate for safety
-                        }, f, indent=2, ensure_ascii=False)
+                # Save to a simple result file
+                with open("test_result.json", "w", encoding="utf-8") as f:
+                    json.dump({
+                        "question": selected_question,
+                        "response": response,
+                        "api_key": selected_api_key[:8] + "..."  # Truncate for safety
+                    }, f, indent=2, ensure_ascii=False)
                     
-                    logger.info("Result saved to test_result.json")
-                    return 0
+                logger.info("Result saved to test_result.json")
+                return 0
                     
-                except Exception as e:
-                    logger.error(f"Error processing test question: {e}")
-                    return 1
+            except Exception as e:
+                logger.error(f"Error processing test question: {e}")
+                return 1
         
         # Normal processing mode
-        processor = GeminiProcessor(
+        processor_args = dict(
             api_keys=api_keys,
             system_prompt_file=args.system_prompt,
             output_file=args.output,
             checkpoint_dir=args.checkpoint_dir,
             concurrency=args.concurrency,
-            save_sample_request=args.save_sample
+            max_retries=args.max_retries,
+            save_sample_request=args.save_sample,
+            max_connections=args.max_connections,
+            rpm_limit=args.rpm_limit,
+            daily_limit=args.daily_limit,
+            key_wait_timeout=args.key_wait_timeout,
+            quota_ledger_path=None if args.no_quota_ledger else args.quota_ledger,
+            output_format=args.output_format,
+            fsync_interval=args.fsync_interval,
+            queue_size=args.queue_size,
+            pack_size=args.pack_size,
+            adaptive_concurrency=args.adaptive_concurrency,
+            min_concurrency=args.min_concurrency,
+            max_concurrency=args.max_concurrency,
+            cache_path=None if args.no_cache else args.cache_db,
+            cache_max_age=args.cache_max_age_days * 24 * 60 * 60,
+            cache_max_bytes=int(args.cache_max_mb * 1024 * 1024),
+            api_url=args.api_url,
+            collect_metrics=args.metrics_port is not None,
+            stream=args.stream,
+            local_backend=OpenAICompatibleBackend(
+                args.local_backend,
+                model=args.local_model,
+                slots=args.local_slots,
+                max_tokens=args.local_max_tokens
+            ) if args.local_backend else None,
+            retry_base_delay=args.retry_base_delay,
+            retry_max_delay=args.retry_max_delay,
+            tpm_limit=args.tpm_limit,
+            expected_output_tokens=args.expected_output_tokens,
+            input_token_price=args.input_token_price,
+            output_token_price=args.output_token_price,
+            request_timeout=args.request_timeout,
+            connect_timeout=args.connect_timeout,
+            hedge=args.hedge,
+            hedge_quantile=args.hedge_quantile,
+            hedge_budget=args.hedge_budget,
+            profile=args.profile,
+            validation={
+                "min_chars": args.min_response_chars,
+                "min_script_ratio": args.min_telugu_ratio,
+                "expect_json": args.expect_json
+            } if args.validate else None,
+            validation_retries=args.validation_retries,
+            validation_workers=args.validation_workers
         )
         
-        if args.resume:
-            processor.resume_from_checkpoint(args.resume)
+        if args.pipeline:
+            try:
+                stages = load_pipeline(args.pipeline)
+            except Exception as e:
+                logger.error(f"Error loading pipeline {args.pipeline}: {e}")
+                return 1
+            pipeline = build_pipeline(stages, processor_args)
+            logger.info(f"Pipeline stages: {' -> '.join(stage['name'] for stage in stages)}")
+            # The metrics endpoint, the profile and the final summary follow the last stage
+            processor = pipeline[-1]
         else:
-            with open(args.input, 'r', encoding='utf-8') as f:
-                questions_data = json.load(f)
-                if not questions_data.get("questions") or not isinstance(questions_data["questions"], list):
-                    logger.error("Invalid questions format in input file")
-                    return 1
-                
-                processor.process_questions(questions_data["questions"])
+            pipeline = []
+            processor = GeminiProcessor(**processor_args)
+        
+        if args.metrics_port is not None:
+            try:
+                MetricsServer(processor, args.metrics_host, args.metrics_port).start()
+            except Exception as e:
+                logger.error(f"Error starting metrics endpoint on port {args.metrics_port}: {e}")
+                return 1
+        
+        if args.dedupe:
+            dedupe_start = time.time()
+            clusters = find_near_duplicates(iter_questions(args.input), args.dedupe_threshold, args.dedupe_workers)
+            members = sum(len(cluster) for cluster in clusters.values())
+            logger.info(
+                f"Found {members} near-duplicate questions in {len(clusters)} clusters in {time.time() - dedupe_start:.1f}s; "
+                f"{'sending all of them' if args.dedupe_send_all else 'sending one question per cluster'}"
+            )
+            (pipeline[0] if pipeline else processor).apply_clusters(clusters, send_all=args.dedupe_send_all)
+        
+        profiler = Profiler(processor, args.profile_output, args.profile_stacks, args.profile_interval).start() if args.profile else None
+        try:
+            if args.serve is not None:
+                asyncio.run(JobService(processor, args.jobs_dir, args.serve_host, args.serve).run())
+                return 0
+            elif args.worker:
+                coordinator = ShardCoordinator(args.worker)
+                worker_id = f"{socket.gethostname()}-{os.getpid()}"
+                shards_done = asyncio.run(run_shard_worker(processor, coordinator, worker_id, lease_ttl=args.lease_ttl))
+                logger.info(f"Worker {worker_id} finished after completing {shards_done} shards")
+                return 0
+            elif pipeline:
+                pipeline[0].input_file = args.input
+                # With --resume every stage continues from its own checkpoint log
+                asyncio.run(run_pipeline(pipeline, iter_questions(args.input), resume=args.resume is not None))
+                processor.input_error = pipeline[0].input_error
+            elif args.resume:
+                processor.resume_from_checkpoint(args.resume, args.input)
+            else:
+                processor.input_file = args.input
+                # Questions are parsed lazily while earlier ones are already being dispatched
+                processor.process_questions(iter_questions(args.input))
+        finally:
+            if profiler is not None:
+                profiler.stop()
+        
+        if processor.input_error:
+            logger.error(f"Input error: {processor.input_error}")
+            return 1
         
         progress = processor.get_progress()
         logger.info("Processing completed!")
@@ -655,6 +5103,4 @@ def main():
 
 
 if __name__ == "__main__":
-    import asyncio
-    import concurrent.futures
     sys.exit(main())
\ No newline at end of file
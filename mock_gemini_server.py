@@ -0,0 +1,472 @@
+import sys
+import json
+import math
+import time
+import random
+import logging
+import argparse
+import threading
+from collections import deque
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from typing import List, Dict, Any, Callable, Optional
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+MOCK_WORDS = "mock answer text for local benchmarking of the gemini processor without spending any real quota".split()
+MOCK_TELUGU_WORDS = "ఇది స్థానిక పరీక్ష కోసం ఒక నమూనా సమాధానం ప్రశ్న వివరణ సమయం పని రోజు".split()
+# Kinds of unusable answer injected by --bad-answer-rate, drawn with equal weight
+BAD_ANSWERS = ("truncated", "blocked", "wrong_script", "too_short")
+
+
+def parse_distribution(spec: str) -> Callable[[random.Random], float]:
+    # "fixed:0.5", "uniform:0.2,1.0", "normal:0.5,0.1", "lognormal:0.4,0.6" (median, sigma) or "exponential:0.5" (mean)
+    name, _, params = spec.partition(":")
+    try:
+        values = [float(v) for v in params.split(",")] if params else []
+    except ValueError:
+        raise ValueError(f"Invalid distribution parameters: {spec}")
+    
+    if name == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if name == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if name == "normal" and len(values) == 2:
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if name == "lognormal" and len(values) == 2:
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    if name == "exponential" and len(values) == 1:
+        return lambda rng: rng.expovariate(1.0 / values[0])
+    raise ValueError(f"Unknown distribution: {spec}")
+
+
+class MockGeminiServer:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8765,
+        latency: str = "fixed:0.2",
+        response_chars: str = "fixed:400",
+        rpm_limit: Optional[int] = None,
+        daily_limit: Optional[int] = None,
+        tpm_limit: Optional[int] = None,
+        error_429_rate: float = 0.0,
+        error_5xx_rate: float = 0.0,
+        valid_keys: Optional[List[str]] = None,
+        seed: Optional[int] = None,
+        chunk_chars: int = 80,
+        chunk_interval: float = 0.05,
+        stream_drop_rate: float = 0.0,
+        slots: int = 4,
+        telugu: bool = False,
+        bad_answer_rate: float = 0.0
+    ):
+        self.latency = parse_distribution(latency)
+        self.response_chars = parse_distribution(response_chars)
+        self.rpm_limit = rpm_limit
+        self.daily_limit = daily_limit
+        self.tpm_limit = tpm_limit
+        self.error_429_rate = error_429_rate
+        self.error_5xx_rate = error_5xx_rate
+        self.valid_keys = set(valid_keys) if valid_keys else None
+        self.rng = random.Random(seed)
+        self.chunk_chars = max(1, chunk_chars)
+        self.chunk_interval = chunk_interval
+        self.stream_drop_rate = stream_drop_rate
+        self.slots = slots
+        self.words = MOCK_TELUGU_WORDS if telugu else MOCK_WORDS
+        self.bad_answer_rate = bad_answer_rate
+        self.lock = threading.Lock()
+        
+        self.key_windows: Dict[str, deque] = {}
+        self.token_windows: Dict[str, deque] = {}
+        self.stats: Dict[str, Any] = {}
+        self.reset_stats()
+        
+        server = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+            
+            def do_GET(self) -> None:
+                if urlparse(self.path).path == "/stats":
+                    self._send(200, server.get_stats())
+                elif urlparse(self.path).path == "/props":
+                    # What llama-server reports, so the mock can stand in for a local backend too
+                    self._send(200, {"total_slots": server.slots})
+                else:
+                    self._send(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+            
+            def do_POST(self) -> None:
+                path = urlparse(self.path).path
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                if path == "/reset":
+                    server.reset_stats()
+                    self._send(200, {"reset": True})
+                elif path.endswith(":generateContent"):
+                    api_key = parse_qs(urlparse(self.path).query).get("key", [""])[0]
+                    status, payload = server.handle_generate(api_key, body)
+                    self._send(status, payload)
+                elif path == "/v1/chat/completions":
+                    status, payload = server.handle_chat_completion(body)
+                    self._send(status, payload)
+                elif path.endswith(":streamGenerateContent"):
+                    # Latency is the time to the first chunk; the rest follow every chunk_interval
+                    api_key = parse_qs(urlparse(self.path).query).get("key", [""])[0]
+                    status, payload = server.handle_generate(api_key, body)
+                    if status == 200:
+                        self._stream(payload)
+                    else:
+                        self._send(status, payload)
+                else:
+                    self._send(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+            
+            def _stream(self, payload: Dict[str, Any]) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for i, event in enumerate(server.stream_events(payload)):
+                    if event is None:
+                        # Simulated broken connection: stop without the terminating chunk
+                        self.close_connection = True
+                        return
+                    if i:
+                        time.sleep(server.chunk_interval)
+                    data = f"data: {json.dumps(event, ensure_ascii=False)}\r\n\r\n".encode("utf-8")
+                    self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+            
+            def _send(self, status: int, payload: Dict[str, Any]) -> None:
+                out = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=UTF-8")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+        
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+    
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1beta/models/gemini-mock:generateContent"
+    
+    def reset_stats(self) -> None:
+        with self.lock:
+            self.key_windows = {}
+            self.token_windows = {}
+            self.stats = {
+                "started": time.time(),
+                "requests": 0,
+                "ok": 0,
+                "rate_limited": 0,
+                "token_limited": 0,
+                "quota_exhausted": 0,
+                "injected_429": 0,
+                "injected_5xx": 0,
+                "bad_requests": 0,
+                "streams": 0,
+                "dropped_streams": 0,
+                "bad_answers": {},
+                "in_flight": 0,
+                "peak_in_flight": 0,
+                "per_key": {}
+            }
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            stats = json.loads(json.dumps(self.stats))
+        stats["uptime"] = time.time() - stats["started"]
+        return stats
+    
+    def _error(self, code: int, status: str, message: str, retry_delay: Optional[float] = None) -> Dict[str, Any]:
+        error: Dict[str, Any] = {"code": code, "message": message, "status": status}
+        if retry_delay is not None:
+            error["details"] = [{
+                "@type": "type.googleapis.com/google.rpc.RetryInfo",
+                "retryDelay": f"{max(1, math.ceil(retry_delay))}s"
+            }]
+        return {"error": error}
+    
+    def _admit(self, api_key: str, now: float) -> Optional[tuple]:
+        # Enforces the per-key limits; returns (status, payload) for a rejected request
+        with self.lock:
+            self.stats["requests"] += 1
+            key_stats = self.stats["per_key"].setdefault(api_key, {"requests": 0, "ok": 0, "rejected": 0})
+            key_stats["requests"] += 1
+            
+            if not api_key or (self.valid_keys is not None and api_key not in self.valid_keys):
+                self.stats["bad_requests"] += 1
+                key_stats["rejected"] += 1
+                return 400, self._error(400, "INVALID_ARGUMENT", "API key not valid. Please pass a valid API key.")
+            
+            window = self.key_windows.setdefault(api_key, deque())
+            while window and window[0] <= now - 60:
+                window.popleft()
+            
+            if self.daily_limit is not None and key_stats["ok"] >= self.daily_limit:
+                self.stats["quota_exhausted"] += 1
+                key_stats["rejected"] += 1
+                return 429, self._error(429, "RESOURCE_EXHAUSTED", "Quota exceeded for requests per day.")
+            if self.rpm_limit is not None and len(window) >= self.rpm_limit:
+                self.stats["rate_limited"] += 1
+                key_stats["rejected"] += 1
+                return 429, self._error(429, "RESOURCE_EXHAUSTED", "Quota exceeded for requests per minute.", window[0] + 60 - now)
+            tokens = self.token_windows.setdefault(api_key, deque())
+            while tokens and tokens[0][0] <= now - 60:
+                tokens.popleft()
+            if self.tpm_limit is not None and sum(count for _, count in tokens) >= self.tpm_limit:
+                self.stats["token_limited"] += 1
+                key_stats["rejected"] += 1
+                return 429, self._error(429, "RESOURCE_EXHAUSTED", "Quota exceeded for input tokens per minute.", tokens[0][0] + 60 - now)
+            
+            roll = self.rng.random()
+            if roll < self.error_429_rate:
+                self.stats["injected_429"] += 1
+                key_stats["rejected"] += 1
+                return 429, self._error(429, "RESOURCE_EXHAUSTED", "Resource has been exhausted (e.g. check quota).")
+            if roll < self.error_429_rate + self.error_5xx_rate:
+                self.stats["injected_5xx"] += 1
+                key_stats["rejected"] += 1
+                if self.rng.random() < 0.5:
+                    return 500, self._error(500, "INTERNAL", "An internal error has occurred.")
+                return 503, self._error(503, "UNAVAILABLE", "The model is overloaded. Please try again later.")
+            
+            window.append(now)
+            return None
+    
+    def _answer(self, chars: int, words_from: Optional[List[str]] = None) -> str:
+        words = []
+        length = 0
+        while length < chars:
+            word = self.rng.choice(words_from or self.words)
+            words.append(word)
+            length += len(word) + 1
+        return " ".join(words)[:max(1, chars)]
+    
+    def handle_generate(self, api_key: str, body: bytes) -> tuple:
+        with self.lock:
+            self.stats["in_flight"] += 1
+            self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.stats["in_flight"])
+            delay = self.latency(self.rng)
+        
+        try:
+            # Latency is spent whether or not the request is admitted, like a real round trip
+            time.sleep(delay)
+            
+            rejected = self._admit(api_key, time.time())
+            if rejected is not None:
+                return rejected
+            
+            try:
+                data = json.loads(body)
+                parts = data["contents"]["parts"] if isinstance(data["contents"], dict) else data["contents"][0]["parts"]
+                prompt = "".join(part.get("text", "") for part in parts)
+                system = "".join(part.get("text", "") for part in (data.get("system_instruction") or {}).get("parts", []))
+            except Exception as e:
+                with self.lock:
+                    self.stats["bad_requests"] += 1
+                return 400, self._error(400, "INVALID_ARGUMENT", f"Invalid request body: {e}")
+            
+            generation_config = data.get("generationConfig") or {}
+            with self.lock:
+                if generation_config.get("responseSchema") is not None and "Items:\n" in prompt:
+                    # Packed request: answer every item in the structured form the caller asked for
+                    try:
+                        items = json.loads(prompt.split("Items:\n", 1)[1])
+                    except json.JSONDecodeError:
+                        items = []
+                    text = json.dumps(
+                        [{"id": item.get("id"), "response": self._answer(int(self.response_chars(self.rng)))} for item in items],
+                        ensure_ascii=False
+                    )
+                else:
+                    text = self._answer(int(self.response_chars(self.rng)))
+                bad = self.rng.choice(BAD_ANSWERS) if self.rng.random() < self.bad_answer_rate else None
+                if bad == "wrong_script":
+                    text = self._answer(len(text), MOCK_WORDS if self.words is not MOCK_WORDS else MOCK_TELUGU_WORDS)
+                elif bad == "too_short":
+                    text = text[:3]
+                elif bad == "truncated":
+                    text = text[:len(text) // 2]
+                if bad is not None:
+                    self.stats["bad_answers"][bad] = self.stats["bad_answers"].get(bad, 0) + 1
+                self.stats["ok"] += 1
+                self.stats["per_key"][api_key]["ok"] += 1
+            
+            prompt_tokens = max(1, (len(prompt) + len(system)) // 4)
+            output_tokens = max(1, len(text) // 4)
+            with self.lock:
+                # Counted once the answer is generated, so concurrent requests can overshoot a little
+                self.token_windows.setdefault(api_key, deque()).append((time.time(), prompt_tokens + output_tokens))
+            if bad == "blocked":
+                # A prompt blocked by the safety filters comes back with no candidates at all
+                return 200, {
+                    "promptFeedback": {"blockReason": "SAFETY"},
+                    "usageMetadata": {"promptTokenCount": prompt_tokens, "totalTokenCount": prompt_tokens},
+                    "modelVersion": "gemini-mock"
+                }
+            return 200, {
+                "candidates": [{
+                    "content": {"parts": [{"text": text}], "role": "model"},
+                    "finishReason": "MAX_TOKENS" if bad == "truncated" else "STOP",
+                    "index": 0
+                }],
+                "usageMetadata": {
+                    "promptTokenCount": prompt_tokens,
+                    "candidatesTokenCount": output_tokens,
+                    "totalTokenCount": prompt_tokens + output_tokens
+                },
+                "modelVersion": "gemini-mock"
+            }
+        finally:
+            with self.lock:
+                self.stats["in_flight"] -= 1
+    
+    def handle_chat_completion(self, body: bytes) -> tuple:
+        # OpenAI-compatible endpoint in the shape llama-server returns; no keys or limits apply
+        with self.lock:
+            self.stats["local_requests"] = self.stats.get("local_requests", 0) + 1
+            delay = self.latency(self.rng)
+            text = self._answer(int(self.response_chars(self.rng)))
+        time.sleep(delay)
+        
+        try:
+            data = json.loads(body)
+            prompt = "".join(str(message.get("content", "")) for message in data["messages"])
+        except Exception as e:
+            return 400, {"error": {"code": 400, "message": f"Invalid request body: {e}", "type": "invalid_request_error"}}
+        
+        prompt_tokens = max(1, len(prompt) // 4)
+        output_tokens = max(1, len(text) // 4)
+        return 200, {
+            "id": f"chatcmpl-mock-{int(time.time() * 1000)}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": data.get("model", "local"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": output_tokens, "total_tokens": prompt_tokens + output_tokens}
+        }
+    
+    def stream_events(self, payload: Dict[str, Any]):
+        # Splits a generateContent response into streamGenerateContent events; None marks a drop
+        if not payload.get("candidates"):
+            yield payload
+            return
+        candidate = payload["candidates"][0]
+        text = candidate["content"]["parts"][0]["text"]
+        pieces = [text[i:i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)] or [""]
+        with self.lock:
+            self.stats["streams"] += 1
+            # Always drop before the final event, so a dropped stream never carries a finishReason
+            drop_at = self.rng.randrange(len(pieces)) if self.rng.random() < self.stream_drop_rate else None
+            if drop_at is not None:
+                self.stats["dropped_streams"] += 1
+        
+        for i, piece in enumerate(pieces):
+            if i == drop_at:
+                yield None
+                return
+            event: Dict[str, Any] = {
+                "candidates": [{"content": {"parts": [{"text": piece}], "role": "model"}, "index": 0}],
+                "modelVersion": payload["modelVersion"]
+            }
+            if i == len(pieces) - 1:
+                event["candidates"][0]["finishReason"] = candidate["finishReason"]
+                event["usageMetadata"] = payload["usageMetadata"]
+            yield event
+    
+    def start(self) -> "MockGeminiServer":
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mock-gemini", daemon=True)
+        self.thread.start()
+        return self
+    
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Gemini generateContent endpoint")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on (0 picks a free port)")
+    parser.add_argument("--latency", default="fixed:0.2",
+                    help="Response latency in seconds: fixed:S, uniform:LO,HI, normal:MEAN,SD, lognormal:MEDIAN,SIGMA or exponential:MEAN")
+    parser.add_argument("--response-chars", default="fixed:400", help="Answer length in characters, same forms as --latency")
+    parser.add_argument("--rpm-limit", type=int, default=None, help="Requests per minute allowed per API key before 429s")
+    parser.add_argument("--daily-limit", type=int, default=None, help="Successful requests allowed per API key before 429s")
+    parser.add_argument("--tpm-limit", type=int, default=None, help="Tokens per minute allowed per API key before 429s")
+    parser.add_argument("--error-429-rate", type=float, default=0.0, help="Fraction of requests answered with an injected 429")
+    parser.add_argument("--error-5xx-rate", type=float, default=0.0, help="Fraction of requests answered with an injected 500/503")
+    parser.add_argument("--api-keys", default=None, help="Only accept the keys in this file (one per line); any key is accepted otherwise")
+    parser.add_argument("--chunk-chars", type=int, default=80, help="Characters per streamGenerateContent chunk")
+    parser.add_argument("--chunk-interval", type=float, default=0.05, help="Seconds between streamed chunks")
+    parser.add_argument("--stream-drop-rate", type=float, default=0.0,
+                    help="Fraction of streamed responses cut off partway through")
+    parser.add_argument("--slots", type=int, default=4, help="total_slots reported on /props for the chat completions endpoint")
+    parser.add_argument("--telugu", action="store_true", help="Answer in Telugu words instead of English ones")
+    parser.add_argument("--bad-answer-rate", type=float, default=0.0,
+                    help="Fraction of answers that are truncated, safety-blocked, in the wrong script or too short")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for latencies, answers and injected errors")
+    
+    args = parser.parse_args()
+    
+    valid_keys = None
+    if args.api_keys:
+        with open(args.api_keys, 'r', encoding='utf-8') as f:
+            valid_keys = [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+    
+    try:
+        server = MockGeminiServer(
+            host=args.host,
+            port=args.port,
+            latency=args.latency,
+            response_chars=args.response_chars,
+            rpm_limit=args.rpm_limit,
+            daily_limit=args.daily_limit,
+            tpm_limit=args.tpm_limit,
+            error_429_rate=args.error_429_rate,
+            error_5xx_rate=args.error_5xx_rate,
+            valid_keys=valid_keys,
+            seed=args.seed,
+            chunk_chars=args.chunk_chars,
+            chunk_interval=args.chunk_interval,
+            stream_drop_rate=args.stream_drop_rate,
+            slots=args.slots,
+            telugu=args.telugu,
+            bad_answer_rate=args.bad_answer_rate
+        )
+    except Exception as e:
+        logger.error(f"Error starting mock server: {e}")
+        return 1
+    
+    # Benchmarks read this line to find the server when it was started with --port 0
+    print(f"MOCK_URL {server.url}", flush=True)
+    logger.info(f"Mock Gemini server listening at {server.url} (started {datetime.now().strftime('%Y-%m-%d %H:%M:%S')})")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        logger.info(f"Final stats: {json.dumps({k: v for k, v in server.get_stats().items() if k != 'per_key'})}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gemini_processor
+
+gemini_processor.configure_logging(log_file=None, force=True)
+
+
+def test_log_tail_is_replayed_on_load(tmp_path):
+    log = gemini_processor.CheckpointLog(str(tmp_path), "run")
+    log.append([5, 1 << 63, 3])
+    log.close()
+    
+    reloaded = gemini_processor.CheckpointLog(str(tmp_path), "run").load()
+    assert len(reloaded) == 3
+    assert 5 in reloaded and (1 << 63) in reloaded and 3 in reloaded
+    assert 4 not in reloaded
+    # 16 hex digits and a newline per completed question
+    assert os.path.getsize(log.wal_path) == 3 * 17
+
+
+def test_compaction_merges_repeated_ids_into_the_snapshot(tmp_path):
+    log = gemini_processor.CheckpointLog(str(tmp_path), "run")
+    log.append([9, 2])
+    log.append([2, 7])  # 2 was asked again, e.g. after an interrupted run
+    log.compact()
+    log.close()
+    
+    assert os.path.getsize(log.snapshot_path) == 3 * 8
+    assert os.path.getsize(log.wal_path) == 0
+    reloaded = gemini_processor.CheckpointLog(str(tmp_path), "run").load()
+    assert len(reloaded) == 3
+    assert all(qid in reloaded for qid in (2, 7, 9))
+    
+    reloaded.append([1])
+    reloaded.close()
+    again = gemini_processor.CheckpointLog(str(tmp_path), "run").load()
+    assert len(again) == 4 and 1 in again and 9 in again
+
+
+def test_log_compacts_itself_once_the_tail_grows(tmp_path):
+    log = gemini_processor.CheckpointLog(str(tmp_path), "run", snapshot_every=4)
+    log.append([1, 2, 3])
+    assert not os.path.exists(log.snapshot_path)
+    log.append([4])
+    log.close()
+    assert os.path.getsize(log.snapshot_path) == 4 * 8
+    assert len(gemini_processor.CheckpointLog(str(tmp_path), "run").load()) == 4
+
+
+def test_reset_forgets_completed_work(tmp_path):
+    log = gemini_processor.CheckpointLog(str(tmp_path), "run", snapshot_every=2)
+    log.append([1, 2, 3])
+    log.reset()
+    assert len(log) == 0 and 1 not in log
+    assert not os.path.exists(log.wal_path) and not os.path.exists(log.snapshot_path)
+
+
+def test_resume_skips_questions_answered_by_the_previous_run(tmp_path):
+    prompt = tmp_path / "prompt.txt"
+    prompt.write_text("prompt", encoding="utf-8")
+    output = tmp_path / "results.json"
+    checkpoints = tmp_path / "checkpoints"
+    asked = []
+    
+    def new_processor():
+        processor = gemini_processor.GeminiProcessor(
+            ["key1111111111"],
+            str(prompt),
+            output_file=str(output),
+            checkpoint_dir=str(checkpoints),
+            rpm_limit=6000
+        )
+        
+        async def answer(batch):
+            asked.extend(gemini_processor.question_text(q) for q in batch)
+            return [{"question": gemini_processor.question_text(q), "response": "answer"} for q in batch]
+        
+        processor.process_question_batch = answer
+        return processor
+    
+    new_processor().process_questions(["q1", {"id": 2, "question": "q2"}])
+    assert sorted(asked) == ["q1", "q2"]
+    
+    # The resumed input repeats both answered questions (q2 by id, with a changed text)
+    input_file = tmp_path / "questions.json"
+    input_file.write_text(json.dumps({"questions": ["q1", {"id": 2, "question": "q2 edited"}, "q3"]}), encoding="utf-8")
+    asked.clear()
+    processor = new_processor()
+    processor.resume_from_checkpoint(processor.checkpoint_name, str(input_file))
+    
+    assert asked == ["q3"]
+    assert processor.skipped_count == 2
+    with open(output, encoding="utf-8") as f:
+        questions = [r["question"] for r in json.load(f)["questions"]]
+    assert sorted(questions) == ["q1", "q2", "q3"]
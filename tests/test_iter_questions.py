@@ -0,0 +1,36 @@
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gemini_processor
+
+gemini_processor.configure_logging(log_file=None, force=True)
+
+QUESTIONS = [
+    1.5e10, "plain", -2.25E-3, 7, {"id": 3, "question": "with \"quotes\" and ]}, inside"},
+    "తెలుగు ప్రశ్న", True, None, False, [1, [2.5, "x"]], 12345678901234567890, 0.1
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 16, 1 << 16])
+def test_json_input_at_any_chunk_size(tmp_path, chunk_size):
+    path = tmp_path / "questions.json"
+    path.write_text(json.dumps({"meta": {"n": 1.25}, "questions": QUESTIONS, "after": 3e5}, ensure_ascii=False), encoding="utf-8")
+    assert list(gemini_processor.iter_questions(str(path), chunk_size=chunk_size)) == QUESTIONS
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1 << 16])
+def test_number_at_end_of_file(tmp_path, chunk_size):
+    path = tmp_path / "questions.json"
+    path.write_text('{"questions": [1.5e10]}', encoding="utf-8")
+    assert list(gemini_processor.iter_questions(str(path), chunk_size=chunk_size)) == [1.5e10]
+
+
+def test_missing_questions_list(tmp_path):
+    path = tmp_path / "questions.json"
+    path.write_text('{"other": [1, 2]}', encoding="utf-8")
+    with pytest.raises(ValueError):
+        list(gemini_processor.iter_questions(str(path)))
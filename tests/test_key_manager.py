@@ -0,0 +1,51 @@
+import os
+import sys
+import time
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gemini_processor
+
+gemini_processor.configure_logging(log_file=None, force=True)
+
+KEY = "key1111111111"
+
+
+async def take_probe(key_manager: gemini_processor.KeyManager) -> dict:
+    # Opens the key's circuit and waits out the cool-down until it is handed out as a probe
+    for _ in range(3):
+        key_manager.mark_error(KEY)
+    probe = await key_manager.acquire_key(timeout=5)
+    assert probe is not None and probe['circuit'] == 'half_open'
+    return probe
+
+
+def test_waiter_served_after_probe_success():
+    async def run():
+        key_manager = gemini_processor.KeyManager([KEY], rpm_limit=6000, min_interval=0, breaker_cooldown=0.2, probe_timeout=10)
+        probe = await take_probe(key_manager)
+        waiter = asyncio.ensure_future(key_manager.acquire_key(timeout=5))
+        await asyncio.sleep(0.1)
+        
+        start = time.time()
+        key_manager.mark_success(probe['key'], 0.1)
+        assert await waiter is not None
+        return time.time() - start
+    
+    assert asyncio.run(run()) < 1
+
+
+def test_waiter_served_after_rate_limited_probe():
+    async def run():
+        key_manager = gemini_processor.KeyManager([KEY], rpm_limit=60, min_interval=0, breaker_cooldown=0.2, probe_timeout=10)
+        probe = await take_probe(key_manager)
+        waiter = asyncio.ensure_future(key_manager.acquire_key(timeout=5))
+        await asyncio.sleep(0.1)
+        
+        start = time.time()
+        key_manager.mark_rate_limited(probe['key'])
+        assert await waiter is not None
+        return time.time() - start
+    
+    # One request per second refills a token in at most a second, well before the probe timeout
+    assert asyncio.run(run()) < 2
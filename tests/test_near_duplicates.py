@@ -0,0 +1,31 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gemini_processor
+
+gemini_processor.configure_logging(log_file=None, force=True)
+
+
+def cluster(texts):
+    index = gemini_processor.NearDuplicateIndex(0.9)
+    return [index.add(signature) for signature in gemini_processor.minhash_signatures(texts)]
+
+
+def test_non_ascii_digits():
+    # Telugu and Arabic-Indic digits used to fail encoding the numbers hash
+    assert cluster(["తెలుగు ౧౨ ప్రశ్న", "price is ٣ dollars"]) == [None, None]
+
+
+def test_digits_compare_by_value():
+    assert cluster(["how long is a 12 hour shift at work", "how long is a ౧౨ hour shift at work"]) == [None, 0]
+
+
+def test_different_numbers_are_not_duplicates():
+    assert cluster(["how long is a 1 hour shift at work", "how long is a 5 hour shift at work"]) == [None, None]
+
+
+def test_near_duplicates_cluster_to_first():
+    questions = ["What is the capital of France?", "what is the capital of france", "Who wrote Hamlet?"]
+    clusters = gemini_processor.find_near_duplicates(questions, workers=1)
+    assert clusters == {gemini_processor.question_id(questions[0]): [questions[1]]}
@@ -0,0 +1,121 @@
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gemini_processor
+
+gemini_processor.configure_logging(log_file=None, force=True)
+
+RECORDS = [{"question": f"question {i}", "response": f"సమాధానం {i} " * (i % 7)} for i in range(50)]
+RECORDS.append({"id": 99, "question": "with an id", "response": "by id"})
+
+
+@pytest.fixture(params=["zlib", "zstd"])
+def codec(request, monkeypatch):
+    if request.param == "zstd" and not gemini_processor.ZSTD_AVAILABLE:
+        pytest.skip("zstandard is not installed")
+    monkeypatch.setattr(gemini_processor, "ZSTD_AVAILABLE", request.param == "zstd")
+    return request.param
+
+
+def write_store(path, records, **kwargs):
+    writer = gemini_processor.ResultStoreWriter(str(path), **kwargs)
+    for record in records:
+        writer.write(record)
+    writer.close()
+    return writer
+
+
+def test_round_trip_across_blocks_and_shards(tmp_path, codec):
+    writer = write_store(tmp_path / "store", RECORDS, shard_records=20, block_bytes=200)
+    assert len(writer.shards) == 3
+    assert os.path.exists(tmp_path / "store" / f"shard-00000.jsonl.{codec}")
+    
+    store = gemini_processor.ResultStore(str(tmp_path / "store"))
+    try:
+        assert store.manifest["codec"] == codec
+        assert len(store) == len(RECORDS)
+        assert list(store) == RECORDS
+        for record in RECORDS:
+            assert store.get(record) == record
+        assert store.get("question 17") == RECORDS[17]
+        assert store.get({"id": 99, "question": "text changed"}) == RECORDS[-1]
+        assert store.get_by_id(gemini_processor.question_id("question 3")) == RECORDS[3]
+        assert store.get("never asked") is None
+        assert "question 0" in store
+    finally:
+        store.close()
+
+
+def test_newest_record_wins(tmp_path, codec):
+    records = [
+        {"question": "a", "response": "first"},
+        {"question": "b", "response": "only"},
+        {"question": "a", "response": "second"},
+        {"question": "c", "response": "only"},
+        {"question": "a", "response": "third"}
+    ]
+    write_store(tmp_path / "store", records, shard_records=4)
+    store = gemini_processor.ResultStore(str(tmp_path / "store"))
+    try:
+        assert store.get("a")["response"] == "third"
+        assert store.get("b")["response"] == "only"
+    finally:
+        store.close()
+    
+    write_store(tmp_path / "one_shard", records[:3])
+    store = gemini_processor.ResultStore(str(tmp_path / "one_shard"))
+    try:
+        assert store.get("a")["response"] == "second"
+    finally:
+        store.close()
+
+
+def test_index_header(tmp_path, codec):
+    write_store(tmp_path / "store", RECORDS, block_bytes=500)
+    index_path = tmp_path / "store" / "shard-00000.idx"
+    data = index_path.read_bytes()
+    assert data[:8] == b"GPSTORE1"
+    header = memoryview(data).cast('Q')
+    assert header[2] == len(RECORDS)
+    # Header, (offset, length) per block and (ID, location) per record, 8 bytes each
+    assert len(data) == 8 * (3 + 2 * header[1] + 2 * len(RECORDS))
+    
+    index_path.write_bytes(b"GPSTORE0" + data[8:])
+    with pytest.raises(ValueError):
+        gemini_processor.ResultStore(str(tmp_path / "store"))
+
+
+def test_empty_store(tmp_path, codec):
+    write_store(tmp_path / "store", [])
+    store = gemini_processor.ResultStore(str(tmp_path / "store"))
+    try:
+        assert len(store) == 0
+        assert list(store) == []
+        assert store.get("anything") is None
+    finally:
+        store.close()
+
+
+def test_build_from_journal_and_export(tmp_path, codec):
+    journal = tmp_path / "results.jsonl"
+    lines = [
+        {"question": "q1", "response": "partial answer", "partial": True, "error": "ERROR: Processing interrupted"},
+        {"question": "q2", "response": "answer 2"},
+        {"question": "q1", "response": "answer 1"}
+    ]
+    journal.write_text("".join(json.dumps(line, ensure_ascii=False) + "\n" for line in lines), encoding="utf-8")
+    
+    assert gemini_processor.build_result_store(str(journal), str(tmp_path / "store")) == 2
+    assert not os.path.exists(tmp_path / "store.tmp")
+    store = gemini_processor.ResultStore(str(tmp_path / "store"))
+    try:
+        assert store.get("q1") == lines[2]
+        assert store.export_json(str(tmp_path / "results.json")) == 2
+    finally:
+        store.close()
+    with open(tmp_path / "results.json", encoding="utf-8") as f:
+        assert json.load(f) == {"questions": lines[1:]}
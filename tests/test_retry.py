@@ -0,0 +1,35 @@
+import os
+import sys
+import time
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gemini_processor
+
+gemini_processor.configure_logging(log_file=None, force=True)
+
+
+def test_backs_off_between_attempts_outside_the_dispatcher(tmp_path):
+    prompt = tmp_path / "prompt.txt"
+    prompt.write_text("prompt", encoding="utf-8")
+    processor = gemini_processor.GeminiProcessor(
+        ["key1111111111"],
+        str(prompt),
+        output_file=str(tmp_path / "results.json"),
+        checkpoint_dir=str(tmp_path / "checkpoints"),
+        max_retries=3,
+        rpm_limit=6000,
+        retry_base_delay=0.2
+    )
+    attempts = []
+    
+    async def send(api_key):
+        attempts.append(time.time())
+        return "ERROR: HTTP error 503"
+    
+    result = asyncio.run(processor._request_with_retry(send))
+    assert result == "ERROR: Maximum retries exceeded"
+    assert len(attempts) == 3
+    # Equal jitter: at least half of base_delay * 2 ** (attempt - 1) between attempts
+    assert attempts[1] - attempts[0] >= 0.1
+    assert attempts[2] - attempts[1] >= 0.2
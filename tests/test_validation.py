@@ -0,0 +1,63 @@
+import os
+import sys
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gemini_processor
+
+gemini_processor.configure_logging(log_file=None, force=True)
+
+TELUGU = "ఇది ఒక పూర్తి తెలుగు సమాధానం"
+RULES = {"min_chars": 10, "min_script_ratio": 0.6}
+
+
+@pytest.mark.parametrize("text, finish_reason, rules, reason", [
+    (TELUGU, "STOP", RULES, None),
+    (TELUGU + " (API)", "STOP", RULES, None),
+    ("", None, {}, "blocked"),
+    (TELUGU, "SAFETY", RULES, "blocked"),
+    ("", "content_filter", {}, "blocked"),
+    (TELUGU, "MAX_TOKENS", RULES, "truncated"),
+    (TELUGU, "length", RULES, "truncated"),
+    ("  తెలుగు  ", "STOP", RULES, "too_short"),
+    ("This answer is in English only", "STOP", RULES, "wrong_script"),
+    ("1234567890 !!", "STOP", RULES, "wrong_script"),
+    ("English mostly, కొంత తెలుగు", "STOP", RULES, "wrong_script"),
+    ('```json\n{"answer": "' + TELUGU + '"}\n```', "STOP", {"expect_json": True}, None),
+    ('{"answer": ', "STOP", {"expect_json": True}, "invalid_json"),
+    ("anything goes", "STOP", {}, None)
+])
+def test_reason_codes(text, finish_reason, rules, reason):
+    assert gemini_processor.validate_response(text, finish_reason, rules) == reason
+
+
+def test_rejected_answers_are_requeued_within_their_own_budget(tmp_path):
+    prompt = tmp_path / "prompt.txt"
+    prompt.write_text("prompt", encoding="utf-8")
+    processor = gemini_processor.GeminiProcessor(
+        ["key1111111111"],
+        str(prompt),
+        output_file=str(tmp_path / "results.json"),
+        checkpoint_dir=str(tmp_path / "checkpoints"),
+        validation=RULES,
+        validation_retries=2,
+        validation_workers=0
+    )
+    processor.defer_retries = True
+    
+    async def validate(text):
+        processor.finish_reasons["q"] = "STOP"
+        return await processor._validate_response("q", text)
+    
+    for _ in range(2):
+        with pytest.raises(gemini_processor.RetryDeferred):
+            asyncio.run(validate("English answer"))
+    assert asyncio.run(validate("English answer")) == "English answer"
+    assert processor.validation_failed == {"q": "wrong_script"}
+    assert asyncio.run(validate(TELUGU)) == TELUGU
+    
+    stats = processor.validation_stats
+    assert (stats["checked"], stats["passed"], stats["requeued"], stats["rejected"]) == (4, 1, 2, 1)
+    assert stats["reasons"] == {"wrong_script": 3}